@@ -0,0 +1 @@
+"""Benchmarks of the trade_engine hot paths on synthetic, scaled workbooks (see bench_engine.py)."""
@@ -0,0 +1,345 @@
+"""
+Benchmark of the engine's hot paths on synthetic workbooks 1x-1000x the size of the real one.
+
+    python -m benchmarks.bench_engine --scales 1 10 100 1000 --output bench.json
+    python -m benchmarks.bench_engine --scales 10 100 --output new.json --compare bench.json
+
+For every scale it times the cold workbook load (load_excel_data), each process_* function, the
+WorkbookStore refresh with a cold and a warm snapshot cache, the lookup structures and the
+per-interaction calculators, and records the peak resident memory of every stage. Results are
+written as JSON; --compare reports the stages that got slower than a previous results file
+(exit code 1 when any did), so regressions can be caught from one commit to the next.
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from benchmarks.synthetic import SCALED_SHEET_COLUMNS, SYNTHETIC_VERSION, UNSCALED_SHEETS, write_synthetic_workbook
+from trade_engine.freight import FreightRateIndex, calculate_freight_cost, calculate_freight_costs_batch
+from trade_engine.fx import FxChartPyramid, FxCurveStore, convert_currency_bulk, perform_currency_conversion
+from trade_engine.hedging import optimize_fx_hedges
+from trade_engine.processing import SHEET_PROCESSORS
+from trade_engine.sensitivities import calculate_sensitivities
+from trade_engine.valuation import ValuationLookup, calculate_valuation, calculate_valuation_grid
+from trade_engine.workbook import (
+    DEFAULT_WORKBOOK_PATH,
+    RAW_PREVIEW_SHEETS,
+    SHEET_NAME_FREIGHT,
+    SHEET_NAME_FX_FIX,
+    SHEET_NAME_VALO,
+    WorkbookStore,
+    load_excel_data,
+)
+
+BENCHMARK_FORMAT_VERSION = 1
+DEFAULT_SCALES = [1, 10, 100, 1000]
+DEFAULT_REPEATS = 5 # Timed runs of every cheap stage; cold loads run once per scale
+SINGLE_CALL_LOOPS = 200 # Calls per timed run of the single-value calculators
+BATCH_ROWS = 10_000 # Legs / cash flows priced by the batch calculator stages
+GRID_SIZE = 100 # Buying diffs x costings of the valuation grid stage
+HEDGE_DAYS = 5 * 365 # Value-date span of the hedge optimizer stage, one daily bucket per day
+REGRESSION_THRESHOLD = 1.25 # A stage is reported as a regression when it is this much slower
+BENCHMARK_PAIR = "EURUSD"
+
+
+class PeakMemory:
+    """
+    Peak memory of a block. On Linux this is the resident set high-water mark (VmHWM), reset at the
+    start of the block, next to the resident set size at the start; elsewhere it falls back to the
+    peak of Python allocations traced by tracemalloc (start_bytes stays None).
+    """
+
+    def __init__(self):
+        self.start_bytes = None
+        self.peak_bytes = None
+        self._use_proc = os.path.exists("/proc/self/clear_refs")
+
+    @staticmethod
+    def _proc_status_bytes(field):
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+        return None
+
+    def __enter__(self):
+        if self._use_proc:
+            try:
+                with open("/proc/self/clear_refs", "w") as f:
+                    f.write("5") # Resets VmHWM to the current resident set size
+                self.start_bytes = self._proc_status_bytes("VmRSS")
+            except OSError:
+                self._use_proc = False
+        if not self._use_proc:
+            tracemalloc.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._use_proc:
+            self.peak_bytes = self._proc_status_bytes("VmHWM")
+        else:
+            self.peak_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+
+def time_stage(fn, repeats, loops=1):
+    """Runs fn loops times per repeat; returns (seconds per call of every repeat, PeakMemory, last result)."""
+    timings = []
+    result = None
+    with PeakMemory() as memory:
+        for _ in range(repeats):
+            start = time.perf_counter()
+            for _ in range(loops):
+                result = fn()
+            timings.append((time.perf_counter() - start) / loops)
+    return timings, memory, result
+
+
+def environment_info():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "pyarrow": pa.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def synthetic_workbook_path(workdir, base_path, scale, seed, regenerate=False):
+    """Generates the workbook of one scale, or reuses the one from an earlier run."""
+    path = os.path.join(workdir, f"synthetic_v{SYNTHETIC_VERSION}_x{scale}_seed{seed}.xlsx")
+    if regenerate or not os.path.exists(path):
+        start = time.perf_counter()
+        rows = write_synthetic_workbook(base_path, path, scale, seed=seed)
+        print(f"  generated {os.path.basename(path)} in {time.perf_counter() - start:.1f}s: "
+              + ", ".join(f"{sheet_name} {count:,} rows" for sheet_name, count in rows.items()))
+    return path
+
+
+@contextlib.contextmanager
+def working_directory(path):
+    """Runs the block inside path, so the engine's relative snapshot cache lives there."""
+    previous = os.getcwd()
+    os.makedirs(path, exist_ok=True)
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def build_chart_pyramid(curve_store):
+    """FxChartPyramid with the levels of the benchmark pair built (the app builds them on the first chart request)."""
+    pyramid = FxChartPyramid(curve_store)
+    pyramid.levels(BENCHMARK_PAIR)
+    return pyramid
+
+
+def benchmark_scale(workbook_path, scale, repeats, cache_dir):
+    """Times every stage on one synthetic workbook (an absolute path). Returns a list of result records."""
+    results = []
+
+    def record(stage, rows, fn, stage_repeats=repeats, loops=1):
+        timings, memory, result = time_stage(fn, stage_repeats, loops)
+        results.append({
+            "scale": scale,
+            "stage": stage,
+            "rows": int(rows),
+            "repeats": stage_repeats,
+            "loops": loops,
+            "seconds_min": min(timings),
+            "seconds_median": statistics.median(timings),
+            "start_rss_bytes": memory.start_bytes,
+            "peak_rss_bytes": memory.peak_bytes,
+            # In-memory size of a DataFrame result (processed frames), to compare column layouts
+            "frame_bytes": int(result.memory_usage(deep=True).sum()) if isinstance(result, pd.DataFrame) else None,
+        })
+        print(f"  x{scale:<5} {stage:<40} {min(timings) * 1000:>12.3f} ms  {(memory.peak_bytes or 0) / 1e6:>9.1f} MB peak")
+        return result
+
+    sheet_names = list(SHEET_PROCESSORS)
+
+    # Cold load and processing, exactly as the store does it on a snapshot cache miss
+    raw_frames = record("load_excel_data", 0, lambda: load_excel_data(workbook_path, sheet_names), stage_repeats=1)
+    results[-1]["rows"] = sum(len(df) for df in raw_frames.values())
+    processed = {}
+    for sheet_name, process in SHEET_PROCESSORS.items():
+        stage = f"process[{sheet_name}]"
+        processed[sheet_name] = record(stage, len(raw_frames[sheet_name]), lambda: process(raw_frames[sheet_name]))
+
+    # Store refresh: cold (parse, process and snapshot) and warm (memory-mapped snapshots)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    with working_directory(cache_dir):
+        record("store_refresh_cold", results[0]["rows"],
+               lambda: WorkbookStore(workbook_path, SHEET_PROCESSORS, RAW_PREVIEW_SHEETS).refresh(), stage_repeats=1)
+        record("store_refresh_warm", results[0]["rows"],
+               lambda: WorkbookStore(workbook_path, SHEET_PROCESSORS, RAW_PREVIEW_SHEETS).refresh())
+
+    # Lookup structures, built once per sheet version in the app
+    freight_df = processed[SHEET_NAME_FREIGHT]
+    fx_df = processed[SHEET_NAME_FX_FIX]
+    valo_df = processed[SHEET_NAME_VALO]
+    freight_index = record("build[FreightRateIndex]", len(freight_df), lambda: FreightRateIndex(freight_df))
+    fx_curves = record("build[FxCurveStore]", len(fx_df), lambda: FxCurveStore(fx_df))
+    valo_lookup = record("build[ValuationLookup]", len(valo_df), lambda: ValuationLookup(valo_df))
+    pyramid = record("build[FxChartPyramid]", len(fx_df), lambda: build_chart_pyramid(fx_curves))
+
+    # Row filters as the tabs run them; categorical pair and lane columns compare integer codes
+    record("filter[FX pair]", len(fx_df), lambda: fx_df[(fx_df['FX'] == BENCHMARK_PAIR).to_numpy()], loops=SINGLE_CALL_LOOPS)
+    record("filter[freight origin]", len(freight_df),
+           lambda: freight_df[(freight_df['Origin'] == freight_df['Origin'].iloc[0]).to_numpy()], loops=SINGLE_CALL_LOOPS)
+
+    # Per-interaction calculators
+    rng = np.random.default_rng(0)
+    lane = freight_index.lane_table.iloc[len(freight_index.lane_table) // 2]
+    record("calculate_freight_cost", len(freight_df),
+           lambda: calculate_freight_cost(freight_df, lane['RateOrigin'], lane['RateDestination'], 250.0, rate_index=freight_index),
+           loops=SINGLE_CALL_LOOPS)
+    record("perform_currency_conversion", len(fx_df),
+           lambda: perform_currency_conversion(fx_df, BENCHMARK_PAIR, 1_000_000.0, curve_store=fx_curves),
+           loops=SINGLE_CALL_LOOPS)
+    record("calculate_valuation", len(valo_df),
+           lambda: calculate_valuation(valo_df, float(np.median(valo_lookup.buying_diffs)), 150.0, lookup=valo_lookup),
+           loops=SINGLE_CALL_LOOPS)
+
+    lane_rows = rng.integers(0, len(freight_index.lane_table), BATCH_ROWS)
+    legs = pd.DataFrame({
+        'Origin': freight_index.lane_table['RateOrigin'].to_numpy()[lane_rows],
+        'Destination': freight_index.lane_table['RateDestination'].to_numpy()[lane_rows],
+        'QuantityMT': rng.uniform(10, 500, BATCH_ROWS),
+    })
+    record(f"calculate_freight_costs_batch[{BATCH_ROWS}]", len(freight_df),
+           lambda: calculate_freight_costs_batch(freight_df, legs, rate_index=freight_index))
+
+    first_date, last_date = fx_curves.points['VALUE DATE'].min(), fx_curves.points['VALUE DATE'].max()
+    cash_flows = pd.DataFrame({
+        'FX': rng.choice([BENCHMARK_PAIR, BENCHMARK_PAIR[3:] + BENCHMARK_PAIR[:3], "GBPUSD", "EURGBP"], BATCH_ROWS),
+        'VALUE DATE': first_date + (last_date - first_date) * rng.uniform(0, 1, BATCH_ROWS),
+        'AMOUNT': rng.uniform(1e3, 1e6, BATCH_ROWS),
+    })
+    record(f"convert_currency_bulk[{BATCH_ROWS}]", len(fx_df),
+           lambda: convert_currency_bulk(fx_df, cash_flows, curve_store=fx_curves))
+
+    # Daily exposure buckets over the last HEDGE_DAYS up to the end of the curve
+    hedge_as_of = last_date.normalize() - pd.Timedelta(days=HEDGE_DAYS)
+    exposures = pd.DataFrame({
+        'Currency': BENCHMARK_PAIR[:3],
+        'VALUE DATE': hedge_as_of + pd.to_timedelta(rng.integers(0, HEDGE_DAYS, BATCH_ROWS), unit='D'),
+        'AMOUNT': rng.normal(0, 1e6, BATCH_ROWS),
+    })
+    hedge_settings = {"bucket_frequency": "D", "as_of_date": hedge_as_of, "max_tenor_days": HEDGE_DAYS,
+                      "base_currency": BENCHMARK_PAIR[3:], "bucket_notional_limit": 5e5, "total_notional_limit": 1e8}
+    record(f"optimize_fx_hedges[{BATCH_ROWS}]", len(exposures), lambda: optimize_fx_hedges(exposures, [fx_curves], hedge_settings))
+
+    # A book over the same lanes and diffs, bumped over every pair and lane it trades
+    book = pd.DataFrame({
+        'Buying Diff': rng.uniform(valo_lookup.buying_diffs.min(), valo_lookup.buying_diffs.max(), BATCH_ROWS),
+        'Costings': rng.uniform(0.0, 300.0, BATCH_ROWS),
+        'QuantityMT': legs['QuantityMT'],
+        'CostCurrency': rng.choice([BENCHMARK_PAIR[:3], BENCHMARK_PAIR[3:]], BATCH_ROWS),
+        'Origin': legs['Origin'],
+        'Destination': legs['Destination'],
+        'VALUE DATE': cash_flows['VALUE DATE'],
+    })
+    record(f"calculate_sensitivities[{BATCH_ROWS}]", len(book),
+           lambda: calculate_sensitivities(valo_df, book, fx_curves, freight_index, {"base_currency": BENCHMARK_PAIR[3:]}, lookup=valo_lookup))
+
+    buying_diffs = np.linspace(valo_lookup.buying_diffs.min(), valo_lookup.buying_diffs.max(), GRID_SIZE)
+    costings = np.linspace(0.0, 300.0, GRID_SIZE)
+    record(f"calculate_valuation_grid[{GRID_SIZE}x{GRID_SIZE}]", len(valo_df),
+           lambda: calculate_valuation_grid(valo_df, buying_diffs, costings, lookup=valo_lookup))
+
+    record("fx_chart_data", len(fx_df), lambda: pyramid.chart_data(BENCHMARK_PAIR))
+    return results
+
+
+def compare_results(current, baseline, threshold):
+    """Prints the ratio of every stage to the baseline; returns the number of regressions."""
+    baseline_stages = {(row["scale"], row["stage"]): row for row in baseline["results"]}
+    regressions = 0
+    print(f"\nCompared with {baseline['environment'].get('commit') or 'baseline'} (regression threshold {threshold:.2f}x):")
+    for row in current["results"]:
+        base = baseline_stages.get((row["scale"], row["stage"]))
+        if base is None or not base["seconds_min"]:
+            continue
+        ratio = row["seconds_min"] / base["seconds_min"]
+        flag = "REGRESSION" if ratio > threshold else ""
+        regressions += bool(flag)
+        print(f"  x{row['scale']:<5} {row['stage']:<40} {ratio:>6.2f}x  {flag}")
+    return regressions
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.bench_engine", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scales", type=int, nargs="+", default=DEFAULT_SCALES, help="Row multipliers of the FX, freight and Valo sheets.")
+    parser.add_argument("--workbook", default=DEFAULT_WORKBOOK_PATH, help="Workbook the synthetic copies are generated from.")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file the results are written to.")
+    parser.add_argument("--compare", default=None, help="Earlier results file to compare against.")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD, help="Slowdown ratio reported as a regression.")
+    parser.add_argument("--repeats", type=int, default=DEFAULT_REPEATS, help="Timed runs per stage (cold loads run once).")
+    parser.add_argument("--workdir", default=".benchmark_cache", help="Directory for the generated workbooks and snapshot caches.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data.")
+    parser.add_argument("--regenerate", action="store_true", help="Regenerate the synthetic workbooks even if they exist.")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    # Date format inference and openpyxl's unsupported-extension notices repeat on every timed run
+    warnings.filterwarnings("ignore", category=UserWarning)
+    workdir = os.path.abspath(args.workdir)
+    os.makedirs(workdir, exist_ok=True)
+
+    report = {
+        "format_version": BENCHMARK_FORMAT_VERSION,
+        "environment": environment_info(),
+        "settings": {
+            "repeats": args.repeats, "single_call_loops": SINGLE_CALL_LOOPS, "batch_rows": BATCH_ROWS,
+            "grid_size": GRID_SIZE, "synthetic_version": SYNTHETIC_VERSION, "seed": args.seed,
+            "scaled_sheets": list(SCALED_SHEET_COLUMNS), "unscaled_sheets": UNSCALED_SHEETS,
+        },
+        "results": [],
+    }
+    for scale in args.scales:
+        print(f"Scale x{scale}:")
+        workbook_path = synthetic_workbook_path(workdir, args.workbook, scale, args.seed, regenerate=args.regenerate)
+        report["results"] += benchmark_scale(workbook_path, scale, args.repeats, os.path.join(workdir, f"run_x{scale}"))
+        # Write after every scale so a long run still leaves usable results if interrupted
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+    print(f"\nWrote {len(report['results'])} results to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare_results(report, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,177 @@
+"""
+Load test of the HTTP pricing service (trade_engine.service).
+
+    python -m benchmarks.bench_service --connections 64 --seconds 10
+    python -m benchmarks.bench_service --url http://127.0.0.1:8765 --endpoints /fx
+
+Starts the service on the workbook in a subprocess (unless --url points at a running one), then
+for every endpoint keeps --connections keep-alive connections busy for --seconds, each sending
+one single-row request after the other. Reports the requests per second and the client-side
+p50/p99 latency, next to the service's own /metrics (latency inside the service and mean
+micro-batch size). Client and service share the machine's cores, so on a small machine the
+throughput is a lower bound.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import socket
+import subprocess
+import sys
+import time
+import urllib.parse
+import urllib.request
+
+import numpy as np
+
+from trade_engine.batch import build_pricing_context
+from trade_engine.service import SERVICE_ENDPOINTS
+from trade_engine.workbook import DEFAULT_WORKBOOK_PATH
+
+DEFAULT_CONNECTIONS = 64
+DEFAULT_SECONDS = 5.0
+SERVICE_START_TIMEOUT_SECONDS = 60
+REQUEST_SAMPLES = 1000 # Distinct request bodies per endpoint, cycled through by the clients
+
+
+def request_bodies(workbook_path, rng):
+    """Realistic single-row request bodies per endpoint, drawn from the workbook's reference data."""
+    freight = build_pricing_context(workbook_path, "freight")
+    lanes = freight["freight_index"].lane_table
+    lane_rows = rng.integers(0, len(lanes), REQUEST_SAMPLES)
+    fx_pairs = build_pricing_context(workbook_path, "fx")["fx_curves"].pairs()
+    valo_lookup = build_pricing_context(workbook_path, "valuation")["valo_lookup"]
+    bodies = {
+        "/freight": [
+            {"origin": lanes['RateOrigin'].iloc[row], "destination": lanes['RateDestination'].iloc[row], "quantity_mt": float(rng.uniform(10, 500))}
+            for row in lane_rows
+        ],
+        "/fx": [{"pair": str(pair), "amount": float(rng.uniform(1e3, 1e6))} for pair in rng.choice(fx_pairs, REQUEST_SAMPLES)],
+        "/valuation": [
+            {"buying_diff": float(rng.uniform(valo_lookup.buying_diffs.min(), valo_lookup.buying_diffs.max())), "costing": float(rng.uniform(0, 300))}
+            for _ in range(REQUEST_SAMPLES)
+        ],
+    }
+    return {path: [json.dumps(body).encode() for body in path_bodies] for path, path_bodies in bodies.items()}
+
+
+async def run_client(host, port, path, bodies, offset, deadline, latencies):
+    """One keep-alive connection sending requests back to back until the deadline."""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        position = offset
+        while time.perf_counter() < deadline:
+            body = bodies[position % len(bodies)]
+            position += 1
+            start = time.perf_counter()
+            writer.write(f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+            await writer.drain()
+            status_line = await reader.readline()
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b""):
+                    break
+                name, _, value = line.decode('latin-1').partition(":")
+                if name.strip().lower() == "content-length":
+                    length = int(value)
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - start)
+            if not status_line.startswith(b"HTTP/1.1 200"):
+                raise RuntimeError(f"{path} answered {status_line.decode().strip()}")
+    finally:
+        writer.close()
+
+
+async def load_endpoint(host, port, path, bodies, connections, seconds):
+    latencies = []
+    deadline = time.perf_counter() + seconds
+    start = time.perf_counter()
+    await asyncio.gather(*(run_client(host, port, path, bodies, client * 7, deadline, latencies) for client in range(connections)))
+    elapsed = time.perf_counter() - start
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "endpoint": path,
+        "requests": len(latencies),
+        "requests_per_second": len(latencies) / elapsed,
+        "client_p50_ms": float(np.percentile(latencies_ms, 50)),
+        "client_p99_ms": float(np.percentile(latencies_ms, 99)),
+    }
+
+
+def get_json(url):
+    with urllib.request.urlopen(url, timeout=5) as response:
+        return json.load(response)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_service(workbook_path, port, extra_args):
+    """Starts `python -m trade_engine serve` and waits until /health answers."""
+    process = subprocess.Popen([sys.executable, "-m", "trade_engine", "serve", "--workbook", workbook_path, "--port", str(port), *extra_args])
+    deadline = time.time() + SERVICE_START_TIMEOUT_SECONDS
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The service exited with code {process.returncode}.")
+        try:
+            get_json(f"http://127.0.0.1:{port}/health")
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("The service did not start in time.")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.bench_service", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workbook", default=DEFAULT_WORKBOOK_PATH, help="Workbook the service and the request bodies use.")
+    parser.add_argument("--url", default=None, help="Running service to load; by default one is started on a free port.")
+    parser.add_argument("--endpoints", nargs="+", default=list(SERVICE_ENDPOINTS), choices=list(SERVICE_ENDPOINTS), help="Endpoints to load, one after the other.")
+    parser.add_argument("--connections", type=int, default=DEFAULT_CONNECTIONS, help="Concurrent keep-alive connections.")
+    parser.add_argument("--seconds", type=float, default=DEFAULT_SECONDS, help="Load duration per endpoint.")
+    parser.add_argument("--batch-window-ms", default=None, help="Passed to the started service.")
+    parser.add_argument("--output", default=None, help="JSON file the results are written to.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the request bodies.")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    bodies = request_bodies(args.workbook, np.random.default_rng(args.seed))
+
+    process = None
+    if args.url:
+        url = urllib.parse.urlsplit(args.url)
+        host, port = url.hostname, url.port
+    else:
+        host, port = "127.0.0.1", free_port()
+        process = start_service(args.workbook, port, ["--batch-window-ms", args.batch_window_ms] if args.batch_window_ms else [])
+    try:
+        results = []
+        for path in args.endpoints:
+            result = asyncio.run(load_endpoint(host, port, path, bodies[path], args.connections, args.seconds))
+            results.append(result)
+            print(f"  {path:<12} {result['requests_per_second']:>9,.0f} req/s  p50 {result['client_p50_ms']:>7.2f} ms  p99 {result['client_p99_ms']:>7.2f} ms (client)")
+        metrics = get_json(f"http://{host}:{port}/metrics")
+        for path, endpoint_metrics in metrics["endpoints"].items():
+            print(f"  {path:<12} p50 {endpoint_metrics['p50_ms']:>7.2f} ms  p99 {endpoint_metrics['p99_ms']:>7.2f} ms (service)  "
+                  f"mean batch {endpoint_metrics['mean_batch_rows'] or 0:,.1f} rows")
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"connections": args.connections, "seconds": args.seconds, "results": results, "service_metrics": metrics}, f, indent=1)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
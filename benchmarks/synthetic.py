@@ -0,0 +1,125 @@
+"""
+Synthetic, scaled copies of the Cocoa Trading Sheet for benchmarking.
+
+The FX (Market & FX Fix / Live), freight and Valo sheets are scaled by replicating their rows:
+    FX: every dated fixing gets scale - 1 intraday neighbours with a slightly perturbed rate,
+        so a pair's history becomes scale times denser
+    Freight: replicas get a numbered carrier (e.g. 'ARKAS 7'), so every lane stays unique
+    Valo: replicas get slightly shifted buying diffs
+Costing Beans and Costing Products keep their size. Only the six sheets the engine reads are
+written, and the scaled sheets keep just their leading columns (the ones the process_* functions
+use), since writing every column of a million-row sheet with openpyxl would take far longer than
+the benchmark itself. Scaled sheets are capped at Excel's row limit.
+"""
+
+import datetime
+
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook
+
+from trade_engine.workbook import (
+    SHEET_NAME_BEANS,
+    SHEET_NAME_FREIGHT,
+    SHEET_NAME_FX_FIX,
+    SHEET_NAME_FX_LIVE,
+    SHEET_NAME_PRODUCTS,
+    SHEET_NAME_VALO,
+    load_excel_data,
+)
+
+SYNTHETIC_VERSION = 1 # Bump whenever the generated content changes so cached workbooks are rebuilt
+EXCEL_MAX_DATA_ROWS = 1_048_576 - 1 # Excel's row limit minus the header row
+
+# Scaled sheets: name -> number of leading columns written (None keeps every column)
+SCALED_SHEET_COLUMNS = {
+    SHEET_NAME_FX_FIX: 8,
+    SHEET_NAME_FX_LIVE: 8,
+    SHEET_NAME_FREIGHT: 7,
+    SHEET_NAME_VALO: None,
+}
+UNSCALED_SHEETS = [SHEET_NAME_BEANS, SHEET_NAME_PRODUCTS]
+
+
+def scaled_row_count(rows, scale):
+    return min(rows * scale, EXCEL_MAX_DATA_ROWS)
+
+
+def replicate_rows(df, scale):
+    """Returns (df repeated to scaled_row_count rows, replica number of every row; 0 = original row)."""
+    target_rows = scaled_row_count(len(df), scale)
+    positions = np.arange(target_rows) % len(df)
+    return df.iloc[positions].reset_index(drop=True), np.arange(target_rows) // len(df)
+
+
+def scale_fx_sheet(df, scale, rng):
+    scaled, replica = replicate_rows(df, scale)
+    deliveries = scaled['Delivery']
+    is_fixing_date = deliveries.map(lambda value: isinstance(value, datetime.datetime)).to_numpy(dtype=bool)
+    # Replicas of a daily fixing are spread evenly over the following day
+    offsets = pd.to_timedelta(replica * (86_400 / scale), unit='s')
+    shifted = pd.Series(pd.to_datetime(deliveries.where(is_fixing_date), errors='coerce')) + offsets
+    scaled['Delivery'] = deliveries.where(~is_fixing_date, shifted.astype(object))
+
+    last = pd.to_numeric(scaled['Last'], errors='coerce').to_numpy(dtype='float64')
+    noise = np.exp(rng.normal(0.0, 1e-4, len(scaled)) * (replica > 0))
+    scaled['Last'] = scaled['Last'].where(np.isnan(last), last * noise)
+    return scaled
+
+
+def scale_freight_sheet(df, scale, rng):
+    scaled, replica = replicate_rows(df, scale)
+    carrier = scaled.columns[0]
+    scaled[carrier] = scaled[carrier].where(
+        scaled[carrier].isna() | (replica == 0),
+        scaled[carrier].astype(str) + " " + replica.astype(str),
+    )
+    cost = scaled.columns[5]
+    costs = pd.to_numeric(scaled[cost], errors='coerce').to_numpy(dtype='float64')
+    scaled[cost] = scaled[cost].where(np.isnan(costs), np.round(costs * rng.uniform(0.95, 1.05, len(scaled)) ** (replica > 0), 2))
+    return scaled
+
+
+def scale_valo_sheet(df, scale, rng):
+    scaled, replica = replicate_rows(df, scale)
+    buying_diffs = pd.to_numeric(scaled['Buying Diff'], errors='coerce').to_numpy(dtype='float64')
+    scaled['Buying Diff'] = scaled['Buying Diff'].where(np.isnan(buying_diffs), buying_diffs + replica * 1e-3)
+    return scaled
+
+
+SHEET_SCALERS = {
+    SHEET_NAME_FX_FIX: scale_fx_sheet,
+    SHEET_NAME_FX_LIVE: scale_fx_sheet,
+    SHEET_NAME_FREIGHT: scale_freight_sheet,
+    SHEET_NAME_VALO: scale_valo_sheet,
+}
+
+
+def write_frames_to_xlsx(frames, path):
+    """Writes DataFrames as sheets (header row plus values, no styles) with openpyxl's streaming writer."""
+    workbook = Workbook(write_only=True)
+    for sheet_name, df in frames.items():
+        worksheet = workbook.create_sheet(sheet_name)
+        # 'Unnamed: n' labels come from empty header cells and are written back as empty cells
+        worksheet.append([None if str(col).startswith("Unnamed:") else col for col in df.columns])
+        values = df.astype(object).where(df.notna(), None)
+        for row in values.itertuples(index=False, name=None):
+            worksheet.append(row)
+    workbook.save(path)
+
+
+def write_synthetic_workbook(base_path, output_path, scale, seed=0):
+    """
+    Writes a copy of the engine's sheets of base_path with the FX, freight and Valo sheets scaled
+    by the given factor. Returns {sheet_name: data rows written}.
+    """
+    rng = np.random.default_rng(seed)
+    base_frames = load_excel_data(base_path, list(SCALED_SHEET_COLUMNS) + UNSCALED_SHEETS)
+    frames = {}
+    for sheet_name, df in base_frames.items():
+        if sheet_name in SHEET_SCALERS and not df.empty:
+            column_count = SCALED_SHEET_COLUMNS[sheet_name]
+            df = SHEET_SCALERS[sheet_name](df.iloc[:, :column_count] if column_count else df, scale, rng)
+        frames[sheet_name] = df
+    write_frames_to_xlsx(frames, output_path)
+    return {sheet_name: len(df) for sheet_name, df in frames.items()}
@@ -1,429 +1,326 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import altair as alt # Import Altair
+import contextlib
+import functools
+import io
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from trade_engine.blotter import DealBlotter
+from trade_engine.formulas import WorkbookFormulaEngine
+from trade_engine.freight import FREIGHT_LEG_COLUMNS, FreightRateIndex, calculate_freight_cost, calculate_freight_costs_batch
+from trade_engine.fx import (
+    FX_CASH_FLOW_COLUMNS,
+    FX_TRIANGULATION_CURRENCIES,
+    FxChartPyramid,
+    FxCurveStore,
+    convert_currency_bulk,
+    live_start_rates,
+    perform_currency_conversion,
+    perform_live_conversion,
+)
+from trade_engine.hedging import HEDGE_BUCKET_FREQUENCIES, HEDGE_DEFAULT_ANNUAL_VOL, HEDGE_DEFAULT_SETTINGS, HEDGE_EXPOSURE_COLUMNS, HEDGE_OBJECTIVES, optimize_fx_hedges
+from trade_engine.instrumentation import (
+    STAGE_RECORD_COLUMNS,
+    StageRecorder,
+    activate_recorder,
+    active_recorder,
+    stage,
+    stage_records_to_json_lines,
+)
+from trade_engine.live_rates import FileRateFeed, LiveRatePoller, SimulatedRateFeed
+from trade_engine.processing import SHEET_PROCESSORS
+from trade_engine.products import (
+    COST_STACK_CATEGORIES,
+    PRODUCT_COLUMNS,
+    calculate_costing_products,
+    sheet_fixed_price,
+    sheet_port_pair,
+)
+from trade_engine.risk import RISK_FX_PAIR, RISK_PARALLEL_MIN_PATHS, calculate_margin_at_risk
+from trade_engine.sensitivities import SENSITIVITY_BOOK_COLUMNS, SENSITIVITY_DEFAULT_SETTINGS, calculate_sensitivities
+from trade_engine.valuation import ValuationLookup, calculate_valuation, calculate_valuation_grid
+from trade_engine.what_if import WHAT_IF_COLUMNS, calculate_what_if
+from trade_engine.workbook import (
+    DEFAULT_WORKBOOK_PATH,
+    RAW_PREVIEW_SHEETS,
+    SHEET_NAME_BEANS,
+    SHEET_NAME_FREIGHT,
+    SHEET_NAME_FX_FIX,
+    SHEET_NAME_FX_LIVE,
+    SHEET_NAME_PRODUCTS,
+    SHEET_NAME_VALO,
+    WorkbookStore,
+    read_sheet_rows,
+    sheet_catalog,
+)
 
 st.set_page_config(layout="wide") # Set wide layout for better use of space
 
 st.title("Cocoa Trading Sheet Automation")
 st.write("Automate cocoa trading processes and calculations from the Excel sheet.")
 
-# Define the file path and relevant sheet names
-FILE_PATH = "Cocoa Trading Sheet.xlsx"
-SHEET_NAME_BEANS = "Costing Beans"
-SHEET_NAME_PRODUCTS = "Costing Products"
-SHEET_NAME_FREIGHT = "Freight & Dressing"
-SHEET_NAME_VALO = "Valo Ori & Dest"
-SHEET_NAME_FX_FIX = "Market & FX Fix"
-SHEET_NAME_FX_LIVE = "Market & FX Live"
-# Add other sheet names as needed based on full Excel analysis
-
-@st.cache_data # Cache the data loading for performance
-def load_excel_data(file_path, sheet_names):
-    """Loads specified sheets from an Excel file into a dictionary of Dataframes."""
-    dataframes = {}
-    for sheet_name in sheet_names:
-        try:
-            # Use header=0, assuming the first row contains headers
-            df = pd.read_excel(file_path, sheet_name=sheet_name, header=0)
-
-            # No longer converting first column to string here as we are using header=0
-
-            dataframes[sheet_name] = df
-            st.sidebar.success(f"Successfully loaded sheet: '{sheet_name}'")
-        except FileNotFoundError:
-            st.sidebar.error(f"Error: File not found at {file_path}")
-            dataframes[sheet_name] = pd.DataFrame() # Return empty DataFrame on error
-            break # Stop loading other sheets if file is not found
-        except Exception as e:
-            st.sidebar.error(f"Error loading sheet '{sheet_name}': {e}")
-            dataframes[sheet_name] = pd.DataFrame() # Return empty DataFrame on error
-    return dataframes
-
-@st.cache_data # Cache data processing results
-def process_costing_beans(df_beans):
-    """Processes the 'Costing Beans' DataFrame."""
-    df_processed = pd.DataFrame()
-    if not df_beans.empty:
-        try:
-            # Use the actual column names loaded with header=0
-            # Identify relevant columns based on expected names
-            relevant_cols = ['FX', 'VALUE DATE', 'FX RATE', 'Unnamed: 4']
-            cols_to_select = [col for col in relevant_cols if col in df_beans.columns]
-
-            if cols_to_select:
-                df_processed = df_beans[cols_to_select].copy()
-                # Explicitly convert columns to handle mixed types and ensure correct dtypes
-                if 'FX' in df_processed.columns:
-                    df_processed['FX'] = df_processed['FX'].astype(str)
-                if 'VALUE DATE' in df_processed.columns:
-                    df_processed['VALUE DATE'] = pd.to_datetime(df_processed['VALUE DATE'], errors='coerce')
-                if 'FX RATE' in df_processed.columns:
-                    df_processed['FX RATE'] = pd.to_numeric(df_processed['FX RATE'], errors='coerce')
-                if 'Unnamed: 4' in df_processed.columns:
-                    df_processed['Unnamed: 4'] = pd.to_numeric(df_processed['Unnamed: 4'], errors='coerce')
-
-                subset_cols = [col for col in ['VALUE DATE', 'FX', 'FX RATE', 'Unnamed: 4'] if col in df_processed.columns]
-                # Only dropna if the columns actually exist in the dataframe
-                if subset_cols and not df_processed[subset_cols].empty:
-                     df_processed.dropna(subset=subset_cols, inplace=True)
-                elif subset_cols: # If columns exist but are empty after selection
-                     df_processed = pd.DataFrame(columns=df_processed.columns) # Return empty with correct columns
-                else: # If no relevant columns were found at all
-                     df_processed = pd.DataFrame() # Return empty DataFrame
-
-
-            else:
-                st.warning("Required columns for processing 'Costing Beans' not found.")
-                df_processed = pd.DataFrame() # Return empty DataFrame if key columns are missing
-
-        except Exception as e:
-            st.error(f"Error processing 'Costing Beans' sheet: {e}")
-            df_processed = pd.DataFrame() # Return empty DataFrame on error
-    return df_processed
-
-@st.cache_data # Cache data processing results
-def process_fx_data(df_fx):
-    """Processes FX related DataFrames (Market & FX Fix/Live)."""
-    df_processed = pd.DataFrame()
-    if not df_fx.empty:
-        try:
-            # Use the actual column names loaded with header=0
-            # Identify relevant columns based on expected names
-            relevant_cols = ['Quote Table', 'Delivery', 'Last'] # Assuming these map to FX, VALUE DATE, FX RATE after header=0
-            cols_to_select = [col for col in relevant_cols if col in df_fx.columns]
-
-            if cols_to_select:
-                df_processed = df_fx[cols_to_select].copy()
-                # Rename columns to consistent names
-                rename_map = {'Quote Table': 'FX', 'Delivery': 'VALUE DATE', 'Last': 'FX RATE'}
-                df_processed.rename(columns=rename_map, inplace=True)
-
-                # Explicitly convert columns to handle mixed types and ensure correct dtypes
-                if 'FX' in df_processed.columns:
-                    df_processed['FX'] = df_processed['FX'].astype(str)
-                if 'VALUE DATE' in df_processed.columns:
-                    df_processed['VALUE DATE'] = pd.to_datetime(df_processed['VALUE DATE'], errors='coerce')
-                if 'FX RATE' in df_processed.columns:
-                    df_processed['FX RATE'] = pd.to_numeric(df_processed['FX RATE'], errors='coerce')
-
-                subset_cols = [col for col in ['VALUE DATE', 'FX', 'FX RATE'] if col in df_processed.columns]
-                # Only dropna if the columns actually exist in the dataframe
-                if subset_cols and not df_processed[subset_cols].empty:
-                    df_processed.dropna(subset=subset_cols, inplace=True)
-                elif subset_cols: # If columns exist but are empty after selection
-                    df_processed = pd.DataFrame(columns=df_processed.columns) # Return empty with correct columns
-                else: # If no relevant columns were found at all
-                    df_processed = pd.DataFrame() # Return empty DataFrame
-
-            else:
-                st.warning("Required columns for processing FX data not found (assuming 'Quote Table', 'Delivery', 'Last').")
-                df_processed = pd.DataFrame() # Return empty DataFrame if key columns is missing
-        except Exception as e:
-            st.error(f"Error processing FX sheet: {e}")
-            df_processed = pd.DataFrame() # Return empty DataFrame on error
-    return df_processed
-
-
-@st.cache_data # Cache data processing results
-def process_freight_data(df_freight):
-    """Processes the 'Freight & Dressing' DataFrame."""
-    df_processed = pd.DataFrame()
-    if not df_freight.empty:
-        try:
-            # Use the actual column names loaded with header=0
-            # Assuming column names are 'Origin', 'Destination', 'FreightCost' or similar after loading
-            # Need to inspect df_freight.columns after loading with header=0 to confirm
-            # For now, let's try more generic Unnamed columns as column names might not be clean
-            relevant_cols = [df_freight.columns[0], df_freight.columns[1], df_freight.columns[5]] if df_freight.shape[1] > 5 else [] # Assuming first 2 and 6th column based on index
-            if len(relevant_cols) == 3:
-                df_processed = df_freight[relevant_cols].copy()
-
-                # Rename columns for clarity
-                df_processed.columns = ['Origin', 'Destination', 'FreightCost']
-
-                # Explicitly convert columns to handle mixed types and ensure correct dtypes
-                if 'Origin' in df_processed.columns:
-                    df_processed['Origin'] = df_processed['Origin'].astype(str)
-                if 'Destination' in df_processed.columns:
-                    df_processed['Destination'] = df_processed['Destination'].astype(str)
-                if 'FreightCost' in df_processed.columns:
-                    df_processed['FreightCost'] = pd.to_numeric(df_processed['FreightCost'], errors='coerce')
-
-                subset_cols = [col for col in ['Origin', 'Destination', 'FreightCost'] if col in df_processed.columns]
-                # Only dropna if the columns actually exist in the dataframe
-                if subset_cols and not df_processed[subset_cols].empty:
-                     df_processed.dropna(subset=subset_cols, inplace=True)
-                elif subset_cols: # If columns exist but are empty after selection
-                     df_processed = pd.DataFrame(columns=df_processed.columns) # Return empty with correct columns
-                else: # If no relevant columns were found at all
-                     df_processed = pd.DataFrame() # Return empty DataFrame
-
-            else:
-                st.warning("Required columns for processing 'Freight & Dressing' not found (assuming first, second, and sixth columns).")
-                df_processed = pd.DataFrame()
-
-        except Exception as e:
-            st.error(f"Error processing 'Freight & Dressing' sheet: {e}")
-            df_processed = pd.DataFrame()
-    return df_processed
-
-@st.cache_data # Cache data processing results
-def process_costing_products_data(df_products):
-    """Processes the 'Costing Products' DataFrame."""
-    df_processed = pd.DataFrame()
-    if not df_products.empty:
-        try:
-            # Process using actual headers loaded with header=0
-            df_processed = df_products.copy()
-
-            # Attempt more robust type conversion for all columns
-            for col in df_processed.columns:
-                # Try converting to numeric first, then datetime, then fallback to string
-                # Use a more cautious approach for numeric conversion
-                try:
-                    df_processed[col] = pd.to_numeric(df_processed[col], errors='coerce')
-                except:
-                    pass # Ignore error if numeric conversion fails
-
-                # If conversion to numeric resulted in all NaNs, try datetime
-                if df_processed[col].isna().all():
-                    try:
-                        df_processed[col] = pd.to_datetime(df_processed[col], errors='coerce')
-                    except:
-                        pass # Ignore error if datetime conversion fails
-
-                # If still all NaNs (or not numeric/datetime), ensure it's string for display compatibility
-                if df_processed[col].dtype == 'object':
-                     df_processed[col] = df_processed[col].astype(str)
-
-
-            # Add more specific processing here based on actual content and calculations needed
-            # e.g., renaming specific columns based on content inspection if necessary
-
-        except Exception as e:
-            st.error(f"Error processing 'Costing Products' sheet: {e}")
-            df_processed = pd.DataFrame()
-    return df_processed
-
-@st.cache_data # Cache data processing results
-def process_valo_data(df_valo):
-    """Processes the 'Valo Ori & Dest' DataFrame."""
-    df_processed = pd.DataFrame()
-    if not df_valo.empty:
-        try:
-            # Use the actual column names loaded with header=0
-            # Assuming relevant columns are 'Buying Diff', 'Costings', 'Break Even', 'Selling Diff', 'Margin'
-            relevant_cols = ['Buying Diff', 'Costings', 'Break Even', 'Selling Diff', 'Margin']
-            cols_to_select = [col for col in relevant_cols if col in df_valo.columns]
-
-            if cols_to_select:
-                 df_processed = df_valo[cols_to_select].copy()
-
-                 # Explicitly convert relevant calculation columns to numeric
-                 calc_cols = ['Buying Diff', 'Costings', 'Break Even', 'Selling Diff', 'Margin']
-                 for col in calc_cols:
-                     if col in df_processed.columns:
-                         df_processed[col] = pd.to_numeric(df_processed[col], errors='coerce')
-
-                 # Drop rows where key calculation results are NaN (e.g., Break Even or Margin)
-                 subset_cols_dropna = [col for col in ['Break Even', 'Margin'] if col in df_processed.columns]
-                 if subset_cols_dropna and not df_processed[subset_cols_dropna].empty:
-                      df_processed.dropna(subset=subset_cols_dropna, inplace=True)
-                 elif subset_cols_dropna: # If columns exist but are empty after selection
-                      df_processed = pd.DataFrame(columns=df_processed.columns)
-                 else: # If no relevant columns were found at all
-                      df_processed = pd.DataFrame()
-
-
-            else:
-                st.warning("Required columns for processing 'Valo Ori & Dest' not found.")
-                df_processed = pd.DataFrame()
-
-        except Exception as e:
-            st.error(f"Error processing 'Valo Ori & Dest' sheet: {e}")
-            df_processed = pd.DataFrame()
-    return df_processed
-
-
-# Load all necessary sheets
-sheet_names_to_load = [SHEET_NAME_BEANS, SHEET_NAME_PRODUCTS, SHEET_NAME_FREIGHT, SHEET_NAME_VALO, SHEET_NAME_FX_FIX, SHEET_NAME_FX_LIVE]
-excel_data = load_excel_data(FILE_PATH, sheet_names_to_load)
-
-# Get DataFrames from loaded data (handle potential missing sheets)
-df_beans_raw = excel_data.get(SHEET_NAME_BEANS, pd.DataFrame())
-df_freight_raw = excel_data.get(SHEET_NAME_FREIGHT, pd.DataFrame())
-df_valo_raw = excel_data.get(SHEET_NAME_VALO, pd.DataFrame())
-df_costing_products_raw = excel_data.get(SHEET_NAME_PRODUCTS, pd.DataFrame())
-df_fx_fix_raw = excel_data.get(SHEET_NAME_FX_FIX, pd.DataFrame())
-df_fx_live_raw = excel_data.get(SHEET_NAME_FX_LIVE, pd.DataFrame())
-
-# Process the loaded DataFrames
-df_processed_beans = process_costing_beans(df_beans_raw)
-df_processed_freight = process_freight_data(df_freight_raw)
-df_processed_fx_fix = process_fx_data(df_fx_fix_raw)
-df_processed_fx_live = process_fx_data(df_fx_live_raw) # Process live data similarly for now
-df_processed_costing_products = process_costing_products_data(df_costing_products_raw) # Process products data
-df_processed_valo = process_valo_data(df_valo_raw) # Process valo data
-
-
-# --- Calculation Functions ---
-def calculate_freight_cost(freight_df, origin, destination, quantity_mt):
-    """
-    Calculates the total freight cost for a given origin, destination, and quantity.
-    Assumes freight_df has columns 'Origin', 'Destination', and 'FreightCost'.
-    Looks for a matching Origin and Destination and multiplies the corresponding
-    'FreightCost' by the quantity.
-    """
-    if freight_df.empty:
-        return None, "Freight data not available."
-
-    # Filter on case-insensitive exact match for origin and destination
-    # Ensure columns exist before filtering
-    if 'Origin' not in freight_df.columns or 'Destination' not in freight_df.columns or 'FreightCost' not in freight_df.columns:
-         return None, "Required columns for freight calculation not found."
-
-    matching_rows = freight_df[
-        (freight_df['Origin'].astype(str).str.contains(origin, case=False, na=False)) &
-        (freight_df['Destination'].astype(str).str.contains(destination, case=False, na=False))
-    ]
-
-    if matching_rows.empty:
-        return None, f"No freight rate found for {origin} to {destination}."
-
-    # Ensure 'FreightCost' is numeric and drop NaNs
-    freight_rates = pd.to_numeric(matching_rows['FreightCost'], errors='coerce').dropna()
-
-    if freight_rates.empty:
-        return None, "Freight rate found but is not numeric."
-
-    # Use the first valid freight rate found (simplification - could average or handle differently)
-    freight_rate_per_unit = freight_rates.iloc[0]
-
-    total_freight = freight_rate_per_unit * quantity_mt
-
-    return total_freight, f"Calculated using rate {freight_rate_per_unit:.2f} per MT."
-
-
-def perform_currency_conversion(df_fx, selected_fx, value_to_convert):
+# Define the file path (sheet names are defined in trade_engine.workbook)
+FILE_PATH = DEFAULT_WORKBOOK_PATH
+WORKBOOK_POLL_SECONDS = 5 # How often open sessions check the workbook file for changes
+SHARED_RESOURCE_MAX_ENTRIES = 16 # Per-sheet indexes kept in the shared cache: a few sheets x current and previous versions
+LIVE_FEED_FILE = os.environ.get("LIVE_FEED_FILE", "live_rates.csv") # CSV of pair,timestamp,rate ticks; a simulated feed is used when absent
+LIVE_REFRESH_SECONDS = 2 # How often the live rates panel redraws from the shared buffers
+DIAGNOSTICS_HISTORY_RUNS = 20 # Reruns whose stage records the diagnostics tab keeps per session
+BLOTTER_PATH = os.environ.get("DEAL_BLOTTER_PATH", "deal_blotter.sqlite") # SQLite file of the deal blotter, shared by every session
+BLOTTER_RECENT_DEALS = 50 # Deals listed in the blotter tab
+SHEET_PAGE_ROW_OPTIONS = [50, 100, 500, 1000] # Page sizes offered when browsing a sheet
+SHEET_PAGE_CACHE_ENTRIES = 64 # Sheet pages kept in the shared cache, across all sheets and sessions
+SENSITIVITY_CHART_FACTORS = 20 # Largest deltas charted in the sensitivities tab
+SENSITIVITY_LADDER_ROWS = 200 # Ladder rows listed per factor type; the CSV download has all of them
+RISK_POOL_WORKERS = os.cpu_count() or 1 # Worker processes of the margin-at-risk pool
+
+# The engine reports through logging; messages logged while this session loads data are shown in the sidebar
+ENGINE_LOG_RENDERERS = {
+    logging.ERROR: st.sidebar.error,
+    logging.WARNING: st.sidebar.warning,
+    logging.INFO: st.sidebar.success,
+    logging.DEBUG: st.sidebar.caption,
+}
+logging.getLogger("trade_engine").setLevel(logging.DEBUG)
+
+class SessionLogHandler(logging.Handler):
+    """Collects the engine's log records emitted by one thread (Streamlit runs each session's script in its own thread)."""
+
+    def __init__(self):
+        super().__init__(level=logging.DEBUG)
+        self.thread_id = threading.get_ident()
+        self.records = []
+
+    def emit(self, record):
+        if record.thread == self.thread_id:
+            self.records.append(record)
+
+@contextlib.contextmanager
+def show_engine_messages():
+    """Renders the engine messages logged inside the block in the sidebar, by severity."""
+    handler = SessionLogHandler()
+    engine_logger = logging.getLogger("trade_engine")
+    engine_logger.addHandler(handler)
+    try:
+        yield
+    finally:
+        engine_logger.removeHandler(handler)
+        for record in handler.records:
+            render = ENGINE_LOG_RENDERERS.get(record.levelno, st.sidebar.error if record.levelno > logging.ERROR else st.sidebar.caption)
+            render(record.getMessage())
+
+
+# Opt-in diagnostics: while enabled, every instrumented stage of a rerun is recorded for this session
+diagnostics_enabled = st.sidebar.checkbox("Diagnostics (per-stage timings)", key="diagnostics_toggle")
+diagnostics_trace_allocations = diagnostics_enabled and st.sidebar.checkbox(
+    "Trace allocations (slows down the whole app)", key="diagnostics_trace_allocations"
+)
+
+def new_stage_recorder():
+    """Starts the recorder of a new run of this session (a full rerun or a rerun of one fragment)."""
+    st.session_state["diagnostics_rerun"] = st.session_state.get("diagnostics_rerun", 0) + 1
+    return StageRecorder(run_id=st.session_state["diagnostics_rerun"], trace_allocations=diagnostics_trace_allocations)
+
+def record_diagnostics_run(recorder, scope):
+    """Stops recording and keeps the run in the session's diagnostics history. Returns the run's wall time."""
+    activate_recorder(None)
+    recorder.close()
+    run_seconds = time.perf_counter() - recorder.started_at
+    diagnostics_history = st.session_state.setdefault("diagnostics_history", [])
+    diagnostics_history.append({"run": recorder.run_id, "scope": scope, "seconds": run_seconds, "records": recorder.records})
+    del diagnostics_history[:-DIAGNOSTICS_HISTORY_RUNS]
+    return run_seconds
+
+stage_recorder = new_stage_recorder() if diagnostics_enabled else None
+activate_recorder(stage_recorder) # Also clears a recorder left active by an interrupted rerun
+
+@st.cache_resource # One store per server process, shared by every session
+def get_workbook_store(file_path):
+    return WorkbookStore(file_path, SHEET_PROCESSORS, RAW_PREVIEW_SHEETS)
+
+workbook_store = get_workbook_store(FILE_PATH)
+try:
+    with show_engine_messages():
+        reloaded_sheets = workbook_store.refresh()
+    if reloaded_sheets and workbook_store.version > 1:
+        st.sidebar.info(f"Workbook changed on disk, reloaded: {', '.join(reloaded_sheets)}")
+except FileNotFoundError:
+    st.sidebar.error(f"Error: File not found at {FILE_PATH}")
+st.session_state["workbook_version"] = workbook_store.version
+st.sidebar.caption(f"Shared reference data: {workbook_store.memory_bytes() / 1e6:.1f} MB (one copy for all sessions)")
+workbook_frames = workbook_store.sheet_frames # Fixed reference for this rerun, even if another session refreshes
+
+@st.fragment(run_every=WORKBOOK_POLL_SECONDS)
+def watch_workbook():
+    """Polls the workbook file and reruns the app when it was saved again or another session reloaded it."""
+    if workbook_store.has_file_changed() or st.session_state.get("workbook_version") != workbook_store.version:
+        st.rerun()
+    st.caption(f"Watching '{FILE_PATH}' for changes (data version {workbook_store.version})")
+
+with st.sidebar:
+    watch_workbook()
+
+def get_sheet_frame(sheet_name, frame_name):
     """
-    Performs currency conversion using the latest FX rate for the selected pair.
-    Assumes df_fx has columns 'FX', 'VALUE DATE', and 'FX RATE'.
+    Returns a view of one frame of a loaded sheet, or an empty DataFrame if the sheet could not be loaded.
+    The view shares the store's data (no copy). This relies on pandas >= 3 (pinned in requirements.txt),
+    where copy-on-write is always on: anything a session modifies on the view is copied for that
+    session only and the shared frame stays unchanged.
     """
-    if df_fx.empty:
-        return None, None, None, "FX data not available."
-
-    # Ensure required columns exist
-    if 'FX' not in df_fx.columns or 'VALUE DATE' not in df_fx.columns or 'FX RATE' not in df_fx.columns:
-        return None, None, None, "Required columns for FX conversion not found."
-
-    filtered_fx = df_fx[df_fx['FX'] == selected_fx].copy()
-
-    if filtered_fx.empty:
-        return None, None, None, f"No data available for the selected FX pair '{selected_fx}'."
-
-    # Ensure 'VALUE DATE' is datetime and 'FX RATE' is numeric before sorting/calculation
-    filtered_fx['VALUE DATE'] = pd.to_datetime(filtered_fx['VALUE DATE'], errors='coerce')
-    filtered_fx['FX RATE'] = pd.to_numeric(filtered_fx['FX RATE'], errors='coerce')
-    filtered_fx.dropna(subset=['VALUE DATE', 'FX RATE'], inplace=True) # Drop rows missing key info
-
-    if filtered_fx.empty:
-         return None, None, None, f"No valid date or FX rate data for the selected FX pair '{selected_fx}'."
+    frame = workbook_frames.get(sheet_name, {}).get(frame_name)
+    return frame.copy(deep=False) if frame is not None else pd.DataFrame()
+
+# Get raw DataFrames used for previews (handle potential missing sheets)
+df_fx_live_raw = get_sheet_frame(SHEET_NAME_FX_LIVE, "raw")
+
+# Processed DataFrames
+df_processed_beans = get_sheet_frame(SHEET_NAME_BEANS, "processed")
+df_processed_freight = get_sheet_frame(SHEET_NAME_FREIGHT, "processed")
+df_processed_fx_fix = get_sheet_frame(SHEET_NAME_FX_FIX, "processed")
+df_processed_fx_live = get_sheet_frame(SHEET_NAME_FX_LIVE, "processed")
+df_processed_costing_products = get_sheet_frame(SHEET_NAME_PRODUCTS, "processed")
+df_processed_valo = get_sheet_frame(SHEET_NAME_VALO, "processed")
+
+
+# --- Shared calculation resources ---
+@st.cache_resource(max_entries=SHARED_RESOURCE_MAX_ENTRIES) # Built once per version of the freight sheet and shared by every session
+def get_freight_rate_index(_freight_df, sheet_fingerprint):
+    """Returns the FreightRateIndex of the processed freight frame; only the fingerprint is hashed."""
+    return FreightRateIndex(_freight_df)
+
+@st.cache_resource(max_entries=SHARED_RESOURCE_MAX_ENTRIES) # Built once per version of the source sheet and shared by every session
+def get_fx_curve_store(_fx_df, sheet_fingerprint):
+    """Returns the FxCurveStore of a processed FX frame; only the fingerprint is hashed."""
+    return FxCurveStore(_fx_df)
+
+@st.cache_resource(max_entries=SHARED_RESOURCE_MAX_ENTRIES) # Built once per version of the source sheet and shared by every session
+def get_fx_chart_pyramid(_curve_store, sheet_fingerprint):
+    """Returns the FxChartPyramid of an FxCurveStore; pairs are aggregated on first use."""
+    return FxChartPyramid(_curve_store)
+
+@st.cache_resource # One poller thread per server process; every session reads the same buffers
+def get_live_rate_poller(feed_file, _start_rates):
+    """Starts the live rate poller on the tick file if it exists, else on a simulated feed from _start_rates."""
+    feed = FileRateFeed(feed_file) if os.path.exists(feed_file) else SimulatedRateFeed(_start_rates)
+    return LiveRatePoller(feed).start()
+
+@st.cache_resource(max_entries=SHARED_RESOURCE_MAX_ENTRIES) # Built once per version of the Valo sheet and shared by every session
+def get_valuation_lookup(_valo_df, sheet_fingerprint):
+    """Returns the ValuationLookup of the processed Valo frame; only the fingerprint is hashed."""
+    return ValuationLookup(_valo_df)
+
+@st.cache_resource # One pool per server process, shared by every session
+def get_risk_process_pool():
+    # Spawned workers only import the trade_engine package, never this Streamlit script
+    return ProcessPoolExecutor(max_workers=RISK_POOL_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+@st.cache_resource(max_entries=SHARED_RESOURCE_MAX_ENTRIES) # Compiled once per workbook content and shared by every session
+def get_formula_engine(file_path, workbook_hash):
+    return WorkbookFormulaEngine.from_xlsx(file_path)
+
+@st.cache_resource # One blotter per server process; SQLite serializes the writes of all sessions
+def get_deal_blotter(blotter_path):
+    return DealBlotter(blotter_path)
+
+@st.cache_resource(max_entries=SHARED_RESOURCE_MAX_ENTRIES) # Read once per workbook content and shared by every session
+def get_sheet_catalog(file_path, workbook_hash):
+    return sheet_catalog(file_path)
+
+@st.cache_resource(max_entries=SHEET_PAGE_CACHE_ENTRIES) # Each page is read on first access and shared by every session
+def get_sheet_page(file_path, workbook_hash, sheet_name, first_row, row_count):
+    return read_sheet_rows(file_path, sheet_name, first_row, row_count)
+
+@st.cache_resource(max_entries=SHARED_RESOURCE_MAX_ENTRIES) # Rendered once per version of the sheet and shared by every session
+def get_sheet_info_text(_df, sheet_fingerprint):
+    """Returns DataFrame.info() of a sheet as text; info() itself prints to stdout and returns None."""
+    buffer = io.StringIO()
+    _df.info(buf=buffer)
+    return buffer.getvalue()
 
 
-    latest_fx_row = filtered_fx.sort_values(by='VALUE DATE', ascending=False).iloc[0]
-    conversion_fx_rate = latest_fx_row['FX RATE']
-    conversion_date = latest_fx_row['VALUE DATE'].date()
-
-    # Ensure value_to_convert is numeric
-    try:
-        value_to_convert_numeric = float(value_to_convert)
-    except (ValueError, TypeError):
-        return None, None, None, "Invalid value to convert."
-
-
-    converted_value = value_to_convert_numeric * conversion_fx_rate
-
-    return converted_value, conversion_fx_rate, conversion_date, "Conversion successful."
+# --- Streamlit UI Layout ---
 
+st.sidebar.header("Settings and Inputs")
+blotter_trader = st.sidebar.text_input("Trader (recorded with booked deals)", key="blotter_trader").strip()
+deal_blotter = get_deal_blotter(BLOTTER_PATH)
 
-def calculate_valuation(valo_df, buying_diff, costing):
+# Using tabs for different sections
+tab_titles = ["FX Rates & Conversion", "Freight Calculation", "Costing Beans Data", "Valuation", "Costing Products", "Margin at Risk", "Other Sheets Info", "Deal Blotter", "FX Hedging", "Sensitivities"]
+if diagnostics_enabled:
+    tab_titles.append("Diagnostics")
+# Lazy tabs (st.tabs key/on_change and tab.open need streamlit >= 1.55): switching tabs reruns the app and only the selected tab runs its code
+tabs = st.tabs(tab_titles, key="active_tab", on_change="rerun")
+
+def render_if_open(tab, render_tab):
+    """Runs a tab's code only while it is the selected tab; hidden tabs stay empty until selected."""
+    with tab:
+        if tab.open:
+            render_tab()
+
+def tab_fragment(render_tab):
     """
-    Calculates valuation metrics (Break Even, Margin) based on Valo data.
-    Assumes valo_df has columns 'Buying Diff', 'Costings', 'Break Even', 'Selling Diff', 'Margin'.
-    This is a simplified calculation based on the structure, actual logic might be more complex.
+    Runs a tab as a fragment: a change to one of its widgets reruns only this tab, not the whole
+    app. With diagnostics on, such a fragment rerun is recorded as a run of its own.
     """
-    if valo_df.empty:
-        return None, None, "Valuation data not available."
-
-    # Find relevant row based on Buying Diff and Costings (simplified)
-    # In a real scenario, the lookup would likely be more complex based on contract terms, etc.
-    # Let's find a row where 'Buying Diff' is close and use its 'Selling Diff' for a sample calculation
-
-    # Find the row with the closest 'Buying Diff' to the input (simplified lookup)
-    if 'Buying Diff' not in valo_df.columns or 'Selling Diff' not in valo_df.columns:
-         return None, None, "Required columns for valuation calculation not found ('Buying Diff', 'Selling Diff')."
-
-    # Ensure 'Buying Diff' is numeric
-    valo_df_numeric_buying_diff = valo_df.copy()
-    valo_df_numeric_buying_diff['Buying Diff'] = pd.to_numeric(valo_df_numeric_buying_diff['Buying Diff'], errors='coerce')
-    valo_df_numeric_buying_diff.dropna(subset=['Buying Diff'], inplace=True)
-
-    if valo_df_numeric_buying_diff.empty:
-        return None, None, "Valuation data empty after processing 'Buying Diff'."
-
-    closest_buying_diff_row = valo_df_numeric_buying_diff.iloc[(valo_df_numeric_buying_diff['Buying Diff'] - buying_diff).abs().argsort()[0]]
-
-    # Assuming Break Even = Buying Diff + Costings (simplified)
-    # Assuming Margin = Selling Diff - Break Even (simplified)
-    # We will use the 'Selling Diff' from the closest row found for a sample Margin calculation
-
-    selling_diff_from_sheet = pd.to_numeric(closest_buying_diff_row.get('Selling Diff'), errors='coerce')
-
-    if pd.isna(selling_diff_from_sheet):
-         return None, None, "Selling Diff from sheet is not numeric."
-
-
-    calculated_break_even = buying_diff + costing # Use input costing
-    calculated_margin = selling_diff_from_sheet - calculated_break_even
-
-    return calculated_break_even, calculated_margin, f"Calculated using Selling Diff ({selling_diff_from_sheet:.2f}) from sheet."
-
+    @st.fragment
+    @functools.wraps(render_tab)
+    def render_tab_fragment():
+        if not diagnostics_enabled or active_recorder() is not None:
+            with stage(f"tab[{render_tab.__name__}]"):
+                render_tab()
+            return
+        fragment_recorder = new_stage_recorder()
+        activate_recorder(fragment_recorder)
+        try:
+            with stage(f"tab[{render_tab.__name__}]"):
+                render_tab()
+        finally:
+            record_diagnostics_run(fragment_recorder, render_tab.__name__)
+    return render_tab_fragment
 
-def calculate_costing_products(products_df, input_params):
+def session_memo(name, inputs, compute):
     """
-    Placeholder function to calculate costing for products.
-    Replace with actual logic based on 'Costing Products' sheet.
-    input_params would be a dictionary of user inputs related to product costing.
+    Input-keyed memoization for this session: returns the result of the last compute() under this
+    name while its inputs and the workbook version are unchanged, otherwise calls compute() again.
+    Only the latest result is kept per name.
     """
-    if products_df.empty:
-        return None, "Costing Products data not available.", products_df.head() # Return empty head
-
-    # --- Placeholder Logic ---
-    # This is where you would implement the actual calculations from the 'Costing Products' sheet.
-    # This might involve:
-    # - Looking up product-specific costs based on product type, origin, etc.
-    # - Applying processing costs, packaging costs, etc.
-    # - Using FX rates to convert costs to a base currency.
-    # - Summing up various cost components to get a total product cost.
-    # - Calculating margins or profitability for products.
-
-    # For now, just return a placeholder message and the processed data head
-    calculated_cost = None # Replace with actual calculated cost
-    message = "Costing Products calculation logic needs to be implemented based on the sheet's formulas."
-
-    return calculated_cost, message, products_df.head() # Return processed data head for inspection
-
-
-# --- Streamlit UI Layout ---
+    memo = st.session_state.setdefault("session_memo", {})
+    memo_key = (workbook_store.version, inputs)
+    if name in memo and memo[name][0] == memo_key:
+        return memo[name][1]
+    result = compute()
+    memo[name] = (memo_key, result)
+    return result
+
+def read_uploaded_csv(uploaded_file, name):
+    """Parses an uploaded CSV once per upload. Returns (DataFrame, None) or (None, error message)."""
+    def parse_csv():
+        try:
+            return pd.read_csv(uploaded_file), None
+        except Exception as e:
+            return None, f"Could not read the uploaded CSV: {e}"
+    return session_memo(name, uploaded_file.file_id, parse_csv)
 
-st.sidebar.header("Settings and Inputs")
+def show_chart(chart, chart_name, rows):
+    """Renders an Altair chart; the chart spec and its data are serialized here, so this is the chart's cost on the server."""
+    with stage(f"chart[{chart_name}]", rows_in=rows):
+        st.altair_chart(chart, use_container_width=True)
 
-# Using tabs for different sections
-tab_titles = ["FX Rates & Conversion", "Freight Calculation", "Costing Beans Data", "Valuation", "Costing Products", "Other Sheets Info"]
-tabs = st.tabs(tab_titles)
+def book_deals(record, deals_df, **kwargs):
+    """Records priced deals with one of the DealBlotter.record_* methods under the sidebar's trader."""
+    booked_deals = record(deals_df, trader=blotter_trader or None, **kwargs)
+    st.success(f"Booked {booked_deals} deal(s) in the blotter.")
 
 # --- Tab: FX Rates & Conversion ---
-with tabs[0]:
+@tab_fragment
+def fx_tab():
     st.header("FX Rates & Conversion")
 
     st.subheader("Market & FX Fix Data")
@@ -436,27 +333,47 @@ with tabs[0]:
         st.subheader("Historical FX Rates (Market & FX Fix)")
         # Ensure 'FX' column exists before getting unique values
         if 'FX' in df_processed_fx_fix.columns:
-            fx_pairs_for_chart = df_processed_fx_fix['FX'].unique()
+            fx_fix_curves = get_fx_curve_store(df_processed_fx_fix, workbook_store.fingerprints.get(SHEET_NAME_FX_FIX))
+            fx_chart_pyramid = get_fx_chart_pyramid(fx_fix_curves, workbook_store.fingerprints.get(SHEET_NAME_FX_FIX))
+            fx_pairs_for_chart = fx_fix_curves.pairs()
             selected_fx_for_chart = st.selectbox("Select FX Pair to Visualize", fx_pairs_for_chart, key="fx_chart_selectbox") # Added key
 
-            df_chart_data = df_processed_fx_fix[df_processed_fx_fix['FX'] == selected_fx_for_chart].copy()
+            chart_levels = fx_chart_pyramid.levels(selected_fx_for_chart) if selected_fx_for_chart is not None else []
+            if chart_levels and len(chart_levels[0][1]) > 0:
+                # Visible range: the chart is rebuilt from the pyramid for the selected dates only
+                chart_first_date = chart_levels[0][1][0].astype('datetime64[D]').item()
+                chart_last_date = chart_levels[0][1][-1].astype('datetime64[D]').item()
+                if chart_first_date < chart_last_date:
+                    chart_start, chart_end = st.slider(
+                        "Date range", min_value=chart_first_date, max_value=chart_last_date,
+                        value=(chart_first_date, chart_last_date), key="fx_chart_range"
+                    )
+                else:
+                    chart_start, chart_end = chart_first_date, chart_last_date
+                chart_method = st.radio("Downsampling", ["ohlc", "lttb"], horizontal=True, key="fx_chart_method",
+                                        format_func=lambda method: "OHLC buckets" if method == "ohlc" else "LTTB")
 
-            if not df_chart_data.empty and 'VALUE DATE' in df_chart_data.columns and 'FX RATE' in df_chart_data.columns:
-                # Ensure data types are correct for Altair
-                df_chart_data['VALUE DATE'] = pd.to_datetime(df_chart_data['VALUE DATE'])
-                df_chart_data['FX RATE'] = pd.to_numeric(df_chart_data['FX RATE'], errors='coerce')
-                df_chart_data.dropna(subset=['VALUE DATE', 'FX RATE'], inplace=True)
+                df_chart_data, chart_resolution = fx_chart_pyramid.chart_data(
+                    selected_fx_for_chart, chart_start, chart_end, method=chart_method
+                )
 
                 if not df_chart_data.empty:
-                    chart = alt.Chart(df_chart_data).mark_line().encode(
+                    base_chart = alt.Chart(df_chart_data).encode(
                         x=alt.X('VALUE DATE', title='Date'),
-                        y=alt.Y('FX RATE', title=f'{selected_fx_for_chart} Rate'),
-                        tooltip=[alt.Tooltip('VALUE DATE', title='Date'), 'FX RATE'] # Updated tooltip
-                    ).properties(
+                        tooltip=[alt.Tooltip('VALUE DATE', title='Date'), 'OPEN', 'HIGH', 'LOW', alt.Tooltip('FX RATE', title='Close')] # Updated tooltip
+                    )
+                    chart = base_chart.mark_line().encode(
+                        y=alt.Y('FX RATE', title=f'{selected_fx_for_chart} Rate', scale=alt.Scale(zero=False)),
+                    )
+                    if chart_resolution != "Raw":
+                        # Aggregated points also show the high-low range of their bucket
+                        chart = base_chart.mark_area(opacity=0.25).encode(y='LOW', y2='HIGH') + chart
+                    chart = chart.properties(
                         title=f'Historical {selected_fx_for_chart} FX Rates'
                     ).interactive() # Make the chart interactive
 
-                    st.altair_chart(chart, use_container_width=True)
+                    show_chart(chart, "FX history", len(df_chart_data))
+                    st.caption(f"{len(df_chart_data)} of {len(chart_levels[0][1])} fixings shown at {chart_resolution} resolution.")
                 else:
                     st.warning("No valid data for plotting the selected FX pair.")
             else:
@@ -479,33 +396,115 @@ with tabs[0]:
             )
 
             converted_value_fix, conversion_fx_rate_fix, conversion_date_fix, message_fix = perform_currency_conversion(
-                df_processed_fx_fix, selected_fx_fix, value_to_convert_fix
+                df_processed_fx_fix, selected_fx_fix, value_to_convert_fix, curve_store=fx_fix_curves
             )
 
             if converted_value_fix is not None:
                  st.write(f"Using FX Rate **{conversion_fx_rate_fix:.4f}** from **{conversion_date_fix.strftime('%Y-%m-%d')}**")
                  st.success(f"Converted value in the quote currency: **{converted_value_fix:.2f}**")
+                 if st.button("Book this conversion", key="fx_book_button"):
+                     book_deals(deal_blotter.record_fx_conversions, pd.DataFrame([{
+                         'FX': selected_fx_fix, 'VALUE DATE': conversion_date_fix, 'AMOUNT': value_to_convert_fix,
+                         'FX RATE': conversion_fx_rate_fix, 'CONVERTED AMOUNT': converted_value_fix, 'RATE SOURCE': "direct",
+                     }]))
             else:
                  st.warning(message_fix)
+
+            st.subheader("Bulk Conversion of Cash Flows")
+            st.write(f"Upload a CSV with the columns {', '.join(FX_CASH_FLOW_COLUMNS)} (amounts in the base currency of each pair). "
+                     f"Missing pairs are triangulated through {' or '.join(FX_TRIANGULATION_CURRENCIES)}.")
+            uploaded_cash_flows = st.file_uploader("Upload cash flows (CSV)", type="csv", key="fx_bulk_upload")
+            if uploaded_cash_flows is not None:
+                df_cash_flows, read_error = read_uploaded_csv(uploaded_cash_flows, "fx_bulk_csv")
+                if read_error:
+                    st.error(read_error)
+
+                if df_cash_flows is not None:
+                    df_conversions, bulk_message = session_memo("fx_bulk_conversions", uploaded_cash_flows.file_id, lambda: convert_currency_bulk(
+                        df_processed_fx_fix, df_cash_flows, curve_store=fx_fix_curves
+                    ))
+                    if df_conversions is not None:
+                        st.success(bulk_message)
+                        # Use to_string() as a fallback for display if st.dataframe fails
+                        st.text(df_conversions.head(20).to_string())
+                        if st.button(f"Book all {len(df_conversions)} conversions", key="fx_bulk_book_button"):
+                            book_deals(deal_blotter.record_fx_conversions, df_conversions)
+                        st.download_button(
+                            "Download converted cash flows (CSV)",
+                            df_conversions.to_csv(index=False).encode("utf-8"),
+                            file_name="fx_conversions.csv",
+                            mime="text/csv",
+                            key="fx_bulk_download"
+                        )
+                    else:
+                        st.warning(bulk_message)
         else:
              st.warning("FX column not found in processed FX data for conversion.")
 
     else:
         st.warning("Could not load or process 'Market & FX Fix' data.")
 
-    st.subheader("Market & FX Live Data (Placeholder)")
-    # In a real application, this would likely involve fetching live data
-    if not df_fx_live_raw.empty: # Display raw data as placeholder
+    st.subheader("Market & FX Live Data")
+    if not df_fx_live_raw.empty:
         st.write("Preview of 'Market & FX Live' sheet (Head):")
         # Use to_string() as a fallback for display if st.dataframe fails
         st.text(df_fx_live_raw.head().to_string())
-        st.info("Live data integration would go here.")
     else:
         st.warning("Could not load 'Market & FX Live' data.")
 
+    live_rate_poller = get_live_rate_poller(LIVE_FEED_FILE, live_start_rates(
+        get_fx_curve_store(df_processed_fx_live, workbook_store.fingerprints.get(SHEET_NAME_FX_LIVE)),
+        get_fx_curve_store(df_processed_fx_fix, workbook_store.fingerprints.get(SHEET_NAME_FX_FIX)),
+    ))
+
+    @st.fragment(run_every=LIVE_REFRESH_SECONDS)
+    def show_live_rates():
+        """Redraws only this panel from the shared tick buffers; the poller thread fills them in the background."""
+        rate_book = live_rate_poller.book
+        live_pairs = rate_book.pairs()
+        st.caption(
+            f"Live feed: {live_rate_poller.feed.name}, {live_rate_poller.ticks_received} ticks received"
+            + (f", last error: {live_rate_poller.last_error}" if live_rate_poller.last_error else "")
+        )
+        if not live_pairs:
+            st.info("Waiting for the first live ticks...")
+            return
+
+        latest_ticks = [(pair, *rate_book.latest(pair), len(rate_book.buffers[pair])) for pair in live_pairs]
+        df_live_latest = pd.DataFrame(latest_ticks, columns=['FX', 'TIME', 'RATE', 'TICKS'])
+        df_live_latest['TIME'] = pd.to_datetime(df_live_latest['TIME'], unit='s')
+        # Use to_string() as a fallback for display if st.dataframe fails
+        st.text(df_live_latest.to_string())
+
+        selected_live_fx = st.selectbox("Select live FX pair:", live_pairs, key="fx_live_pair")
+        tick_times, tick_rates = rate_book.history(selected_live_fx)
+        if len(tick_times) > 1:
+            df_live_history = pd.DataFrame({'TIME': pd.to_datetime(tick_times, unit='s'), 'RATE': tick_rates})
+            live_chart = alt.Chart(df_live_history).mark_line().encode(
+                x=alt.X('TIME:T', title='Time (UTC)'),
+                y=alt.Y('RATE:Q', title='Rate', scale=alt.Scale(zero=False)),
+                tooltip=['TIME', 'RATE']
+            ).properties(
+                title=f'Live {selected_live_fx} ticks'
+            )
+            show_chart(live_chart, "Live ticks", len(df_live_history))
+
+        live_value_to_convert = st.number_input("Enter value to convert at the live rate:", value=1.0, format="%.2f", key="fx_live_convert_value")
+        live_converted, live_rate, _, live_message = perform_live_conversion(rate_book, selected_live_fx, live_value_to_convert)
+        if live_converted is not None:
+            st.write(f"Converted Value: **{live_converted:.4f}** (rate {live_rate:.6f})")
+            st.info(live_message)
+        else:
+            st.warning(live_message)
+
+    show_live_rates()
+
+render_if_open(tabs[0], fx_tab)
+
 
 # --- Tab: Freight Calculation ---
-with tabs[1]:
+@tab_fragment
+def freight_tab():
     st.header("Freight Cost Calculation")
 
     if not df_processed_freight.empty:
@@ -516,28 +515,76 @@ with tabs[1]:
         potential_destinations = df_processed_freight['Destination'].dropna().unique() if 'Destination' in df_processed_freight.columns else []
 
 
-        selected_origin = st.selectbox("Select Origin", potential_origins, key="freight_origin_selectbox") if len(potential_origins) > 0 else st.text_input("Enter Origin", key="freight_origin_input")
-        selected_destination = st.selectbox("Select Destination", potential_destinations, key="freight_destination_selectbox") if len(potential_destinations) > 0 else st.text_input("Enter Destination", key="freight_destination_input")
+        # Typed names are resolved by prefix/fuzzy match, selected names by exact match
+        allow_partial_names = st.checkbox("Type origin/destination names (partial names allowed)", value=False, key="freight_allow_partial")
+        if allow_partial_names or len(potential_origins) == 0:
+            selected_origin = st.text_input("Enter Origin", key="freight_origin_input")
+        else:
+            selected_origin = st.selectbox("Select Origin", potential_origins, key="freight_origin_selectbox")
+        if allow_partial_names or len(potential_destinations) == 0:
+            selected_destination = st.text_input("Enter Destination", key="freight_destination_input")
+        else:
+            selected_destination = st.selectbox("Select Destination", potential_destinations, key="freight_destination_selectbox")
         quantity_mt = st.number_input("Enter Quantity (MT)", value=100.0, format="%.2f", key="freight_quantity_input")
 
-        # Call the calculation function
-        freight_cost, message = calculate_freight_cost(df_processed_freight, selected_origin, selected_destination, quantity_mt)
+        # Call the calculation function with the cached rate index (O(1) lane lookup per rerun)
+        freight_rate_index = get_freight_rate_index(df_processed_freight, workbook_store.fingerprints.get(SHEET_NAME_FREIGHT))
+        freight_cost, message = calculate_freight_cost(
+            df_processed_freight, selected_origin, selected_destination, quantity_mt,
+            rate_index=freight_rate_index, allow_partial=allow_partial_names
+        )
 
         if freight_cost is not None:
             st.success(f"Total Freight Cost: **{freight_cost:.2f}**")
             st.info(message)
+            if st.button("Book this freight quote", key="freight_book_button"):
+                book_deals(deal_blotter.record_freight_quotes, pd.DataFrame([{
+                    'Origin': selected_origin, 'Destination': selected_destination, 'QuantityMT': quantity_mt,
+                    'FreightRate': freight_cost / quantity_mt if quantity_mt else None, 'TotalFreight': freight_cost, 'Status': "OK",
+                }]))
         else:
             st.warning(message)
 
+        st.subheader("Batch Freight Quotes")
+        st.write(f"Upload a CSV of shipment legs with the columns {', '.join(FREIGHT_LEG_COLUMNS)} to price the whole book at once.")
+        uploaded_legs = st.file_uploader("Upload freight legs (CSV)", type="csv", key="freight_batch_upload")
+        if uploaded_legs is not None:
+            df_legs, read_error = read_uploaded_csv(uploaded_legs, "freight_batch_csv")
+            if read_error:
+                st.error(read_error)
+
+            if df_legs is not None:
+                df_freight_quotes, batch_message = session_memo("freight_batch_quotes", uploaded_legs.file_id, lambda: calculate_freight_costs_batch(
+                    df_processed_freight, df_legs, rate_index=freight_rate_index
+                ))
+                if df_freight_quotes is not None:
+                    st.success(batch_message)
+                    # Use to_string() as a fallback for display if st.dataframe fails
+                    st.text(df_freight_quotes.head(20).to_string())
+                    if st.button(f"Book all {len(df_freight_quotes)} legs", key="freight_batch_book_button"):
+                        book_deals(deal_blotter.record_freight_quotes, df_freight_quotes)
+                    st.download_button(
+                        "Download priced legs (CSV)",
+                        df_freight_quotes.to_csv(index=False).encode("utf-8"),
+                        file_name="freight_quotes.csv",
+                        mime="text/csv",
+                        key="freight_batch_download"
+                    )
+                else:
+                    st.warning(batch_message)
+
         st.subheader("Processed Freight Data Preview (Head)")
         # Use to_string() as a fallback for display if st.dataframe fails
         st.text(df_processed_freight.head().to_string())
     else:
         st.warning("Could not load or process 'Freight & Dressing' data.")
 
+render_if_open(tabs[1], freight_tab)
+
 
 # --- Tab: Costing Beans Data ---
-with tabs[2]:
+@tab_fragment
+def beans_tab():
     st.header("Costing Beans Data")
     if not df_processed_beans.empty:
         st.subheader("Filtered Data (Costing Beans)")
@@ -562,15 +609,19 @@ with tabs[2]:
             start_datetime = pd.to_datetime(start_date)
             end_datetime = pd.to_datetime(end_date)
 
-            filtered_df_beans = df_processed_beans[df_processed_beans['FX'] == selected_fx].copy()
-            final_filtered_df_beans = filtered_df_beans[
-                (filtered_df_beans['VALUE DATE'] >= start_datetime) &
-                (filtered_df_beans['VALUE DATE'] <= end_datetime)
-            ].copy()
+            # Only the previewed rows are taken out of the shared frame
+            def filter_beans_preview():
+                beans_row_mask = (
+                    (df_processed_beans['FX'] == selected_fx) &
+                    (df_processed_beans['VALUE DATE'] >= start_datetime) &
+                    (df_processed_beans['VALUE DATE'] <= end_datetime)
+                ).to_numpy()
+                return df_processed_beans.iloc[np.flatnonzero(beans_row_mask)[:5]]
+            final_filtered_df_beans = session_memo("beans_preview", (selected_fx, start_datetime, end_datetime), filter_beans_preview)
 
             st.write(f"Showing data for: **{selected_fx}** from **{start_date.strftime('%Y-%m-%d')}** to **{end_date.strftime('%Y-%m-%d')}**")
             # Use to_string() as a fallback for display if st.dataframe fails
-            st.text(final_filtered_df_beans.head().to_string())
+            st.text(final_filtered_df_beans.to_string())
 
             # Automated Currency Conversion using Costing Beans FX Rate
             st.subheader("Currency Conversion using Costing Beans FX Rate")
@@ -581,9 +632,13 @@ with tabs[2]:
                 key="beans_conversion_value" # Added key to avoid potential conflicts
             )
 
+            # Latest rate within the selected date range: as-of lookup at the end date on the cached curves
+            beans_fx_curves = get_fx_curve_store(df_processed_beans, workbook_store.fingerprints.get(SHEET_NAME_BEANS))
             converted_value, conversion_fx_rate, conversion_date, message = perform_currency_conversion(
-                 final_filtered_df_beans, selected_fx, value_to_convert # Use the filtered data
+                 df_processed_beans, selected_fx, value_to_convert, curve_store=beans_fx_curves, as_of_date=end_datetime
             )
+            if converted_value is not None and pd.Timestamp(conversion_date) < start_datetime:
+                converted_value, message = None, f"No FX rate for '{selected_fx}' in the selected date range."
 
             if converted_value is not None:
                 st.write(f"Using FX Rate **{conversion_fx_rate:.4f}** from **{conversion_date.strftime('%Y-%m-%d')}**")
@@ -597,8 +652,11 @@ with tabs[2]:
     else:
         st.warning("Could not load or process 'Costing Beans' data.")
 
+render_if_open(tabs[2], beans_tab)
+
 # --- Tab: Valuation ---
-with tabs[3]:
+@tab_fragment
+def valuation_tab():
     st.header("Valuation (Origin & Destination)")
     if not df_processed_valo.empty:
         st.write("Inputs for Valuation:")
@@ -610,18 +668,103 @@ with tabs[3]:
         input_buying_diff = st.number_input("Enter Buying Difference:", value=0.0, format="%.2f", key="valo_buying_diff")
         input_costing = st.number_input("Enter Total Costing:", value=0.0, format="%.2f", key="valo_costing")
 
-        # Trigger calculation
-        if st.button("Calculate Valuation", key="valo_calculate_button"):
-            calculated_be, calculated_margin, message = calculate_valuation(df_processed_valo, input_buying_diff, input_costing)
+        valuation_lookup = get_valuation_lookup(df_processed_valo, workbook_store.fingerprints.get(SHEET_NAME_VALO))
+
+        valo_value_date = st.date_input("Value date (for booking):", key="valo_value_date")
+
+        # Trigger calculation; booking calculates too, since results only show on the rerun of the click
+        calculate_clicked = st.button("Calculate Valuation", key="valo_calculate_button")
+        book_clicked = st.button("Calculate and Book", key="valo_book_button")
+        if calculate_clicked or book_clicked:
+            calculated_be, calculated_margin, message = calculate_valuation(df_processed_valo, input_buying_diff, input_costing, lookup=valuation_lookup)
 
             if calculated_be is not None and calculated_margin is not None:
                 st.subheader("Calculation Results:")
                 st.write(f"Calculated Break Even: **{calculated_be:.2f}**")
                 st.write(f"Calculated Margin: **{calculated_margin:.2f}**")
                 st.info(message)
+                if book_clicked:
+                    book_deals(deal_blotter.record_valuations, pd.DataFrame([{
+                        'Buying Diff': input_buying_diff, 'Costings': input_costing, 'Selling Diff': calculated_be + calculated_margin,
+                        'Break Even': calculated_be, 'Margin': calculated_margin,
+                    }]), value_date=valo_value_date)
             else:
                  st.warning(message)
 
+        st.subheader("Valuation Grid")
+        if st.checkbox("Show Break Even / Margin surface over ranges of Buying Diff and Costing", key="valo_grid_toggle"):
+            # Default ranges span the values found in the sheet
+            default_buying_diffs = [float(min(potential_buying_diffs)), float(max(potential_buying_diffs))] if len(potential_buying_diffs) > 0 else [0.0, 1000.0]
+            default_costings = [float(min(potential_costings)), float(max(potential_costings))] if len(potential_costings) > 0 else [0.0, 500.0]
+
+            grid_columns = st.columns(2)
+            with grid_columns[0]:
+                grid_buying_diff_min = st.number_input("Buying Diff from:", value=default_buying_diffs[0], format="%.2f", key="valo_grid_bd_min")
+                grid_buying_diff_max = st.number_input("Buying Diff to:", value=default_buying_diffs[1], format="%.2f", key="valo_grid_bd_max")
+            with grid_columns[1]:
+                grid_costing_min = st.number_input("Costing from:", value=default_costings[0], format="%.2f", key="valo_grid_cost_min")
+                grid_costing_max = st.number_input("Costing to:", value=default_costings[1], format="%.2f", key="valo_grid_cost_max")
+            grid_steps = st.slider("Grid points per axis", min_value=10, max_value=400, value=200, step=10, key="valo_grid_steps")
+            grid_metric = st.radio("Metric", ["Margin", "Break Even"], horizontal=True, key="valo_grid_metric")
+
+            def compute_valuation_grid():
+                grid_start = time.perf_counter()
+                grid_buying_diffs = np.linspace(grid_buying_diff_min, grid_buying_diff_max, grid_steps)
+                grid_costings = np.linspace(grid_costing_min, grid_costing_max, grid_steps)
+                df_grid, message = calculate_valuation_grid(df_processed_valo, grid_buying_diffs, grid_costings, lookup=valuation_lookup)
+                if df_grid is not None:
+                    # Each cell spans one grid step on both axes
+                    buying_diff_step = (grid_buying_diff_max - grid_buying_diff_min) / max(grid_steps - 1, 1) or 1.0
+                    costing_step = (grid_costing_max - grid_costing_min) / max(grid_steps - 1, 1) or 1.0
+                    df_grid['Buying Diff End'] = df_grid['Buying Diff'] + buying_diff_step
+                    df_grid['Costings End'] = df_grid['Costings'] + costing_step
+                return df_grid, message, time.perf_counter() - grid_start
+
+            # Switching the metric only recolors the chart; the grid is reused
+            df_valuation_grid, grid_message, grid_elapsed = session_memo(
+                "valuation_grid", (grid_buying_diff_min, grid_buying_diff_max, grid_costing_min, grid_costing_max, grid_steps), compute_valuation_grid
+            )
+
+            if df_valuation_grid is not None:
+                grid_chart = alt.Chart(df_valuation_grid).mark_rect().encode(
+                    x=alt.X('Buying Diff:Q', title='Buying Diff'),
+                    x2='Buying Diff End:Q',
+                    y=alt.Y('Costings:Q', title='Costing'),
+                    y2='Costings End:Q',
+                    color=alt.Color(f'{grid_metric}:Q', title=grid_metric, scale=alt.Scale(scheme='redyellowgreen' if grid_metric == 'Margin' else 'viridis')),
+                    tooltip=['Buying Diff', 'Costings', 'Selling Diff', 'Break Even', 'Margin']
+                ).properties(
+                    title=f'{grid_metric} by Buying Diff and Costing'
+                )
+                show_chart(grid_chart, "Valuation grid", len(df_valuation_grid))
+                st.caption(f"{grid_message} Computed in {grid_elapsed * 1000:.1f} ms.")
+            else:
+                st.warning(grid_message)
+
+        if st.checkbox("What-if on the workbook's own formulas", key="valo_what_if_toggle"):
+            formula_engine = get_formula_engine(FILE_PATH, workbook_store.workbook_hash)
+            st.caption(
+                f"{len(formula_engine.compiled)} formulas compiled and recomputed in {formula_engine.recalculation_seconds:.2f} s; "
+                f"{len(formula_engine.unsupported)} keep the value last saved by Excel (add-in feeds, external links, spilled arrays)."
+            )
+            default_changes = pd.DataFrame([{
+                'Sheet': SHEET_NAME_VALO,
+                'Cell': "A2",
+                'Value': str(formula_engine.value(SHEET_NAME_VALO, "A2")),
+            }], columns=WHAT_IF_COLUMNS)
+            st.write("Input cells to change (add or edit rows):")
+            df_what_if_input = st.data_editor(default_changes, num_rows="dynamic", key="valo_what_if_editor")
+
+            df_what_if, what_if_message = session_memo(
+                "what_if", (workbook_store.workbook_hash, df_what_if_input.to_json()), lambda: calculate_what_if(formula_engine, df_what_if_input)
+            )
+            if df_what_if is not None:
+                st.success(what_if_message)
+                # Use to_string() as a fallback for display if st.dataframe fails
+                st.text(df_what_if.to_string())
+            else:
+                st.warning(what_if_message)
+
         st.subheader("Processed Valuation Data Preview (Head)")
          # Use to_string() as a fallback for display if st.dataframe fails
         st.text(df_processed_valo.head().to_string())
@@ -629,79 +772,479 @@ with tabs[3]:
     else:
         st.warning("Could not load or process 'Valo Ori & Dest' data.")
 
+render_if_open(tabs[3], valuation_tab)
+
 # --- Tab: Costing Products ---
-with tabs[4]: # Adjusted index for the new tab
+@tab_fragment
+def costing_products_tab():
     st.header("Costing Products")
-    st.write("This section will contain the logic and UI for calculating product costs.")
+    st.write("Full cost stack per product, built from the cost lines of the 'Costing Products' sheet.")
 
     if not df_processed_costing_products.empty:
         st.write("Inputs for Product Costing:")
-        # Add input fields relevant to product costing based on the Excel sheet
-        # Example: Product type, origin, quantity, processing parameters
+        product_base_currency = st.selectbox("Base Currency", ["USD", "EUR", "GBP"], key="products_base_currency")
+        product_freight_currency = st.selectbox("Currency of the freight table rates", ["USD", "EUR", "GBP"], key="products_freight_currency")
+
+        # Seed the products table with the sheet's own costing (fixed price and ports)
+        sheet_price, sheet_price_currency = sheet_fixed_price(df_processed_costing_products)
+        sheet_pol, sheet_pod = sheet_port_pair(df_processed_costing_products)
+        default_products = pd.DataFrame([{
+            'Product': "Sheet costing",
+            'QuantityMT': 100.0,
+            'BeanCost': sheet_price if sheet_price is not None else 0.0,
+            'BeanCurrency': sheet_price_currency or product_base_currency,
+            'Origin': sheet_pol or "",
+            'Destination': sheet_pod or "",
+        }], columns=PRODUCT_COLUMNS)
+        st.write("Products to cost (add or edit rows):")
+        df_products_input = st.data_editor(default_products, num_rows="dynamic", key="products_editor")
+
+        cost_stack, costing_message, cost_lines = session_memo("cost_stack", (df_products_input.to_json(), product_base_currency, product_freight_currency), lambda: calculate_costing_products(df_processed_costing_products, {
+            "products": df_products_input,
+            "base_currency": product_base_currency,
+            "fx_df": df_processed_fx_fix,
+            "fx_curves": get_fx_curve_store(df_processed_fx_fix, workbook_store.fingerprints.get(SHEET_NAME_FX_FIX)),
+            "freight_df": df_processed_freight,
+            "freight_index": get_freight_rate_index(df_processed_freight, workbook_store.fingerprints.get(SHEET_NAME_FREIGHT)),
+            "freight_currency": product_freight_currency,
+        }))
+
+        st.subheader("Product Cost Stack")
+        if cost_stack is not None:
+            st.success(costing_message)
+            # Use to_string() as a fallback for display if st.dataframe fails
+            st.text(cost_stack.to_string())
+
+            df_stack_chart = cost_stack.melt(id_vars=['Product'], value_vars=COST_STACK_CATEGORIES, var_name='Component', value_name='Cost per MT')
+            stack_chart = alt.Chart(df_stack_chart).mark_bar().encode(
+                x=alt.X('Product:N', title='Product'),
+                y=alt.Y('Cost per MT:Q', title=f'Cost per MT ({product_base_currency})', stack='zero'),
+                color=alt.Color('Component:N', sort=COST_STACK_CATEGORIES),
+                tooltip=['Product', 'Component', alt.Tooltip('Cost per MT:Q', format='.2f')]
+            ).properties(
+                title='Cost Stack per Product'
+            )
+            show_chart(stack_chart, "Cost stack", len(df_stack_chart))
+
+            st.write("Cost lines used from the sheet:")
+            st.text(cost_lines.to_string())
+        else:
+            st.warning(costing_message)
 
         st.subheader("Processed Costing Products Data Preview (Head)")
         # Use to_string() as a fallback for display if st.dataframe fails
         st.text(df_processed_costing_products.head().to_string())
 
+    else:
+        st.warning("Could not load or process 'Costing Products' data.")
 
-        st.subheader("Product Cost Calculation (Placeholder)")
-        st.write("Calculation logic will be implemented here.")
+render_if_open(tabs[4], costing_products_tab)
 
-        # Example of how you might call the calculation function
-        # input_params = {"product_type": selected_product, "quantity": input_quantity, ...}
-        # calculated_cost, message, data_preview = calculate_costing_products(df_processed_costing_products, input_params)
 
-        # if calculated_cost is not None:
-        #     st.success(f"Calculated Product Cost: **{calculated_cost:.2f}**")
-        # else:
-        #     st.info(message) # Display message even if calculation is not fully implemented
+# --- Tab: Margin at Risk ---
+@tab_fragment
+def margin_at_risk_tab():
+    st.header("Margin at Risk")
+    st.write("Monte Carlo distribution of a position's margin over FX and differential scenarios.")
 
+    if not df_processed_valo.empty:
+        risk_valuation_lookup = get_valuation_lookup(df_processed_valo, workbook_store.fingerprints.get(SHEET_NAME_VALO))
+        risk_fx_curves = get_fx_curve_store(df_processed_fx_fix, workbook_store.fingerprints.get(SHEET_NAME_FX_FIX))
+        # Start from the middle of the sheet's own values
+        median_buying_diff = float(np.nanmedian(risk_valuation_lookup.buying_diffs)) if len(risk_valuation_lookup) > 0 else 0.0
+        median_costing = float(pd.to_numeric(df_processed_valo['Costings'], errors='coerce').median()) if 'Costings' in df_processed_valo.columns else 0.0
+
+        st.write("Position:")
+        risk_columns = st.columns(3)
+        with risk_columns[0]:
+            risk_buying_diff = st.number_input("Buying Diff:", value=median_buying_diff, format="%.2f", key="risk_buying_diff")
+            risk_costing = st.number_input("Costing:", value=0.0 if pd.isna(median_costing) else median_costing, format="%.2f", key="risk_costing")
+            risk_quantity = st.number_input("Quantity (MT):", min_value=0.0, value=100.0, format="%.2f", key="risk_quantity")
+        with risk_columns[1]:
+            risk_eur_share = st.slider("Share of costing paid in EUR", min_value=0.0, max_value=1.0, value=0.5, step=0.05, key="risk_eur_share")
+            risk_horizon = st.number_input("Horizon (trading days):", min_value=1, max_value=500, value=60, step=1, key="risk_horizon")
+            risk_fx_model = st.radio("FX model", ["bootstrap", "parametric"], horizontal=True, key="risk_fx_model",
+                                     format_func=lambda model: f"Bootstrap {RISK_FX_PAIR} history" if model == "bootstrap" else "Parametric (lognormal)")
+            risk_fx_vol = st.number_input("FX annual volatility (parametric):", min_value=0.0, value=0.08, format="%.4f", key="risk_fx_vol")
+        with risk_columns[2]:
+            risk_buying_vol = st.number_input("Buying Diff daily vol:", min_value=0.0, value=5.0, format="%.2f", key="risk_buying_vol")
+            risk_selling_vol = st.number_input("Selling Diff daily vol:", min_value=0.0, value=5.0, format="%.2f", key="risk_selling_vol")
+            risk_costing_vol = st.number_input("Costing daily vol (incl. freight):", min_value=0.0, value=1.0, format="%.2f", key="risk_costing_vol")
+        risk_paths = st.select_slider("Paths", options=[10_000, 50_000, 100_000, 250_000, 500_000, 1_000_000], value=100_000, key="risk_paths")
+        risk_seed = st.number_input("Random seed:", min_value=0, value=42, step=1, key="risk_seed")
+
+        if st.button("Run Simulation", key="risk_run_button"):
+            risk_start = time.perf_counter()
+            risk_summary, risk_margins, risk_message = calculate_margin_at_risk(df_processed_valo, risk_fx_curves, {
+                "buying_diff": risk_buying_diff,
+                "costing": risk_costing,
+                "quantity_mt": risk_quantity,
+                "eur_cost_share": risk_eur_share,
+                "horizon_days": int(risk_horizon),
+                "fx_model": risk_fx_model,
+                "fx_annual_vol": risk_fx_vol,
+                "buying_diff_daily_vol": risk_buying_vol,
+                "selling_diff_daily_vol": risk_selling_vol,
+                "costing_daily_vol": risk_costing_vol,
+            }, int(risk_paths), seed=int(risk_seed), lookup=risk_valuation_lookup,
+               executor=get_risk_process_pool() if risk_paths >= RISK_PARALLEL_MIN_PATHS and RISK_POOL_WORKERS > 1 else None,
+               workers=RISK_POOL_WORKERS)
+            risk_elapsed = time.perf_counter() - risk_start
+
+            if risk_summary is not None:
+                st.success(risk_message)
+                # Use to_string() as a fallback for display if st.dataframe fails
+                st.text(risk_summary.to_string())
+
+                # Chart a histogram rather than every simulated path
+                bin_counts, bin_edges = np.histogram(risk_margins, bins=60)
+                df_risk_histogram = pd.DataFrame({'Margin from': bin_edges[:-1], 'Margin to': bin_edges[1:], 'Paths': bin_counts})
+                risk_chart = alt.Chart(df_risk_histogram).mark_bar().encode(
+                    x=alt.X('Margin from:Q', title='Margin per MT'),
+                    x2='Margin to:Q',
+                    y=alt.Y('Paths:Q', title='Paths'),
+                    tooltip=['Margin from', 'Margin to', 'Paths']
+                ).properties(
+                    title='Simulated Margin Distribution'
+                )
+                show_chart(risk_chart, "Margin distribution", len(df_risk_histogram))
+                st.caption(f"Computed in {risk_elapsed:.2f} s.")
+            else:
+                st.warning(risk_message)
     else:
-        st.warning("Could not load or process 'Costing Products' data.")
+        st.warning("Could not load or process 'Valo Ori & Dest' data.")
+
+render_if_open(tabs[5], margin_at_risk_tab)
 
 
 # --- Tab: Other Sheets Info ---
-with tabs[5]: # Adjusted index for the new tab
+@tab_fragment
+def other_sheets_tab():
     st.header("Information from Other Sheets")
-    st.write("This section provides a preview of data from other sheets for reference.")
+    st.write("Every worksheet of the workbook, listed from its metadata without reading any cells. "
+             "A sheet's rows are only read when it is opened below, one page at a time.")
     st.warning("Note: Displaying raw data from the Excel file might be limited due to formatting issues.")
 
-    if not df_costing_products_raw.empty:
-        st.subheader(f"'{SHEET_NAME_PRODUCTS}' Sheet Info (Head)")
+    df_sheet_catalog = get_sheet_catalog(FILE_PATH, workbook_store.workbook_hash)
+    if df_sheet_catalog.empty:
+        st.warning(f"Could not read the sheet catalog of '{FILE_PATH}'.")
+        return
+
+    st.subheader("Sheet Catalog")
+    df_catalog_view = df_sheet_catalog.assign(**{'Loaded by the App': df_sheet_catalog['Sheet'].isin(list(workbook_frames))})
+    # Use to_string() as a fallback for display if st.dataframe fails
+    st.text(df_catalog_view.to_string(index=False))
+
+    selected_sheet = st.selectbox("Sheet to open", df_sheet_catalog['Sheet'], key="other_sheets_sheet")
+    sheet_rows = df_sheet_catalog.loc[df_sheet_catalog['Sheet'] == selected_sheet, 'Rows'].iloc[0]
+    page_rows = st.selectbox("Rows per page", SHEET_PAGE_ROW_OPTIONS, index=1, key="other_sheets_page_rows")
+    page_count = max(1, -(-int(sheet_rows) // page_rows)) if not pd.isna(sheet_rows) else 1
+    # One page number per sheet and page size, so switching sheets never lands past the last page
+    page_number = st.number_input(f"Page (of {page_count})", min_value=1, max_value=page_count, value=1, step=1,
+                                  key=f"other_sheets_page[{selected_sheet}][{page_rows}]")
+    first_row = (int(page_number) - 1) * page_rows + 1
+
+    df_sheet_page, page_message = get_sheet_page(FILE_PATH, workbook_store.workbook_hash, selected_sheet, first_row, page_rows)
+    if df_sheet_page is not None:
+        st.caption(page_message)
         # Use to_string() as a fallback for display if st.dataframe fails
-        st.text(df_costing_products_raw.head().to_string())
-        st.write("Info:")
-        st.text(df_costing_products_raw.info())
+        st.text(df_sheet_page.to_string())
     else:
-         st.warning(f"Could not load '{SHEET_NAME_PRODUCTS}' data.")
-
-    if not df_valo_raw.empty:
-        st.subheader(f"'{SHEET_NAME_VALO}' Sheet Info (Head)")
-        # Use to_string() as a fallback for display if st.dataframe fails
-        st.text(df_valo_raw.head().to_string())
-        st.write("Info:")
-        st.text(df_valo_raw.info())
+        st.warning(page_message)
+
+    # Sheets the app already loads also show the column summary of their loaded frame
+    df_loaded_raw = workbook_frames.get(selected_sheet, {}).get("raw")
+    if df_loaded_raw is not None and not df_loaded_raw.empty:
+        st.write("Info (as loaded by the app):")
+        st.text(get_sheet_info_text(df_loaded_raw, workbook_store.fingerprints.get(selected_sheet)))
+
+render_if_open(tabs[6], other_sheets_tab)
+
+# --- Tab: Deal Blotter ---
+@tab_fragment
+def deal_blotter_tab():
+    st.header("Deal Blotter")
+    st.write(f"Every booked FX conversion, freight quote and valuation, stored in `{BLOTTER_PATH}`. "
+             "The aggregates are computed by SQLite over its indexes, not by loading the deals.")
+    blotter_columns = st.columns(3)
+    with blotter_columns[0]:
+        blotter_trader_filter = st.text_input("Trader (empty for all):", value=blotter_trader, key="blotter_trader_filter").strip()
+    with blotter_columns[1]:
+        blotter_start_date = st.date_input("Value date from:", value=None, key="blotter_start_date")
+    with blotter_columns[2]:
+        blotter_end_date = st.date_input("Value date to:", value=None, key="blotter_end_date")
+    blotter_filters = {"trader": blotter_trader_filter or None, "start_date": blotter_start_date, "end_date": blotter_end_date}
+
+    st.write(f"Deals in the blotter: **{deal_blotter.deal_count():,}**")
+    blotter_queries = [
+        ("Net Exposure by Currency (FX conversions)", deal_blotter.net_exposure_by_currency),
+        ("Average Freight by Lane", deal_blotter.average_freight_by_lane),
+        ("Margin per MT by Month (valuations)", deal_blotter.margin_by_month),
+    ]
+    for query_title, query in blotter_queries:
+        st.subheader(query_title)
+        query_start = time.perf_counter()
+        df_aggregate = query(**blotter_filters)
+        st.caption(f"Query time: {(time.perf_counter() - query_start) * 1000:.1f} ms")
+        if df_aggregate.empty:
+            st.info("No matching deals booked yet.")
+        else:
+            # Use to_string() as a fallback for display if st.dataframe fails
+            st.text(df_aggregate.to_string(index=False))
+
+    st.subheader("Recent Deals")
+    df_recent_deals = deal_blotter.recent_deals(BLOTTER_RECENT_DEALS, trader=blotter_trader_filter or None)
+    # Drop the columns of the other deal types so the listing stays readable
+    df_recent_deals = df_recent_deals.dropna(axis=1, how='all')
+    # Use to_string() as a fallback for display if st.dataframe fails
+    st.text(df_recent_deals.to_string(index=False))
+
+render_if_open(tabs[7], deal_blotter_tab)
+
+# --- Tab: FX Hedging ---
+@tab_fragment
+def fx_hedging_tab():
+    st.header("FX Hedging")
+    st.write("Forward hedges for the open currency exposures, bucketed by value date, solved as one linear program "
+             "within the notional and tenor limits below. Forward rates come from the Costing Beans curves first, "
+             "then from Market & FX Fix.")
+
+    hedge_source = st.radio("Exposures", ["blotter", "csv"], horizontal=True, key="hedge_source",
+                            format_func=lambda source: "Booked FX conversions (Deal Blotter)" if source == "blotter" else "Upload CSV")
+    if hedge_source == "blotter":
+        df_hedge_exposures = deal_blotter.fx_exposures_by_value_date(trader=blotter_trader or None)
     else:
-         st.warning(f"Could not load '{SHEET_NAME_VALO}' data.")
+        st.write(f"CSV columns: {', '.join(HEDGE_EXPOSURE_COLUMNS)} (positive amounts receivable, negative payable).")
+        uploaded_exposures = st.file_uploader("Exposures CSV", type="csv", key="hedge_exposures_file")
+        if uploaded_exposures is None:
+            st.info("Upload a CSV of exposures to optimize.")
+            return
+        df_hedge_exposures, upload_error = read_uploaded_csv(uploaded_exposures, "hedge_exposures_csv")
+        if df_hedge_exposures is None:
+            st.error(upload_error)
+            return
+    if df_hedge_exposures.empty:
+        st.info("No open FX exposures booked yet.")
+        return
+    st.write(f"Exposure rows: **{len(df_hedge_exposures):,}**")
+
+    hedge_columns = st.columns(3)
+    with hedge_columns[0]:
+        hedge_base_currency = st.text_input("Base currency:", value=HEDGE_DEFAULT_SETTINGS["base_currency"], key="hedge_base_currency")
+        hedge_objective = st.radio("Objective", HEDGE_OBJECTIVES, horizontal=True, key="hedge_objective",
+                                   format_func=lambda objective: "Minimize residual risk" if objective == "residual" else "Minimize cost")
+        hedge_frequency = st.selectbox("Value-date buckets", list(HEDGE_BUCKET_FREQUENCIES), index=1, key="hedge_frequency",
+                                       format_func=HEDGE_BUCKET_FREQUENCIES.get)
+        hedge_as_of = st.date_input("As of:", value=pd.Timestamp.today().date(), key="hedge_as_of")
+    with hedge_columns[1]:
+        hedge_max_tenor = st.number_input("Max tenor (days):", min_value=0, value=HEDGE_DEFAULT_SETTINGS["max_tenor_days"], step=30, key="hedge_max_tenor")
+        hedge_min_ratio = st.slider("Min hedge ratio per bucket", min_value=0.0, max_value=1.0, value=HEDGE_DEFAULT_SETTINGS["min_hedge_ratio"], step=0.05, key="hedge_min_ratio")
+        hedge_annual_vol = st.number_input("FX annual volatility (0 = from the curves):", min_value=0.0, value=HEDGE_DEFAULT_ANNUAL_VOL, format="%.4f", key="hedge_annual_vol")
+        hedge_max_residual = st.number_input("Max residual (cost objective):", min_value=0.0, value=HEDGE_DEFAULT_SETTINGS["max_residual"], format="%.0f", key="hedge_max_residual")
+        hedge_spread_bps = st.number_input("Spread (bps):", min_value=0.0, value=HEDGE_DEFAULT_SETTINGS["spread_bps"], format="%.2f", key="hedge_spread_bps")
+        hedge_spread_bps_per_year = st.number_input("Spread per year of tenor (bps):", min_value=0.0, value=HEDGE_DEFAULT_SETTINGS["spread_bps_per_year"], format="%.2f", key="hedge_spread_bps_per_year")
+    with hedge_columns[2]:
+        st.write("Notional limits in base currency (0 = no limit):")
+        hedge_limits = {
+            setting: st.number_input(label, min_value=0.0, value=0.0, format="%.0f", key=f"hedge_{setting}") or None
+            for setting, label in [
+                ("max_trade_notional", "Per forward:"),
+                ("bucket_notional_limit", "Per bucket date:"),
+                ("currency_notional_limit", "Per currency:"),
+                ("total_notional_limit", "Whole book:"),
+            ]
+        }
+
+    if st.button("Optimize Hedges", key="hedge_optimize_button"):
+        hedge_curve_stores = [
+            get_fx_curve_store(df_processed_beans, workbook_store.fingerprints.get(SHEET_NAME_BEANS)),
+            get_fx_curve_store(df_processed_fx_fix, workbook_store.fingerprints.get(SHEET_NAME_FX_FIX)),
+        ]
+        hedge_start = time.perf_counter()
+        df_hedges, df_hedge_summary, hedge_message = optimize_fx_hedges(df_hedge_exposures, hedge_curve_stores, {
+            "base_currency": hedge_base_currency,
+            "objective": hedge_objective,
+            "bucket_frequency": hedge_frequency,
+            "as_of_date": hedge_as_of,
+            "max_tenor_days": int(hedge_max_tenor),
+            "min_hedge_ratio": hedge_min_ratio,
+            "annual_vol": hedge_annual_vol or None,
+            "max_residual": hedge_max_residual,
+            "spread_bps": hedge_spread_bps,
+            "spread_bps_per_year": hedge_spread_bps_per_year,
+            **hedge_limits,
+        })
+        hedge_elapsed = time.perf_counter() - hedge_start
+
+        if df_hedges is not None:
+            st.success(hedge_message)
+            # Use to_string() as a fallback for display if st.dataframe fails
+            st.text(df_hedge_summary.to_string())
+            st.subheader("Hedges per Bucket")
+            # Use to_string() as a fallback for display if st.dataframe fails
+            st.text(df_hedges.to_string(index=False))
+            st.download_button(
+                "Download hedges (CSV)",
+                df_hedges.to_csv(index=False).encode("utf-8"),
+                file_name="fx_hedges.csv",
+                mime="text/csv",
+                key="hedge_download"
+            )
+            st.caption(f"Computed in {hedge_elapsed:.2f} s.")
+        else:
+            st.warning(hedge_message)
+
+render_if_open(tabs[8], fx_hedging_tab)
 
-    # Add other sheets here as needed
-    if not df_fx_fix_raw.empty:
-        st.subheader(f"'{SHEET_NAME_FX_FIX}' Sheet Info (Head)")
+# --- Tab: Sensitivities ---
+@tab_fragment
+def sensitivities_tab():
+    st.header("Sensitivities")
+    st.write("Delta ladder of a book's margin: every FX pair, every freight lane and the buying and selling diffs are "
+             "bumped up and down and the whole book is repriced from cached partial results, in one pass per factor type.")
+
+    if df_processed_valo.empty:
+        st.warning("Could not load or process 'Valo Ori & Dest' data.")
+        return
+
+    st.write(f"Upload a CSV book with the columns {', '.join(SENSITIVITY_BOOK_COLUMNS)} and optionally CostCurrency "
+             "(currency of the costing), Origin and Destination (freight lane) and VALUE DATE (date of the FX rates).")
+    uploaded_book = st.file_uploader("Upload book (CSV)", type="csv", key="sensitivity_book_upload")
+    if uploaded_book is None:
+        st.info("Upload a book to compute its sensitivities.")
+        return
+    df_book, read_error = read_uploaded_csv(uploaded_book, "sensitivity_book_csv")
+    if read_error:
+        st.error(read_error)
+        return
+
+    sensitivity_columns = st.columns(3)
+    with sensitivity_columns[0]:
+        sensitivity_base_currency = st.selectbox("Base Currency", ["USD", "EUR", "GBP"], key="sensitivity_base_currency")
+        sensitivity_freight_currency = st.selectbox("Currency of the freight table rates", ["USD", "EUR", "GBP"], key="sensitivity_freight_currency")
+    with sensitivity_columns[1]:
+        sensitivity_fx_bump = st.number_input("FX bump (% of rate):", min_value=0.0, value=SENSITIVITY_DEFAULT_SETTINGS["fx_bump_pct"], format="%.2f", key="sensitivity_fx_bump")
+        sensitivity_freight_bump = st.number_input("Freight bump (per MT):", min_value=0.0, value=SENSITIVITY_DEFAULT_SETTINGS["freight_bump"], format="%.2f", key="sensitivity_freight_bump")
+        sensitivity_diff_bump = st.number_input("Diff bump (per MT):", min_value=0.0, value=SENSITIVITY_DEFAULT_SETTINGS["diff_bump"], format="%.2f", key="sensitivity_diff_bump")
+    with sensitivity_columns[2]:
+        sensitivity_include_unused = st.checkbox("List pairs and lanes the book does not trade", key="sensitivity_include_unused")
+
+    sensitivity_settings = {
+        "base_currency": sensitivity_base_currency,
+        "freight_currency": sensitivity_freight_currency,
+        "fx_bump_pct": sensitivity_fx_bump,
+        "freight_bump": sensitivity_freight_bump,
+        "diff_bump": sensitivity_diff_bump,
+        "include_unused": sensitivity_include_unused,
+    }
+    sensitivity_start = time.perf_counter()
+    df_ladder, df_priced_book, sensitivity_message = session_memo("sensitivity_ladder", (uploaded_book.file_id, tuple(sensitivity_settings.items())), lambda: calculate_sensitivities(
+        df_processed_valo, df_book,
+        get_fx_curve_store(df_processed_fx_fix, workbook_store.fingerprints.get(SHEET_NAME_FX_FIX)),
+        get_freight_rate_index(df_processed_freight, workbook_store.fingerprints.get(SHEET_NAME_FREIGHT)),
+        sensitivity_settings,
+        lookup=get_valuation_lookup(df_processed_valo, workbook_store.fingerprints.get(SHEET_NAME_VALO)),
+    ))
+    sensitivity_elapsed = time.perf_counter() - sensitivity_start
+    if df_ladder is None:
+        st.warning(sensitivity_message)
+        return
+
+    st.success(sensitivity_message)
+    st.caption(f"Computed in {sensitivity_elapsed * 1000:.0f} ms.")
+
+    # Chart the largest deltas rather than every lane
+    df_top_deltas = df_ladder.assign(**{'Abs Delta': df_ladder['Delta'].abs()}).nlargest(SENSITIVITY_CHART_FACTORS, 'Abs Delta')
+    delta_chart = alt.Chart(df_top_deltas).mark_bar().encode(
+        x=alt.X('Delta:Q', title=f'Delta ({sensitivity_base_currency} per bump)'),
+        y=alt.Y('Factor:N', sort='-x', title=None),
+        color='Factor Type:N',
+        tooltip=['Factor Type', 'Factor', 'Base Value', 'Bump', 'Bump Unit', 'P&L Up', 'P&L Down', 'Delta', 'Gamma']
+    ).properties(
+        title=f'Largest {len(df_top_deltas)} Deltas'
+    )
+    show_chart(delta_chart, "Delta ladder", len(df_top_deltas))
+
+    for factor_type in df_ladder['Factor Type'].unique():
+        st.subheader(f"{factor_type} Ladder")
         # Use to_string() as a fallback for display if st.dataframe fails
-        st.text(df_fx_fix_raw.head().to_string())
-        st.write("Info:")
-        st.text(df_fx_fix_raw.info())
-    else:
-         st.warning(f"Could not load '{SHEET_NAME_FX_FIX}' data.")
+        st.text(df_ladder[df_ladder['Factor Type'] == factor_type].head(SENSITIVITY_LADDER_ROWS).to_string(index=False))
+    st.download_button(
+        "Download ladder (CSV)",
+        df_ladder.to_csv(index=False).encode("utf-8"),
+        file_name="sensitivity_ladder.csv",
+        mime="text/csv",
+        key="sensitivity_download"
+    )
+
+    st.subheader("Priced Book (Head)")
+    # Use to_string() as a fallback for display if st.dataframe fails
+    st.text(df_priced_book.head(20).to_string())
+
+render_if_open(tabs[9], sensitivities_tab)
+
+# --- Tab: Diagnostics (opt-in) ---
+if stage_recorder is not None:
+    record_diagnostics_run(stage_recorder, f"app, {st.session_state.get('active_tab') or tab_titles[0]}") # The diagnostics tab itself is not measured
+
+    def diagnostics_tab():
+        st.header("Diagnostics")
+        diagnostics_history = st.session_state["diagnostics_history"]
+        st.write("Only the selected tab runs, and a change to a tab's widgets reruns just that tab, so every "
+                 "full rerun and every tab rerun is recorded as a run of its own.")
+        # Newest first; the run that opened this tab is preselected only when it is the only one
+        diagnostics_runs = diagnostics_history[::-1]
+        selected_run = st.selectbox(
+            "Run", diagnostics_runs, index=1 if len(diagnostics_runs) > 1 else 0, key="diagnostics_run",
+            format_func=lambda run: f"Run {run['run']} ({run['scope']}): {run['seconds'] * 1000:.1f} ms, {len(run['records'])} stage(s)",
+        )
+        df_stages = pd.DataFrame(selected_run["records"], columns=STAGE_RECORD_COLUMNS)
+        if not df_stages.empty:
+            # Records are appended when a stage ends; sorting by start restores the call order for the nested view
+            df_stages = df_stages.sort_values(by='start_seconds')
+            stage_labels = df_stages['depth'].map(lambda depth: "· " * depth) + df_stages['stage']
+            df_stages_view = pd.DataFrame({
+                'Stage': stage_labels.str.ljust(int(stage_labels.str.len().max())), # Left-aligned so the nesting stays visible
+                'Start (ms)': (df_stages['start_seconds'] * 1000).round(1),
+                'Time (ms)': (df_stages['seconds'] * 1000).round(3),
+                'Rows In': df_stages['rows_in'].astype('Int64'),
+                'Rows Out': df_stages['rows_out'].astype('Int64'),
+                'Alloc Delta (KB)': (df_stages['alloc_delta_bytes'] / 1024).round(1),
+                'Error': df_stages['error'],
+            })
+            # Use to_string() as a fallback for display if st.dataframe fails
+            st.text(df_stages_view.to_string(index=False))
+
+            # Only top-level stages add up to the run time; nested ones are already inside their parent
+            df_stage_totals = df_stages[df_stages['depth'] == 0].groupby('stage', as_index=False)['seconds'].sum()
+            df_stage_totals['Time (ms)'] = df_stage_totals['seconds'] * 1000
+            stage_chart = alt.Chart(df_stage_totals).mark_bar().encode(
+                x=alt.X('Time (ms):Q', title='Time (ms)'),
+                y=alt.Y('stage:N', title='Stage', sort='-x'),
+                tooltip=['stage', alt.Tooltip('Time (ms):Q', format='.2f')]
+            ).properties(
+                title=f'Top-level stages of run {selected_run["run"]}'
+            )
+            st.altair_chart(stage_chart, use_container_width=True)
+        else:
+            st.info("No instrumented stage ran in this run (everything came from the shared caches).")
 
-    if not df_fx_live_raw.empty:
-        st.subheader(f"'{SHEET_NAME_FX_LIVE}' Sheet Info (Head)")
+        st.subheader("Recent Runs")
+        df_reruns = pd.DataFrame([
+            (run["run"], run["scope"], run["seconds"] * 1000, len(run["records"]), sum(record["seconds"] for record in run["records"] if record["depth"] == 0) * 1000)
+            for run in diagnostics_history
+        ], columns=['Run', 'Scope', 'Wall Time (ms)', 'Stages', 'Instrumented Time (ms)'])
         # Use to_string() as a fallback for display if st.dataframe fails
-        st.text(df_fx_live_raw.head().to_string())
-        st.write("Info:")
-        st.text(df_fx_live_raw.info())
-    else:
-         st.warning(f"Could not load '{SHEET_NAME_LIVE}' data.")
+        st.text(df_reruns.round(1).to_string(index=False))
+
+        # Structured logs: one JSON object per stage, tagged with its run number
+        st.download_button(
+            "Download stage records (JSON lines)",
+            data=stage_records_to_json_lines([record for run in diagnostics_history for record in run["records"]]),
+            file_name="stage_records.jsonl", mime="application/x-ndjson", key="diagnostics_download",
+        )
+
+    render_if_open(tabs[tab_titles.index("Diagnostics")], diagnostics_tab)
 
 # --- General Error Handling (moved to the end) ---
 # The specific error handling within the load_excel_data function is usually sufficient.
@@ -0,0 +1,15 @@
+import pandas as pd
+import pytest
+
+from trade_engine.fx import FxCurveStore
+
+
+@pytest.fixture
+def eurusd_curves():
+    """FxCurveStore with a daily EURUSD curve over 2026, rising from 1.10 by 0.0001 a day."""
+    value_dates = pd.date_range("2026-01-01", "2026-12-31", freq="D")
+    return FxCurveStore(pd.DataFrame({
+        'FX': "EURUSD",
+        'VALUE DATE': value_dates,
+        'FX RATE': 1.10 + 0.0001 * pd.RangeIndex(len(value_dates)),
+    }))
@@ -0,0 +1,54 @@
+import os
+
+import pandas as pd
+import pytest
+
+from trade_engine import batch
+
+
+@pytest.fixture
+def batch_files(tmp_path, monkeypatch):
+    """Two one-row chunks to price, a stand-in workbook and the output path; no reference data is loaded."""
+    input_path = tmp_path / "deals.csv"
+    pd.DataFrame({'Buying Diff': [100.0, 200.0], 'Costings': [10.0, 20.0]}).to_csv(input_path, index=False)
+    workbook_path = tmp_path / "workbook.xlsx"
+    workbook_path.write_bytes(b"")
+    monkeypatch.setattr(batch, "build_pricing_context", lambda workbook_path, job, options: {})
+    return str(input_path), str(tmp_path / "priced.csv"), str(workbook_path)
+
+
+def test_run_batch_writes_every_chunk(batch_files, monkeypatch):
+    input_path, output_path, workbook_path = batch_files
+    monkeypatch.setattr(batch, "price_chunk", lambda context, chunk: (chunk.assign(Status="OK"), "priced"))
+
+    summary, message = batch.run_batch("valuation", input_path, output_path, workbook_path, chunk_rows=1)
+
+    assert summary["rows"] == 2 and summary["ok_rows"] == 2 and summary["chunks"] == 2
+    assert pd.read_csv(output_path)['Buying Diff'].tolist() == [100.0, 200.0]
+
+
+def test_unexpected_error_discards_the_temporary_output(batch_files, monkeypatch):
+    input_path, output_path, workbook_path = batch_files
+
+    def price_chunk(context, chunk):
+        if chunk['Buying Diff'].iloc[0] == 200.0:
+            raise TypeError("unsupported operand")
+        return chunk.assign(Status="OK"), "priced"
+    monkeypatch.setattr(batch, "price_chunk", price_chunk)
+
+    with pytest.raises(TypeError):
+        batch.run_batch("valuation", input_path, output_path, workbook_path, chunk_rows=1)
+
+    assert not os.path.exists(output_path)
+    assert sorted(os.listdir(os.path.dirname(output_path))) == ["deals.csv", "workbook.xlsx"]
+
+
+def test_conversions_count_only_converted_rows_as_ok(batch_files, monkeypatch):
+    input_path, output_path, workbook_path = batch_files
+    monkeypatch.setattr(batch, "price_chunk", lambda context, chunk: (chunk.assign(**{
+        'FX RATE': 1.1, 'CONVERTED AMOUNT': chunk['Costings'].where(chunk['Costings'] < 15) * 1.1,
+    }), "converted"))
+
+    summary, _ = batch.run_batch("fx", input_path, output_path, workbook_path, chunk_rows=1)
+
+    assert summary["rows"] == 2 and summary["ok_rows"] == 1
@@ -0,0 +1,19 @@
+import pandas as pd
+
+from trade_engine.blotter import DealBlotter
+from trade_engine.fx import convert_currency_bulk
+
+
+def test_conversion_with_a_rate_but_no_numeric_amount_is_recorded_as_invalid(tmp_path, eurusd_curves):
+    conversions, _ = convert_currency_bulk(None, pd.DataFrame({
+        'FX': ["EURUSD", "EURUSD", "GBPJPY"],
+        'VALUE DATE': ["2026-03-20", "2026-03-20", "2026-03-20"],
+        'AMOUNT': ["1000", "n/a", "1000"],
+    }), eurusd_curves)
+    blotter = DealBlotter(str(tmp_path / "blotter.sqlite"))
+
+    assert blotter.record_fx_conversions(conversions) == 3
+
+    deals = blotter.recent_deals().sort_values('id')
+    assert deals['status'].tolist() == ["OK", "invalid amount", "no rate found"]
+    assert deals['amount'].iloc[0] == 1000.0 and pd.isna(deals['amount'].iloc[1])
@@ -0,0 +1,91 @@
+import os
+
+import pandas as pd
+import pytest
+
+from trade_engine.formulas import WorkbookFormulaEngine, cell_key, shift_reference
+from trade_engine.what_if import calculate_what_if
+
+WORKBOOK_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "Cocoa Trading Sheet.xlsx")
+
+
+def engine_of(cells, shared=()):
+    """
+    An engine over one sheet 'S' from {address: value, or formula text starting with '='}.
+    shared lists (address, master address) pairs: the cell holds the master's formula, filled as Excel does.
+    """
+    values, formulas = {}, {}
+    for address, content in cells.items():
+        key = cell_key("S", address)
+        if isinstance(content, str) and content.startswith("="):
+            formulas[key] = (content[1:], False, False, (0, 0))
+        else:
+            values[key] = content
+    for address, master_address in shared:
+        key, master_key = cell_key("S", address), cell_key("S", master_address)
+        formulas[key] = (formulas[master_key][0], False, False, (key[1] - master_key[1], key[2] - master_key[2]))
+    return WorkbookFormulaEngine(["S"], values, formulas, {})
+
+
+@pytest.fixture(scope="module")
+def workbook_engine():
+    if not os.path.exists(WORKBOOK_PATH):
+        pytest.skip("The sample workbook is not available.")
+    return WorkbookFormulaEngine.from_xlsx(WORKBOOK_PATH)
+
+
+def test_sample_workbook_recomputes_to_the_values_excel_saved(workbook_engine):
+    assert len(workbook_engine.compiled) > 20_000
+    assert workbook_engine.verify() == []
+
+
+@pytest.mark.parametrize("formula, expected", [
+    ("=2+3*4^2", 50.0),
+    ("=(2+3)*4", 20.0),
+    ("=10-4-3", 3.0),
+    ("=2^3^2", 64.0), # Excel evaluates ^ left to right
+    ("=-2^2", 4.0), # Unary minus binds tighter than ^
+    ("=-A1^2", 9.0),
+    ("=2*-A1", -6.0),
+    ("=50%*A1", 1.5),
+    ("=\"x\"&1+2", "x3"),
+    ("=1+2=A1", True),
+])
+def test_operator_precedence_and_unary_minus(formula, expected):
+    engine = engine_of({"A1": 3.0, "B1": formula})
+
+    assert engine.value("S", "B1") == expected
+
+
+def test_shared_formulas_shift_their_relative_references():
+    engine = engine_of({
+        "A1": 1.0, "A2": 2.0, "A3": 3.0, "C1": 10.0,
+        "B1": "=A1*$C$1+SUM($A$1:A1)",
+    }, shared=[("B2", "B1"), ("B3", "B1")])
+
+    assert [engine.value("S", address) for address in ("B1", "B2", "B3")] == [11.0, 23.0, 36.0]
+    assert engine.formula(cell_key("S", "B3")) == "=A3*$C$1+SUM($A$1:A3)"
+    assert shift_reference("IVC!B20", 1, 2) == "IVC!D21"
+    assert shift_reference("$A2:B$3", 1, 1) == "$A3:C$3"
+    assert shift_reference("A:B", 5, 1) == "B:C"
+
+
+def test_what_if_propagates_through_a_range_dependency():
+    engine = engine_of({
+        "A1": 1.0, "A2": 2.0, "A3": 3.0,
+        "B1": "=SUM(A1:A3)",
+        "C1": "=B1*2",
+        "D1": "=A1+1", # Reads A1 only, not the changed cell
+    })
+
+    changed, stats = engine.what_if({("S", "A2"): 10.0})
+
+    assert changed == {("S", "A2"): (2.0, 10.0), ("S", "B1"): (6.0, 14.0), ("S", "C1"): (12.0, 28.0)}
+    assert stats["dirty_cells"] == 2
+    assert engine.value("S", "C1") == 12.0 # The base values are untouched
+
+    df_changed, message = calculate_what_if(engine, pd.DataFrame({'Sheet': ["S"], 'Cell': ["a2"], 'Value': ["10"]}))
+    assert df_changed[['Cell', 'Formula', 'What-If Value']].values.tolist() == [
+        ["A2", "", "10.0"], ["B1", "=SUM(A1:A3)", "14.0"], ["C1", "=B1*2", "28.0"],
+    ]
+    assert message.startswith("1 input cell(s) changed; 2 dependent formula(s) recomputed")
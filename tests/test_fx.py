@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+
+from trade_engine.fx import convert_currency_bulk, parse_value_dates
+
+
+def test_missing_value_date_uses_the_latest_rate(eurusd_curves):
+    conversions, _ = convert_currency_bulk(None, pd.DataFrame({'FX': ["EURUSD"] * 2, 'VALUE DATE': [None, ""], 'AMOUNT': 100.0}), curve_store=eurusd_curves)
+    latest_rate, _ = eurusd_curves.latest("EURUSD")
+    assert np.allclose(conversions['FX RATE'], latest_rate)
+    assert (conversions['RATE SOURCE'] == "direct").all()
+
+
+def test_unparseable_value_date_gets_no_rate(eurusd_curves):
+    conversions, message = convert_currency_bulk(None, pd.DataFrame({
+        'FX': ["EURUSD"] * 3,
+        'VALUE DATE': ["2026-13-45", "garbage", "2026-03-01"],
+        'AMOUNT': 100.0,
+    }), curve_store=eurusd_curves)
+    assert conversions['FX RATE'].iloc[:2].isna().all()
+    assert conversions['CONVERTED AMOUNT'].iloc[:2].isna().all()
+    assert list(conversions['RATE SOURCE']) == ["invalid value date", "invalid value date", "direct"]
+    assert conversions['FX RATE'].iloc[2] == eurusd_curves.as_of("EURUSD", "2026-03-01")[0]
+    assert message == "Converted 1 of 3 cash flows."
+
+
+def test_value_dates_in_several_formats_all_get_a_rate(eurusd_curves):
+    conversions, message = convert_currency_bulk(None, pd.DataFrame({
+        'FX': ["EURUSD"] * 4,
+        'VALUE DATE': ["2026-03-01", "2026-03-02 10:00", "03/04/2026", pd.Timestamp("2026-03-05")],
+        'AMOUNT': 100.0,
+    }), curve_store=eurusd_curves)
+    expected_rates = [eurusd_curves.as_of("EURUSD", date)[0] for date in ["2026-03-01", "2026-03-02", "2026-03-04", "2026-03-05"]]
+    assert list(conversions['FX RATE']) == expected_rates
+    assert (conversions['RATE SOURCE'] == "direct").all()
+    assert message == "Converted 4 of 4 cash flows."
+
+
+def test_parse_value_dates_flags_only_given_dates_that_do_not_parse():
+    dates, invalid = parse_value_dates(pd.Series(["2026-03-01", None, " ", "garbage", "2026-03-02 10:00", "2026-03-01"]))
+    assert dates.tolist()[:1] + dates.tolist()[4:] == [pd.Timestamp("2026-03-01"), pd.Timestamp("2026-03-02 10:00"), pd.Timestamp("2026-03-01")]
+    assert dates.iloc[1:4].isna().all()
+    assert invalid.tolist() == [False, False, False, True, False, False]
+
+
+def test_inverse_and_unknown_pairs(eurusd_curves):
+    conversions, _ = convert_currency_bulk(None, pd.DataFrame({'FX': ["USDEUR", "GBPJPY"], 'VALUE DATE': "2026-06-30", 'AMOUNT': 100.0}), curve_store=eurusd_curves)
+    assert conversions['FX RATE'].iloc[0] == 1.0 / eurusd_curves.as_of("EURUSD", "2026-06-30")[0]
+    assert list(conversions['RATE SOURCE']) == ["inverse", "no rate found"]
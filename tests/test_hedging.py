@@ -0,0 +1,72 @@
+import pandas as pd
+import pytest
+
+from trade_engine.hedging import optimize_fx_hedges
+
+AS_OF_DATE = "2026-03-02"
+
+
+def exposures(*flows):
+    return pd.DataFrame(list(flows), columns=['Currency', 'VALUE DATE', 'AMOUNT'])
+
+
+def summary_value(summary, metric):
+    return summary.set_index('Metric').loc[metric, 'Value']
+
+
+def test_cost_objective_ignores_exposure_beyond_the_tenor_limit(eurusd_curves):
+    hedges, summary, message = optimize_fx_hedges(exposures(
+        ("EUR", "2026-03-20", 1_000_000),
+        ("EUR", "2026-12-18", -500_000), # Beyond max_tenor_days
+    ), [eurusd_curves], {"objective": "cost", "as_of_date": AS_OF_DATE, "max_tenor_days": 90, "bucket_frequency": "D"})
+
+    assert hedges is not None, message
+    assert hedges['Status'].tolist() == ["Hedged", "Beyond 90 days"]
+    assert hedges['Hedge Ratio'].tolist() == pytest.approx([1.0, 0.0])
+    out_of_tenor = 500_000 * hedges['Forward Rate'].iloc[1]
+    assert summary_value(summary, "Unhedgeable (USD)") == pytest.approx(out_of_tenor)
+    assert "can't be hedged" in message
+
+
+def test_cost_objective_residual_is_measured_against_the_trade_limit(eurusd_curves):
+    hedges, summary, message = optimize_fx_hedges(exposures(
+        ("EUR", "2026-03-20", 1_000_000),
+        ("EUR", "2026-04-17", 200_000),
+    ), [eurusd_curves], {"objective": "cost", "as_of_date": AS_OF_DATE, "max_trade_notional": 500_000, "bucket_frequency": "D"})
+
+    assert hedges is not None, message
+    assert hedges['Hedge Notional (USD)'].tolist() == pytest.approx([500_000, 200_000 * hedges['Forward Rate'].iloc[1]])
+    assert summary_value(summary, "Unhedgeable (USD)") == pytest.approx(1_000_000 * hedges['Forward Rate'].iloc[0] - 500_000)
+
+
+def test_residual_target_beyond_the_limits_is_infeasible(eurusd_curves):
+    hedges, summary, message = optimize_fx_hedges(exposures(
+        ("EUR", "2026-03-20", 1_000_000),
+    ), [eurusd_curves], {"objective": "cost", "as_of_date": AS_OF_DATE, "total_notional_limit": 100_000})
+
+    assert hedges is None and summary is None
+    assert message.startswith("No hedge satisfies the limits")
+
+
+def test_unparseable_value_dates_are_not_hedged_as_spot(eurusd_curves):
+    hedges, _, message = optimize_fx_hedges(exposures(
+        ("EUR", "2026-03-20", 1_000_000),
+        ("EUR", "not a date", 300_000),
+        ("EUR", None, 100_000), # Missing: spot
+    ), [eurusd_curves], {"as_of_date": AS_OF_DATE, "bucket_frequency": "D"})
+
+    assert hedges['Exposure'].tolist() == [100_000, 1_000_000]
+    assert hedges['Tenor Days'].tolist() == [0, 18]
+    assert message.endswith("1 flow(s) with an invalid value date are left out.")
+
+
+def test_value_dates_in_a_second_format_are_hedged(eurusd_curves):
+    hedges, summary, message = optimize_fx_hedges(exposures(
+        ("EUR", "2026-03-20", 1_000_000),
+        ("EUR", "2026-04-17 00:00", 200_000),
+        ("EUR", "05/15/2026", 300_000),
+    ), [eurusd_curves], {"objective": "cost", "as_of_date": AS_OF_DATE, "bucket_frequency": "D"})
+
+    assert hedges['Bucket Date'].dt.strftime('%Y-%m-%d').tolist() == ["2026-03-20", "2026-04-17", "2026-05-15"]
+    assert summary_value(summary, "Hedge Ratio") == pytest.approx(1.0)
+    assert "invalid value date" not in message
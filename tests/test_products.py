@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from trade_engine.products import PRODUCT_COLUMNS, calculate_costing_products
+
+
+def costing_form(*lines):
+    """A 'Costing Products' form of (label, months, column C, column D, include flag) lines."""
+    return pd.DataFrame([[label, months, column_c, column_d, None, include] for label, months, column_c, column_d, include in lines])
+
+
+def cost_products(form, eurusd_curves, freight_df=None):
+    products = pd.DataFrame([
+        ["Liquor", 10.0, 2000.0, "EUR", "Abidjan", "Amsterdam"],
+        ["Butter", 5.0, 3000.0, "EUR", "Abidjan", "Hamburg"],
+    ], columns=PRODUCT_COLUMNS)
+    return calculate_costing_products(form, {
+        "products": products,
+        "base_currency": "USD",
+        "fx_df": eurusd_curves.points,
+        "fx_curves": eurusd_curves,
+        "freight_df": freight_df if freight_df is not None else pd.DataFrame(),
+        "freight_currency": "USD",
+    })
+
+
+def test_totals_add_up_the_cost_stack(eurusd_curves):
+    form = costing_form(
+        ("SAMPLING", None, "USD", 10.0, 1),
+        ("DTHC", None, "USD", 20.0, 1),
+        ("FREIGHT", None, "USD", 50.0, 1),
+        ("INSURANCE", None, 0.01, None, 1),
+    )
+    freight_df = pd.DataFrame({'Origin': ["Abidjan"], 'Destination': ["Amsterdam"], 'FreightCost': [80.0]})
+    cost_stack, message, _ = cost_products(form, eurusd_curves, freight_df)
+
+    eur_rate, _ = eurusd_curves.latest("EURUSD")
+    bean = np.array([2000.0, 3000.0]) * eur_rate
+    assert cost_stack['Status'].tolist() == ["OK", "OK"]
+    assert cost_stack['FreightSource'].tolist() == ["freight table", "sheet FREIGHT line"]
+    assert cost_stack['Freight'].tolist() == pytest.approx([80.0, 50.0])
+    assert cost_stack['TotalPerMT'].to_numpy() == pytest.approx(bean * 1.01 + 10.0 + 20.0 + np.array([80.0, 50.0]))
+    assert cost_stack['TotalCost'].to_numpy() == pytest.approx(cost_stack['TotalPerMT'].to_numpy() * [10.0, 5.0])
+    assert message.startswith("Costed 2 of 2 products")
+
+
+def test_unconverted_cost_line_leaves_totals_unpriced(eurusd_curves):
+    form = costing_form(
+        ("SAMPLING", None, "USD", 10.0, 1),
+        ("DTHC", None, "GBP", 20.0, 1),
+        ("FREIGHT", None, "USD", 50.0, 1),
+    )
+    cost_stack, message, _ = cost_products(form, eurusd_curves)
+
+    assert cost_stack['Logistics'].isna().all()
+    assert cost_stack['TotalPerMT'].isna().all()
+    assert cost_stack['Status'].str.startswith("Unconverted cost lines").all()
+    assert "No FX rate to USD for: DTHC (GBP)." in message
+
+
+def test_no_freight_rate_is_not_priced_at_zero(eurusd_curves):
+    form = costing_form(("SAMPLING", None, "USD", 10.0, 1))
+    cost_stack, message, _ = cost_products(form, eurusd_curves)
+
+    assert cost_stack['FreightSource'].tolist() == ["none", "none"]
+    assert cost_stack['Freight'].isna().all()
+    assert cost_stack['TotalPerMT'].isna().all()
+    assert cost_stack['Status'].tolist() == ["No freight rate", "No freight rate"]
+    assert message.startswith("Costed 0 of 2 products")
@@ -0,0 +1,19 @@
+import pandas as pd
+
+from trade_engine.schemas import get_inferred_schema
+
+
+def test_persisted_schema_is_reused_while_the_columns_fit(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    df = pd.DataFrame({'Label': ["a", "b"], 'Amount': [1.5, 2.0]})
+    assert get_inferred_schema(df, "Sheet") == {'Label': {"dtype": "str"}, 'Amount': {"dtype": "numeric"}}
+    assert get_inferred_schema(df.assign(Amount=[3.0, 4.0]), "Sheet")['Amount'] == {"dtype": "numeric"}
+
+
+def test_schema_is_inferred_again_when_a_column_turns_to_text(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    get_inferred_schema(pd.DataFrame({'Label': ["a", "b"], 'Amount': [1.5, 2.0]}), "Sheet")
+    changed = pd.DataFrame({'Label': ["a", "b"], 'Amount': ["USD", "EUR"]})
+    assert get_inferred_schema(changed, "Sheet")['Amount'] == {"dtype": "str"}
+    # The new schema is persisted
+    assert get_inferred_schema(changed, "Sheet")['Amount'] == {"dtype": "str"}
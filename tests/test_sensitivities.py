@@ -0,0 +1,35 @@
+import pandas as pd
+
+from trade_engine.sensitivities import calculate_sensitivities
+
+
+def test_unparseable_value_date_is_not_priced(eurusd_curves):
+    valo_df = pd.DataFrame({'Buying Diff': [100.0, 200.0], 'Selling Diff': [400.0, 500.0]})
+    book_df = pd.DataFrame({
+        'Buying Diff': [100.0, 100.0, 100.0],
+        'Costings': [10.0, 10.0, 10.0],
+        'QuantityMT': [5.0, 5.0, 5.0],
+        'CostCurrency': "EUR",
+        'VALUE DATE': ["2026-06-30", None, "2026-13-45"],
+    })
+
+    _, book, _ = calculate_sensitivities(valo_df, book_df, eurusd_curves, None)
+
+    assert book['Status'].tolist() == ["OK", "OK", "Invalid value date"]
+
+
+def test_value_dates_in_a_second_format_are_priced(eurusd_curves):
+    valo_df = pd.DataFrame({'Buying Diff': [100.0, 200.0], 'Selling Diff': [400.0, 500.0]})
+    book_df = pd.DataFrame({
+        'Buying Diff': [100.0, 100.0],
+        'Costings': [10.0, 10.0],
+        'QuantityMT': [5.0, 5.0],
+        'CostCurrency': "EUR",
+        'VALUE DATE': ["2026-06-30", "2026-07-01 00:00"],
+    })
+
+    ladder, book, _ = calculate_sensitivities(valo_df, book_df, eurusd_curves, None)
+
+    assert book['Status'].tolist() == ["OK", "OK"]
+    eurusd_delta = ladder.loc[(ladder['Factor Type'] == "FX") & (ladder['Factor'] == "EURUSD"), 'Delta']
+    assert len(eurusd_delta) == 1 and eurusd_delta.iloc[0] != 0
@@ -0,0 +1,83 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+import pytest
+
+from trade_engine.service import LatencyMetrics, MicroBatcher, PricingService
+
+WORKBOOK_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "Cocoa Trading Sheet.xlsx")
+
+
+def price_doubles(rows):
+    """Doubles 'x' per row; a row without a number fails the whole call, like a bad pandas column."""
+    return [{"y": row["x"] * 2} for row in rows], "priced"
+
+
+async def submit_together(batcher, *requests):
+    return await asyncio.gather(*(batcher.submit(rows) for rows in requests))
+
+
+def test_failed_batch_only_fails_the_bad_request():
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        metrics = LatencyMetrics()
+        batcher = MicroBatcher("/double", price_doubles, executor, metrics, window_seconds=0.01)
+        good, bad, other = asyncio.run(submit_together(batcher, [{"x": 1}, {"x": 2}], [{"x": None}], [{"x": 5}]))
+
+    assert good == ([{"y": 2}, {"y": 4}], None)
+    assert bad[0] is None and bad[1].startswith("Pricing failed:")
+    assert other == ([{"y": 10}], None)
+    # The coalesced batch, then each request on its own
+    assert metrics.snapshot()["endpoints"]["/double"]["batches"] == 4
+
+
+@pytest.fixture
+def service():
+    """A service per test: its micro-batchers belong to the event loop of the test's asyncio.run."""
+    if not os.path.exists(WORKBOOK_PATH):
+        pytest.skip("The sample workbook is not available.")
+    return PricingService(WORKBOOK_PATH, batch_window_seconds=0.01)
+
+
+def test_invalid_field_types_are_rejected_before_batching(service):
+    async def requests():
+        return await asyncio.gather(
+            service.price("/freight", {"origin": "ARKAS", "destination": "AbidjanAntwerp40", "quantity_mt": 10}),
+            service.price("/freight", {"origin": ["a"], "destination": "AbidjanAntwerp40", "quantity_mt": 10}),
+            service.price("/valuation", {"buying_diff": "high", "costing": 10}),
+        )
+    (good_status, good), (list_status, list_error), (text_status, text_error) = asyncio.run(requests())
+
+    assert good_status == HTTPStatus.OK and good["status"] == "OK" and good["total_freight"] == pytest.approx(400.0)
+    assert list_status == HTTPStatus.BAD_REQUEST and list_error["error"] == "Request 0: field(s) origin must be a single value."
+    assert text_status == HTTPStatus.BAD_REQUEST and text_error["error"] == "Request 0: field(s) buying_diff must be numeric."
+
+
+def test_non_finite_numbers_are_rejected(service):
+    status, error = asyncio.run(service.price("/valuation", [{"buying_diff": 100, "costing": 10}, {"buying_diff": "nan", "costing": "inf"}]))
+
+    assert status == HTTPStatus.BAD_REQUEST and error["error"] == "Request 1: field(s) buying_diff, costing must be numeric."
+
+
+def test_only_partial_freight_items_take_the_row_by_row_path(service):
+    status, records = asyncio.run(service.price("/freight", [
+        {"origin": "ARKAS", "destination": "AbidjanAntwerp40", "quantity_mt": 10},
+        {"origin": "arka", "destination": "AbidjanAntwerp40", "quantity_mt": 5, "allow_partial": True},
+        {"origin": "arka", "destination": "AbidjanAntwerp40", "quantity_mt": 5}, # Exact names only
+    ]))
+
+    assert status == HTTPStatus.OK
+    assert [record["status"] for record in records] == ["OK", "OK", "No freight rate found"]
+    assert [record["total_freight"] for record in records] == pytest.approx([400.0, 200.0, None])
+    assert "message" in records[1] and "message" not in records[0]
+
+
+def test_partial_freight_status_is_never_the_calculation_message(service):
+    records = service._price_partial_freight([
+        {"Origin": "arka", "Destination": "AbidjanAntwerp40", "QuantityMT": "n/a"},
+        {"Origin": "ARKAS", "Destination": "abidjanantw", "QuantityMT": 5},
+    ])
+
+    assert [record["status"] for record in records] == ["Invalid quantity", "No freight rate found"]
+    assert records[0]["message"].startswith("Calculated using rate") and "ambiguous" in records[1]["message"]
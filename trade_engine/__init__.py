@@ -0,0 +1,57 @@
+"""
+Calculation engine of the Cocoa Trading Sheet app, importable without Streamlit.
+
+The Streamlit app (main.py), the batch CLI and the HTTP pricing service (python -m trade_engine)
+and the process pool workers all use these modules; none of them imports Streamlit or Altair.
+Loading problems are reported through the "trade_engine" loggers instead of UI calls.
+"""
+
+from .batch import BATCH_JOBS, run_batch
+from .blotter import DealBlotter
+from .freight import FreightRateIndex, calculate_freight_cost, calculate_freight_costs_batch
+from .fx import FxCurveStore, convert_currency_bulk, perform_currency_conversion, perform_live_conversion
+from .hedging import optimize_fx_hedges
+from .processing import (
+    SHEET_PROCESSORS,
+    process_costing_beans,
+    process_costing_products_data,
+    process_freight_data,
+    process_fx_data,
+    process_valo_data,
+)
+from .products import calculate_costing_products
+from .sensitivities import calculate_sensitivities
+from .service import PricingService, run_service
+from .valuation import ValuationLookup, calculate_valuation, calculate_valuation_batch, calculate_valuation_grid
+from .workbook import DEFAULT_WORKBOOK_PATH, WorkbookStore, load_excel_data
+
+__all__ = [
+    "BATCH_JOBS",
+    "DEFAULT_WORKBOOK_PATH",
+    "DealBlotter",
+    "FreightRateIndex",
+    "FxCurveStore",
+    "PricingService",
+    "SHEET_PROCESSORS",
+    "ValuationLookup",
+    "WorkbookStore",
+    "calculate_costing_products",
+    "calculate_freight_cost",
+    "calculate_freight_costs_batch",
+    "calculate_sensitivities",
+    "calculate_valuation",
+    "calculate_valuation_batch",
+    "calculate_valuation_grid",
+    "convert_currency_bulk",
+    "load_excel_data",
+    "optimize_fx_hedges",
+    "perform_currency_conversion",
+    "perform_live_conversion",
+    "process_costing_beans",
+    "process_costing_products_data",
+    "process_freight_data",
+    "process_fx_data",
+    "process_valo_data",
+    "run_batch",
+    "run_service",
+]
@@ -0,0 +1,6 @@
+import sys
+
+from .cli import main
+
+if __name__ == "__main__": # Spawned batch workers import this module too and must not rerun the CLI
+    sys.exit(main())
@@ -0,0 +1,236 @@
+"""
+Batch pricing of large input files with the workbook's reference data, without Streamlit.
+
+The input (CSV or Parquet) is read in chunks of rows, every chunk is priced with the vectorized
+calculator of the job and the results are streamed to the output file (CSV or Parquet) in input
+order, so memory use depends on the chunk size and not on the size of the file. With several
+workers the chunks are priced in a process pool; every worker loads the reference sheets once
+(memory-mapped from the snapshot cache when the app or an earlier run already parsed them).
+"""
+
+import collections
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .freight import FREIGHT_LEG_COLUMNS, FreightRateIndex, calculate_freight_costs_batch
+from .fx import FX_CASH_FLOW_COLUMNS, FxCurveStore, convert_currency_bulk
+from .processing import SHEET_PROCESSORS
+from .products import PRODUCT_COLUMNS, calculate_costing_products
+from .valuation import VALUATION_DEAL_COLUMNS, ValuationLookup, calculate_valuation_batch
+from .workbook import (
+    RAW_PREVIEW_SHEETS,
+    SHEET_NAME_FREIGHT,
+    SHEET_NAME_FX_FIX,
+    SHEET_NAME_PRODUCTS,
+    SHEET_NAME_VALO,
+    WorkbookStore,
+)
+
+logger = logging.getLogger(__name__)
+
+BATCH_CHUNK_ROWS = 100_000 # Rows priced per chunk; bounds the memory of one chunk and its results
+BATCH_CHUNKS_IN_FLIGHT_PER_WORKER = 2 # Chunks queued per worker, so workers never wait on the writer
+
+# Batch jobs: the sheets whose reference data they need and the columns they expect in the input
+BATCH_JOBS = {
+    "freight": {"sheets": [SHEET_NAME_FREIGHT], "columns": FREIGHT_LEG_COLUMNS},
+    "fx": {"sheets": [SHEET_NAME_FX_FIX], "columns": FX_CASH_FLOW_COLUMNS},
+    "valuation": {"sheets": [SHEET_NAME_VALO], "columns": VALUATION_DEAL_COLUMNS},
+    "products": {"sheets": [SHEET_NAME_PRODUCTS, SHEET_NAME_FX_FIX, SHEET_NAME_FREIGHT], "columns": PRODUCT_COLUMNS},
+}
+
+
+def build_pricing_context(workbook_path, job, options=None):
+    """
+    Loads the reference sheets of a job and builds their lookup structures once.
+    options may set "base_currency" and "freight_currency" for the products job.
+    Returns the context passed to price_chunk; raises FileNotFoundError if the workbook is missing.
+    """
+    sheet_names = BATCH_JOBS[job]["sheets"]
+    store = WorkbookStore(
+        workbook_path,
+        {sheet_name: SHEET_PROCESSORS[sheet_name] for sheet_name in sheet_names},
+        [sheet_name for sheet_name in RAW_PREVIEW_SHEETS if sheet_name in sheet_names],
+    )
+    store.refresh()
+
+    def processed(sheet_name):
+        return store.sheet_frames.get(sheet_name, {}).get("processed", pd.DataFrame())
+
+    context = {"job": job, **(options or {})}
+    if SHEET_NAME_FREIGHT in sheet_names:
+        context["freight_df"] = processed(SHEET_NAME_FREIGHT)
+        context["freight_index"] = FreightRateIndex(context["freight_df"]) if not context["freight_df"].empty else None
+    if SHEET_NAME_FX_FIX in sheet_names:
+        context["fx_df"] = processed(SHEET_NAME_FX_FIX)
+        context["fx_curves"] = FxCurveStore(context["fx_df"])
+    if SHEET_NAME_VALO in sheet_names:
+        context["valo_df"] = processed(SHEET_NAME_VALO)
+        context["valo_lookup"] = ValuationLookup(context["valo_df"]) if not context["valo_df"].empty else None
+    if SHEET_NAME_PRODUCTS in sheet_names:
+        context["products_df"] = processed(SHEET_NAME_PRODUCTS)
+    return context
+
+
+def price_chunk(context, chunk):
+    """Prices one chunk of input rows with the calculator of the context's job. Returns (DataFrame, message)."""
+    job = context["job"]
+    if job == "freight":
+        return calculate_freight_costs_batch(context["freight_df"], chunk, rate_index=context["freight_index"])
+    if job == "fx":
+        return convert_currency_bulk(context["fx_df"], chunk, curve_store=context["fx_curves"])
+    if job == "valuation":
+        return calculate_valuation_batch(context["valo_df"], chunk, lookup=context["valo_lookup"])
+    if job == "products":
+        base_currency = context.get("base_currency", "USD")
+        cost_stack, message, _ = calculate_costing_products(context["products_df"], {
+            "products": chunk,
+            "base_currency": base_currency,
+            "fx_df": context["fx_df"],
+            "fx_curves": context["fx_curves"],
+            "freight_df": context["freight_df"],
+            "freight_index": context["freight_index"],
+            "freight_currency": context.get("freight_currency", base_currency),
+        })
+        return cost_stack, message
+    return None, f"Unknown batch job '{job}'."
+
+
+# Pricing context of a pool worker, built once by _init_worker
+_worker_context = None
+
+def _init_worker(workbook_path, job, options):
+    global _worker_context
+    _worker_context = build_pricing_context(workbook_path, job, options)
+
+def _price_chunk_in_worker(chunk):
+    return price_chunk(_worker_context, chunk)
+
+
+def read_input_chunks(input_path, chunk_rows):
+    """Yields the rows of a CSV or Parquet file as DataFrames of at most chunk_rows rows."""
+    if input_path.lower().endswith(".parquet"):
+        parquet_file = pq.ParquetFile(input_path)
+        for record_batch in parquet_file.iter_batches(batch_size=chunk_rows):
+            yield record_batch.to_pandas()
+    else:
+        yield from pd.read_csv(input_path, chunksize=chunk_rows)
+
+
+class ChunkWriter:
+    """
+    Appends DataFrames to a CSV or Parquet file (one row group per chunk). Rows go to a temporary
+    file that only replaces the output on close(), so a failed run never leaves a truncated output.
+    """
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.is_parquet = output_path.lower().endswith(".parquet")
+        self.tmp_path = f"{output_path}.{os.getpid()}.tmp"
+        self._parquet_writer = None
+        self._chunks_written = 0
+
+    def write(self, df):
+        if self.is_parquet:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self._parquet_writer is None:
+                self._parquet_writer = pq.ParquetWriter(self.tmp_path, table.schema)
+            elif table.schema != self._parquet_writer.schema:
+                # Chunks can infer narrower types (e.g. int64 instead of double); align them on the first chunk
+                table = table.cast(self._parquet_writer.schema)
+            self._parquet_writer.write_table(table)
+        else:
+            df.to_csv(self.tmp_path, mode="a" if self._chunks_written else "w", header=not self._chunks_written, index=False)
+        self._chunks_written += 1
+
+    def close(self):
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+        if self._chunks_written:
+            os.replace(self.tmp_path, self.output_path)
+
+    def discard(self):
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def run_batch(job, input_path, output_path, workbook_path, workers=1, chunk_rows=BATCH_CHUNK_ROWS, options=None):
+    """
+    Prices every row of input_path with the given job and writes the results to output_path.
+    workers > 1 prices the chunks in that many spawned processes; output rows keep the input order.
+    Returns (summary dictionary with "rows", "ok_rows", "chunks" and "seconds", message);
+    the summary is None if the run failed, in which case no output is written.
+    """
+    if job not in BATCH_JOBS:
+        return None, f"Unknown batch job '{job}'; choose one of: {', '.join(BATCH_JOBS)}."
+    if not os.path.exists(input_path):
+        return None, f"Input file not found: {input_path}"
+    if not os.path.exists(workbook_path):
+        return None, f"Workbook not found: {workbook_path}"
+
+    run_start = time.perf_counter()
+    summary = {"rows": 0, "ok_rows": 0, "chunks": 0, "seconds": 0.0}
+    writer = ChunkWriter(output_path)
+    executor = None
+    try:
+        if workers > 1:
+            executor = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker, initargs=(workbook_path, job, options),
+            )
+            max_in_flight = workers * BATCH_CHUNKS_IN_FLIGHT_PER_WORKER
+        else:
+            context = build_pricing_context(workbook_path, job, options)
+            logger.debug(f"Loaded the reference data of '{job}' in {time.perf_counter() - run_start:.2f}s")
+
+        def write_result(result):
+            priced, message = result
+            if priced is None:
+                raise ValueError(f"Chunk {summary['chunks'] + 1}: {message}")
+            writer.write(priced)
+            summary["chunks"] += 1
+            summary["rows"] += len(priced)
+            if 'Status' in priced.columns:
+                summary["ok_rows"] += int((priced['Status'] == "OK").sum())
+            else: # Conversions report a rate source instead of a status; a rate with an invalid amount converts nothing
+                summary["ok_rows"] += int(priced['CONVERTED AMOUNT'].notna().sum())
+            logger.debug(f"Chunk {summary['chunks']}: {message}")
+
+        # In-flight chunks are written in submission order, so the output keeps the input order
+        in_flight = collections.deque()
+        for chunk in read_input_chunks(input_path, chunk_rows):
+            if executor is None:
+                write_result(price_chunk(context, chunk))
+                continue
+            in_flight.append(executor.submit(_price_chunk_in_worker, chunk))
+            if len(in_flight) >= max_in_flight:
+                write_result(in_flight.popleft().result())
+        while in_flight:
+            write_result(in_flight.popleft().result())
+
+        if summary["chunks"] == 0:
+            raise ValueError("The input file has no rows.")
+        writer.close()
+    except (ValueError, KeyError, OSError, pa.ArrowException) as e:
+        writer.discard()
+        return None, f"Batch '{job}' failed: {e}"
+    except BaseException: # Unexpected errors (and Ctrl-C) propagate, but never leave the temporary file behind
+        writer.discard()
+        raise
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    summary["seconds"] = time.perf_counter() - run_start
+    rows_per_second = summary["rows"] / summary["seconds"] if summary["seconds"] > 0 else 0.0
+    return summary, (f"Priced {summary['ok_rows']:,} of {summary['rows']:,} rows in {summary['chunks']} chunk(s) "
+                     f"in {summary['seconds']:.2f}s ({rows_per_second:,.0f} rows/s) -> {output_path}")
@@ -0,0 +1,233 @@
+"""
+Deal blotter: every priced trade (freight quote, FX conversion, valuation) with its inputs and
+outputs, stored in an embedded SQLite file so exposures can be aggregated across deals.
+
+Aggregates run as SQL over covering indexes, so they read only the index pages they need instead
+of loading the blotter into pandas. Each thread gets its own connection; the file is opened in
+WAL mode so readers (other sessions) never wait on a writer.
+"""
+
+import datetime
+import sqlite3
+import threading
+
+import numpy as np
+import pandas as pd
+
+from .instrumentation import instrumented
+
+BLOTTER_SCHEMA_VERSION = 1
+BLOTTER_DEAL_TYPES = ['freight', 'fx', 'valuation']
+# Columns of the deals table besides the id; value_date is an ISO date, recorded_at an ISO UTC timestamp
+BLOTTER_COLUMNS = [
+    'recorded_at', 'trader', 'deal_type', 'value_date',
+    'pair', 'amount', 'rate', 'converted_amount', 'rate_source', # fx
+    'origin', 'destination', 'quantity_mt', 'freight_rate', 'total_freight', # freight
+    'buying_diff', 'costing', 'selling_diff', 'break_even', 'margin', # valuation
+    'status',
+]
+BLOTTER_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS deals (
+    id INTEGER PRIMARY KEY,
+    recorded_at TEXT NOT NULL,
+    trader TEXT,
+    deal_type TEXT NOT NULL,
+    value_date TEXT,
+    pair TEXT, amount REAL, rate REAL, converted_amount REAL, rate_source TEXT,
+    origin TEXT, destination TEXT, quantity_mt REAL, freight_rate REAL, total_freight REAL,
+    buying_diff REAL, costing REAL, selling_diff REAL, break_even REAL, margin REAL,
+    status TEXT
+);
+-- Covering indexes: the aggregate queries below are answered from the index alone
+CREATE INDEX IF NOT EXISTS deals_pair ON deals (deal_type, pair, value_date, amount, converted_amount);
+CREATE INDEX IF NOT EXISTS deals_lane ON deals (deal_type, origin, destination, freight_rate, total_freight, quantity_mt);
+CREATE INDEX IF NOT EXISTS deals_value_date ON deals (deal_type, value_date, margin);
+CREATE INDEX IF NOT EXISTS deals_trader ON deals (trader, deal_type, value_date);
+PRAGMA user_version = {BLOTTER_SCHEMA_VERSION};
+"""
+
+
+def _date_text(values):
+    """ISO dates (YYYY-MM-DD) of a Series of dates or date strings; invalid or missing dates become None."""
+    dates = pd.to_datetime(values, errors='coerce')
+    return dates.dt.strftime('%Y-%m-%d').astype(object).where(dates.notna(), None)
+
+
+class DealBlotter:
+    """Append-only store of priced deals in a SQLite file, with SQL aggregates over them."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connection().executescript(BLOTTER_SCHEMA)
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL") # WAL keeps the file consistent; only the last commits can be lost on power failure
+            self._local.connection = connection
+        return connection
+
+    def _query(self, sql, params=()):
+        return pd.read_sql_query(sql, self._connection(), params=params)
+
+    @instrumented("DealBlotter.record_deals", rows_in="deals_df")
+    def record_deals(self, deals_df, trader=None):
+        """
+        Inserts deals given as a DataFrame with 'deal_type' and any of BLOTTER_COLUMNS, in one transaction.
+        Returns the number of deals recorded.
+        """
+        if deals_df.empty:
+            return 0
+        rows = deals_df.reindex(columns=BLOTTER_COLUMNS)
+        rows['recorded_at'] = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')
+        if trader:
+            rows['trader'] = trader
+        rows['value_date'] = _date_text(rows['value_date'])
+        # sqlite3 binds Python scalars only: NaN/NaT become NULL, numpy numbers Python numbers
+        values = rows.astype(object).where(rows.notna(), None).to_numpy().tolist()
+        placeholders = ", ".join("?" for _ in BLOTTER_COLUMNS)
+        with self._connection() as connection:
+            connection.executemany(f"INSERT INTO deals ({', '.join(BLOTTER_COLUMNS)}) VALUES ({placeholders})", values)
+        return len(values)
+
+    def record_fx_conversions(self, conversions_df, trader=None):
+        """Records the rows of convert_currency_bulk output (or a one-row frame with the same columns)."""
+        value_dates = conversions_df['VALUE DATE'] if 'VALUE DATE' in conversions_df.columns else pd.Series(pd.NaT, index=conversions_df.index)
+        if 'RATE DATE' in conversions_df.columns:
+            value_dates = pd.to_datetime(value_dates, errors='coerce').fillna(pd.to_datetime(conversions_df['RATE DATE'], errors='coerce'))
+        return self.record_deals(pd.DataFrame({
+            'deal_type': 'fx',
+            'value_date': value_dates,
+            'pair': conversions_df['FX'].astype(str).str.strip().str.upper(),
+            'amount': pd.to_numeric(conversions_df['AMOUNT'], errors='coerce'),
+            'rate': conversions_df['FX RATE'],
+            'converted_amount': conversions_df['CONVERTED AMOUNT'],
+            'rate_source': conversions_df.get('RATE SOURCE'),
+            'status': np.select(
+                [pd.notna(conversions_df['CONVERTED AMOUNT']), pd.notna(conversions_df['FX RATE'])],
+                ["OK", "invalid amount"], default=conversions_df.get('RATE SOURCE', "no rate found")),
+        }), trader=trader)
+
+    def record_freight_quotes(self, quotes_df, trader=None, value_date=None):
+        """Records the rows of calculate_freight_costs_batch output (or a one-row frame with the same columns)."""
+        return self.record_deals(pd.DataFrame({
+            'deal_type': 'freight',
+            'value_date': value_date or datetime.date.today(),
+            'origin': quotes_df['Origin'],
+            'destination': quotes_df['Destination'],
+            'quantity_mt': quotes_df['QuantityMT'],
+            'freight_rate': quotes_df['FreightRate'],
+            'total_freight': quotes_df['TotalFreight'],
+            'status': quotes_df['Status'],
+        }), trader=trader)
+
+    def record_valuations(self, valuations_df, trader=None, value_date=None):
+        """Records the rows of calculate_valuation_batch output (or a one-row frame with the same columns)."""
+        return self.record_deals(pd.DataFrame({
+            'deal_type': 'valuation',
+            'value_date': value_date or datetime.date.today(),
+            'buying_diff': valuations_df['Buying Diff'],
+            'costing': valuations_df['Costings'],
+            'selling_diff': valuations_df['Selling Diff'],
+            'break_even': valuations_df['Break Even'],
+            'margin': valuations_df['Margin'],
+            'status': valuations_df['Status'] if 'Status' in valuations_df.columns else "OK",
+        }), trader=trader)
+
+    def deal_count(self):
+        return self._connection().execute("SELECT COUNT(*) FROM deals").fetchone()[0]
+
+    def recent_deals(self, limit=20, trader=None):
+        """The latest deals, newest first."""
+        trader_filter = "WHERE trader = ?" if trader else ""
+        return self._query(f"SELECT * FROM deals {trader_filter} ORDER BY id DESC LIMIT ?", ((trader,) if trader else ()) + (limit,))
+
+    @staticmethod
+    def _filters(trader, start_date, end_date):
+        clauses, params = [], []
+        if trader:
+            clauses.append("trader = ?")
+            params.append(trader)
+        if start_date is not None:
+            clauses.append("value_date >= ?")
+            params.append(pd.Timestamp(start_date).strftime('%Y-%m-%d'))
+        if end_date is not None:
+            clauses.append("value_date <= ?")
+            params.append(pd.Timestamp(end_date).strftime('%Y-%m-%d'))
+        return "".join(f" AND {clause}" for clause in clauses), params
+
+    @instrumented("DealBlotter.net_exposure_by_currency")
+    def net_exposure_by_currency(self, trader=None, start_date=None, end_date=None):
+        """
+        Net amount per currency over the recorded FX conversions: a conversion pays the amount in the
+        pair's base currency and receives the converted amount in its quote currency. Pairs are summed
+        first (one pass over the pair index), then split into their two currencies.
+        """
+        filters, params = self._filters(trader, start_date, end_date)
+        return self._query(f"""
+            WITH by_pair AS (
+                SELECT pair, SUM(amount) AS paid, SUM(converted_amount) AS received, COUNT(*) AS deals
+                FROM deals
+                WHERE deal_type = 'fx' AND length(pair) = 6 AND converted_amount IS NOT NULL{filters}
+                GROUP BY pair
+            )
+            SELECT currency, SUM(net_amount) AS net_amount, SUM(deals) AS deals FROM (
+                SELECT substr(pair, 1, 3) AS currency, -paid AS net_amount, deals FROM by_pair
+                UNION ALL
+                SELECT substr(pair, 4, 3), received, deals FROM by_pair
+            )
+            GROUP BY currency
+            ORDER BY currency
+        """, params)
+
+    @instrumented("DealBlotter.fx_exposures_by_value_date")
+    def fx_exposures_by_value_date(self, trader=None, start_date=None, end_date=None):
+        """
+        Open currency exposures of the recorded FX conversions per value date, in the columns the
+        hedge optimizer reads ('Currency', 'VALUE DATE', 'AMOUNT'): the same legs as
+        net_exposure_by_currency, summed per pair and value date first.
+        """
+        filters, params = self._filters(trader, start_date, end_date)
+        return self._query(f"""
+            WITH by_pair AS (
+                SELECT pair, value_date, SUM(amount) AS paid, SUM(converted_amount) AS received
+                FROM deals
+                WHERE deal_type = 'fx' AND length(pair) = 6 AND converted_amount IS NOT NULL{filters}
+                GROUP BY pair, value_date
+            )
+            SELECT currency AS "Currency", value_date AS "VALUE DATE", SUM(net_amount) AS "AMOUNT" FROM (
+                SELECT substr(pair, 1, 3) AS currency, value_date, -paid AS net_amount FROM by_pair
+                UNION ALL
+                SELECT substr(pair, 4, 3), value_date, received FROM by_pair
+            )
+            GROUP BY currency, value_date
+            ORDER BY currency, value_date
+        """, params)
+
+    @instrumented("DealBlotter.average_freight_by_lane")
+    def average_freight_by_lane(self, trader=None, start_date=None, end_date=None):
+        """Deals, average rate per MT, total quantity and total freight per lane over the priced freight quotes."""
+        filters, params = self._filters(trader, start_date, end_date)
+        return self._query(f"""
+            SELECT origin, destination, COUNT(*) AS deals, AVG(freight_rate) AS avg_freight_rate,
+                   SUM(quantity_mt) AS quantity_mt, SUM(total_freight) AS total_freight
+            FROM deals
+            WHERE deal_type = 'freight' AND freight_rate IS NOT NULL{filters}
+            GROUP BY origin, destination
+            ORDER BY total_freight DESC
+        """, params)
+
+    @instrumented("DealBlotter.margin_by_month")
+    def margin_by_month(self, trader=None, start_date=None, end_date=None):
+        """Deals, average and total margin per MT of the recorded valuations, by month of their value date."""
+        filters, params = self._filters(trader, start_date, end_date)
+        return self._query(f"""
+            SELECT substr(value_date, 1, 7) AS month, COUNT(*) AS deals, AVG(margin) AS avg_margin, SUM(margin) AS total_margin
+            FROM deals
+            WHERE deal_type = 'valuation' AND value_date IS NOT NULL AND margin IS NOT NULL{filters}
+            GROUP BY month
+            ORDER BY month
+        """, params)
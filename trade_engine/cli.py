@@ -0,0 +1,83 @@
+"""
+Command line entry point of the engine:
+
+    python -m trade_engine price --job freight --input legs.csv --output quotes.parquet --workers 4
+    python -m trade_engine serve --port 8765
+
+Jobs and their input columns:
+    freight    Origin, Destination, QuantityMT
+    fx         FX, VALUE DATE, AMOUNT
+    valuation  Buying Diff, Costings
+    products   Product, QuantityMT, BeanCost, BeanCurrency, Origin, Destination
+
+serve runs the HTTP pricing service (see trade_engine.service) until interrupted.
+"""
+
+import argparse
+import logging
+import os
+import sys
+
+from .batch import BATCH_CHUNK_ROWS, BATCH_JOBS, run_batch
+from .service import (
+    SERVICE_BATCH_WINDOW_SECONDS,
+    SERVICE_DEFAULT_HOST,
+    SERVICE_DEFAULT_PORT,
+    SERVICE_MAX_BATCH_ROWS,
+    run_service,
+)
+from .workbook import DEFAULT_WORKBOOK_PATH
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m trade_engine", description="Cocoa trading sheet calculations without the UI.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    price = subparsers.add_parser("price", help="Price a CSV or Parquet file of deals/legs/cash flows with the workbook's reference data.")
+    price.add_argument("--job", required=True, choices=list(BATCH_JOBS), help="Calculation applied to every input row.")
+    price.add_argument("--input", required=True, help="Input file (.csv or .parquet).")
+    price.add_argument("--output", required=True, help="Output file (.csv or .parquet), written chunk by chunk.")
+    price.add_argument("--workbook", default=DEFAULT_WORKBOOK_PATH, help="Trading workbook with the reference sheets.")
+    price.add_argument("--workers", type=int, default=1, help="Worker processes; 0 uses every CPU core.")
+    price.add_argument("--chunk-rows", type=int, default=BATCH_CHUNK_ROWS, help="Input rows priced per chunk.")
+    price.add_argument("--base-currency", default="USD", help="Result currency of the products job.")
+    price.add_argument("--freight-currency", default=None, help="Currency of the freight table rates (products job; default: base currency).")
+    price.add_argument("-v", "--verbose", action="store_true", help="Also log per-chunk timings.")
+
+    serve = subparsers.add_parser("serve", help="Serve freight quotes, FX conversions and valuations over HTTP/JSON.")
+    serve.add_argument("--workbook", default=DEFAULT_WORKBOOK_PATH, help="Trading workbook with the reference sheets.")
+    serve.add_argument("--host", default=SERVICE_DEFAULT_HOST, help="Interface to listen on.")
+    serve.add_argument("--port", type=int, default=SERVICE_DEFAULT_PORT, help="Port to listen on.")
+    serve.add_argument("--max-batch-rows", type=int, default=SERVICE_MAX_BATCH_ROWS, help="Rows priced per micro-batch.")
+    serve.add_argument("--batch-window-ms", type=float, default=SERVICE_BATCH_WINDOW_SECONDS * 1000,
+                       help="How long a micro-batch waits for concurrent requests (0 prices whatever is queued).")
+    serve.add_argument("-v", "--verbose", action="store_true", help="Also log debug messages.")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format="%(levelname)s %(name)s: %(message)s")
+
+    if args.command == "serve":
+        if args.max_batch_rows < 1 or args.batch_window_ms < 0:
+            print("--max-batch-rows must be at least 1 and --batch-window-ms at least 0.", file=sys.stderr)
+            return 2
+        if not os.path.exists(args.workbook):
+            print(f"Workbook not found: {args.workbook}", file=sys.stderr)
+            return 1
+        run_service(args.workbook, args.host, args.port, args.max_batch_rows, args.batch_window_ms / 1000)
+        return 0
+
+    if args.chunk_rows < 1:
+        print("--chunk-rows must be at least 1.", file=sys.stderr)
+        return 2
+    workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+    options = {"base_currency": args.base_currency, "freight_currency": args.freight_currency or args.base_currency}
+
+    summary, message = run_batch(args.job, args.input, args.output, args.workbook, workers=workers, chunk_rows=args.chunk_rows, options=options)
+    if summary is None:
+        print(message, file=sys.stderr)
+        return 1
+    print(message)
+    return 0
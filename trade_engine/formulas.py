@@ -0,0 +1,990 @@
+"""
+Formula engine for the trading workbook.
+
+Extracts the cell formulas from the xlsx worksheets, compiles each one to a Python closure
+and links them into a dependency graph, so the workbook's own calculations (Valo Ori & Dest
+margins, Costing Beans totals, ...) can be recomputed without Excel. A what-if change only
+re-evaluates the cells downstream of the changed inputs, in dependency order.
+
+Formulas the engine cannot evaluate (add-in functions such as the ICE feed, external links,
+spilled dynamic arrays) keep the value Excel last saved and act as inputs for the rest of the graph.
+"""
+
+import bisect
+import datetime
+import graphlib
+import math
+import re
+import time
+import zipfile
+import xml.etree.ElementTree as ET
+
+import numpy as np
+from openpyxl.formula.tokenizer import Token, Tokenizer
+from openpyxl.formula.translate import Translator
+from openpyxl.utils.cell import column_index_from_string, get_column_letter
+
+from .instrumentation import instrumented
+from .workbook import XLSX_NS, read_shared_strings, workbook_sheet_parts
+
+CELL_TAG = f"{{{XLSX_NS['main']}}}c"
+EXCEL_EPOCH = datetime.date(1899, 12, 30) # Serial day 0 of the 1900 date system
+
+CELL_REFERENCE_PATTERN = re.compile(r"^\$?([A-Z]{1,3})\$?(\d+)(?::\$?([A-Z]{1,3})\$?(\d+))?$")
+COLUMN_REFERENCE_PATTERN = re.compile(r"^\$?([A-Z]{1,3}):\$?([A-Z]{1,3})$")
+REFERENCE_PART_PATTERN = re.compile(r"(\$?)([A-Z]{1,3})(?:(\$?)(\d+))?")
+
+
+class ExcelError:
+    """An Excel error value such as #N/A or #DIV/0!; propagates through calculations like in Excel."""
+    __slots__ = ("code",)
+
+    def __init__(self, code):
+        self.code = code
+
+    def __eq__(self, other):
+        return isinstance(other, ExcelError) and other.code == self.code
+
+    def __hash__(self):
+        return hash(self.code)
+
+    def __repr__(self):
+        return self.code
+
+
+ERROR_NA = ExcelError("#N/A")
+ERROR_VALUE = ExcelError("#VALUE!")
+ERROR_DIV0 = ExcelError("#DIV/0!")
+ERROR_REF = ExcelError("#REF!")
+ERROR_NUM = ExcelError("#NUM!")
+
+
+class UnsupportedFormula(Exception):
+    """Raised while compiling a formula the engine cannot evaluate."""
+
+
+def cell_key(sheet_name, address):
+    """Returns the (sheet, row, column) key of an A1 address such as 'G2' or '$G$2'."""
+    match = CELL_REFERENCE_PATTERN.match(address.upper())
+    if match is None or match.group(3):
+        raise ValueError(f"Not a single cell address: {address}")
+    return sheet_name, int(match.group(2)), column_index_from_string(match.group(1))
+
+
+def key_address(key):
+    """Returns the A1 address of a (sheet, row, column) key."""
+    return f"{get_column_letter(key[2])}{key[1]}"
+
+
+# --- Workbook extraction ---
+
+def _defined_names(archive, sheet_names):
+    """Returns {(scope sheet or None, NAME): reference text} from workbook.xml."""
+    workbook_xml = ET.fromstring(archive.read("xl/workbook.xml"))
+    names = {}
+    for defined_name in workbook_xml.findall("main:definedNames/main:definedName", XLSX_NS):
+        local_sheet_id = defined_name.get("localSheetId")
+        scope = sheet_names[int(local_sheet_id)] if local_sheet_id is not None else None
+        names[(scope, defined_name.get("name").upper())] = defined_name.text or ""
+    return names
+
+
+V_TAG = f"{{{XLSX_NS['main']}}}v"
+F_TAG = f"{{{XLSX_NS['main']}}}f"
+IS_TAG = f"{{{XLSX_NS['main']}}}is"
+
+def _cell_value(cell_type, value_node, inline_node, shared_strings):
+    """Decodes the cached value of a cell from its type attribute and <v> / <is> children."""
+    if cell_type == "inlineStr":
+        return "".join(t.text or "" for t in inline_node.iter(f"{{{XLSX_NS['main']}}}t")) if inline_node is not None else None
+    if value_node is None or value_node.text is None:
+        return None
+    text = value_node.text
+    if cell_type == "s":
+        return shared_strings[int(text)]
+    if cell_type == "str":
+        return text
+    if cell_type == "b":
+        return text == "1"
+    if cell_type == "e":
+        return ExcelError(text)
+    return float(text)
+
+
+def read_workbook_cells(file_path):
+    """
+    Reads every worksheet of an xlsx file in one pass over the zip archive.
+    Returns (sheet_names, values, formulas, defined_names) where values maps
+    (sheet, row, column) to the cached value and formulas maps the same keys to
+    (formula text without '=', is_array, is_spilled_array, (row offset, column offset)).
+    Cells filled from a shared formula carry the master's text and their offset from it,
+    so the master is parsed once and its references are shifted per cell.
+    """
+    values, formulas = {}, {}
+    with zipfile.ZipFile(file_path) as archive:
+        parts = workbook_sheet_parts(archive)
+        sheet_names = list(parts)
+        shared_strings = read_shared_strings(archive)
+        defined_names = _defined_names(archive, sheet_names)
+
+        for sheet_name, part in parts.items():
+            shared_masters = {}
+            with archive.open(part) as sheet_xml:
+                for _, element in ET.iterparse(sheet_xml):
+                    if element.tag != CELL_TAG:
+                        continue
+                    value_node = formula_node = inline_node = None
+                    for child in element:
+                        if child.tag == V_TAG:
+                            value_node = child
+                        elif child.tag == F_TAG:
+                            formula_node = child
+                        elif child.tag == IS_TAG:
+                            inline_node = child
+                    address = element.get("r")
+                    key = cell_key(sheet_name, address)
+                    value = _cell_value(element.get("t", "n"), value_node, inline_node, shared_strings)
+                    if value is not None:
+                        values[key] = value
+
+                    if formula_node is not None:
+                        formula_type = formula_node.get("t")
+                        text, offset = formula_node.text, (0, 0)
+                        if formula_type == "shared":
+                            shared_index = formula_node.get("si")
+                            if text:
+                                shared_masters[shared_index] = (text, key)
+                            elif shared_index in shared_masters:
+                                text, master_key = shared_masters[shared_index]
+                                offset = (key[1] - master_key[1], key[2] - master_key[2])
+                        if text:
+                            # Multi-cell array formulas spill, which the engine does not model
+                            is_spilled_array = formula_type == "array" and ":" in (formula_node.get("ref") or "")
+                            formulas[key] = (text, formula_type == "array", is_spilled_array, offset)
+                    element.clear()
+    return sheet_names, values, formulas, defined_names
+
+
+def shift_reference(text, row_offset, column_offset):
+    """Moves the relative parts of an A1 reference (e.g. 'IVC!B20', '$A2:B$3', 'A:B') by an offset; names are kept."""
+    if row_offset == 0 and column_offset == 0:
+        return text
+    prefix, reference = text.rsplit("!", 1) if "!" in text else (None, text)
+    if not (CELL_REFERENCE_PATTERN.match(reference.upper()) or COLUMN_REFERENCE_PATTERN.match(reference.upper())):
+        return text
+
+    def shift_column(column_anchor, column):
+        if column_anchor:
+            return column_anchor + column
+        return get_column_letter(column_index_from_string(column) + column_offset)
+
+    def shift_part(match):
+        column_anchor, column, row_anchor, row = match.groups()
+        shifted = shift_column(column_anchor, column)
+        if row:
+            shifted += row_anchor + (row if row_anchor else str(int(row) + row_offset))
+        return shifted
+
+    shifted = REFERENCE_PART_PATTERN.sub(shift_part, reference.upper())
+    return f"{prefix}!{shifted}" if prefix is not None else shifted
+
+
+def shift_formula_tree(node, row_offset, column_offset):
+    """Copies a parsed formula with its references shifted, as when Excel fills a shared formula."""
+    kind = node[0]
+    if kind == "ref":
+        return ("ref", shift_reference(node[1], row_offset, column_offset))
+    if kind == "binop":
+        return ("binop", node[1], shift_formula_tree(node[2], row_offset, column_offset), shift_formula_tree(node[3], row_offset, column_offset))
+    if kind == "call":
+        return ("call", node[1], [shift_formula_tree(arg, row_offset, column_offset) for arg in node[2]])
+    return node
+
+
+# --- Values and coercion ---
+
+class RangeReference:
+    """A rectangular block of cells, read lazily from the current cell values."""
+    __slots__ = ("sheet", "row1", "col1", "row2", "col2", "get")
+
+    def __init__(self, sheet, row1, col1, row2, col2, get):
+        self.sheet, self.row1, self.col1, self.row2, self.col2, self.get = sheet, row1, col1, row2, col2, get
+
+    @property
+    def shape(self):
+        return self.row2 - self.row1 + 1, self.col2 - self.col1 + 1
+
+    def cell(self, row_offset, col_offset):
+        return self.get((self.sheet, self.row1 + row_offset, self.col1 + col_offset))
+
+    def column(self, col_offset):
+        return [self.cell(row_offset, col_offset) for row_offset in range(self.shape[0])]
+
+    def row(self, row_offset):
+        return [self.cell(row_offset, col_offset) for col_offset in range(self.shape[1])]
+
+    def to_array(self):
+        rows, cols = self.shape
+        array = np.empty((rows, cols), dtype=object)
+        for row_offset in range(rows):
+            for col_offset in range(cols):
+                array[row_offset, col_offset] = self.cell(row_offset, col_offset)
+        return array
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def to_number(value):
+    if isinstance(value, ExcelError):
+        return value
+    if value is None:
+        return 0.0
+    if isinstance(value, bool):
+        return float(value)
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(str(value).strip())
+    except ValueError:
+        return ERROR_VALUE
+
+
+def to_text(value):
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, float):
+        return str(int(value)) if value.is_integer() else f"{value:.15g}"
+    return str(value)
+
+
+def to_bool(value):
+    if isinstance(value, ExcelError):
+        return value
+    if isinstance(value, str):
+        if value.upper() in ("TRUE", "FALSE"):
+            return value.upper() == "TRUE"
+        return ERROR_VALUE
+    return bool(value)
+
+
+def scalar(value):
+    """Reduces a range or array to its top-left value (Excel's single-cell result)."""
+    if isinstance(value, RangeReference):
+        return value.cell(0, 0)
+    if isinstance(value, np.ndarray):
+        return value.flat[0] if value.size else None
+    return value
+
+
+def as_array(value):
+    if isinstance(value, RangeReference):
+        return value.to_array()
+    if isinstance(value, np.ndarray):
+        return value
+    return np.array([[value]], dtype=object)
+
+
+def flatten_values(args):
+    """Yields every value of the arguments, expanding ranges and arrays."""
+    for arg in args:
+        if isinstance(arg, (RangeReference, np.ndarray)):
+            yield from as_array(arg).flat
+        else:
+            yield arg
+
+
+def _comparison_key(value):
+    # Excel orders numbers < text < booleans; text compares case-insensitively
+    if isinstance(value, bool):
+        return 2, value
+    if isinstance(value, str):
+        return 1, value.lower()
+    return 0, value
+
+
+def compare_values(left, right, op):
+    if isinstance(left, ExcelError):
+        return left
+    if isinstance(right, ExcelError):
+        return right
+    # Blank cells take the type of the other side
+    if left is None:
+        left = "" if isinstance(right, str) else False if isinstance(right, bool) else 0.0
+    if right is None:
+        right = "" if isinstance(left, str) else False if isinstance(left, bool) else 0.0
+    left_key, right_key = _comparison_key(left), _comparison_key(right)
+    if op == "=":
+        return left_key == right_key
+    if op == "<>":
+        return left_key != right_key
+    if op == "<":
+        return left_key < right_key
+    if op == ">":
+        return left_key > right_key
+    if op == "<=":
+        return left_key <= right_key
+    return left_key >= right_key
+
+
+def _arithmetic(op):
+    def apply(left, right):
+        left, right = to_number(left), to_number(right)
+        if isinstance(left, ExcelError):
+            return left
+        if isinstance(right, ExcelError):
+            return right
+        if op == "+":
+            return left + right
+        if op == "-":
+            return left - right
+        if op == "*":
+            return left * right
+        if op == "/":
+            return ERROR_DIV0 if right == 0 else left / right
+        try:
+            result = left ** right
+        except (OverflowError, ZeroDivisionError):
+            return ERROR_NUM
+        return ERROR_NUM if isinstance(result, complex) else result
+    return apply
+
+
+def _concatenate(left, right):
+    if isinstance(left, ExcelError):
+        return left
+    if isinstance(right, ExcelError):
+        return right
+    return to_text(left) + to_text(right)
+
+
+BINARY_OPERATORS = {op: _arithmetic(op) for op in ("+", "-", "*", "/", "^")}
+BINARY_OPERATORS["&"] = _concatenate
+for _comparison in ("=", "<>", "<", ">", "<=", ">="):
+    BINARY_OPERATORS[_comparison] = (lambda op: lambda left, right: compare_values(left, right, op))(_comparison)
+
+# Element-wise versions for array formulas such as MIN(IF(S58:S603<>0,T58:T603))
+ARRAY_OPERATORS = {op: np.frompyfunc(function, 2, 1) for op, function in BINARY_OPERATORS.items()}
+
+
+def apply_binary(op, left, right):
+    if isinstance(left, (RangeReference, np.ndarray)) or isinstance(right, (RangeReference, np.ndarray)):
+        return ARRAY_OPERATORS[op](as_array(left), as_array(right))
+    return BINARY_OPERATORS[op](left, right)
+
+
+# --- Worksheet functions ---
+
+def _numbers(args):
+    """Numbers for aggregate functions: cells in ranges only count when numeric, direct arguments are coerced."""
+    numbers = []
+    for arg in args:
+        if isinstance(arg, (RangeReference, np.ndarray)):
+            for value in as_array(arg).flat:
+                if isinstance(value, ExcelError):
+                    return value
+                if is_number(value):
+                    numbers.append(value)
+        else:
+            value = to_number(arg)
+            if isinstance(value, ExcelError):
+                return value
+            numbers.append(value)
+    return numbers
+
+
+def fn_sum(*args):
+    numbers = _numbers(args)
+    return numbers if isinstance(numbers, ExcelError) else float(math.fsum(numbers))
+
+
+def fn_min(*args):
+    numbers = _numbers(args)
+    return numbers if isinstance(numbers, ExcelError) else (min(numbers) if numbers else 0.0)
+
+
+def fn_max(*args):
+    numbers = _numbers(args)
+    return numbers if isinstance(numbers, ExcelError) else (max(numbers) if numbers else 0.0)
+
+
+def fn_average(*args):
+    numbers = _numbers(args)
+    if isinstance(numbers, ExcelError):
+        return numbers
+    return math.fsum(numbers) / len(numbers) if numbers else ERROR_DIV0
+
+
+def fn_count(*args):
+    return float(sum(1 for value in flatten_values(args) if is_number(value)))
+
+
+def fn_abs(value):
+    value = to_number(scalar(value))
+    return value if isinstance(value, ExcelError) else abs(value)
+
+
+def fn_round(value, digits=0.0):
+    value, digits = to_number(scalar(value)), to_number(scalar(digits))
+    if isinstance(value, ExcelError):
+        return value
+    if isinstance(digits, ExcelError):
+        return digits
+    # Excel rounds halves away from zero
+    factor = 10 ** int(digits)
+    return math.copysign(math.floor(abs(value) * factor + 0.5) / factor, value)
+
+
+def fn_and(*args):
+    values = [to_bool(value) for value in flatten_values(args) if value is not None]
+    errors = [value for value in values if isinstance(value, ExcelError)]
+    return errors[0] if errors else all(values)
+
+
+def fn_or(*args):
+    values = [to_bool(value) for value in flatten_values(args) if value is not None]
+    errors = [value for value in values if isinstance(value, ExcelError)]
+    return errors[0] if errors else any(values)
+
+
+def fn_not(value):
+    value = to_bool(scalar(value))
+    return value if isinstance(value, ExcelError) else not value
+
+
+def fn_isnumber(value):
+    return is_number(scalar(value))
+
+
+def fn_isblank(value):
+    return scalar(value) is None
+
+
+def fn_iserror(value):
+    return isinstance(scalar(value), ExcelError)
+
+
+def fn_today():
+    return float((datetime.date.today() - EXCEL_EPOCH).days)
+
+
+def _lookup_position(lookup_value, candidates, approximate):
+    """0-based position of lookup_value in candidates, or None (exact or sorted-approximate match)."""
+    if isinstance(lookup_value, str):
+        lookup_value = lookup_value.lower()
+        candidates = [candidate.lower() if isinstance(candidate, str) else candidate for candidate in candidates]
+    if not approximate:
+        for position, candidate in enumerate(candidates):
+            if candidate == lookup_value and type(candidate) is type(lookup_value) or (
+                is_number(candidate) and is_number(lookup_value) and candidate == lookup_value
+            ):
+                return position
+        return None
+    # Approximate match: last value <= lookup_value in an ascending list of the same type
+    best = None
+    for position, candidate in enumerate(candidates):
+        if candidate is None or isinstance(candidate, ExcelError):
+            continue
+        if _comparison_key(candidate)[0] != _comparison_key(lookup_value)[0]:
+            continue
+        if _comparison_key(candidate) <= _comparison_key(lookup_value):
+            best = position
+        else:
+            break
+    return best
+
+
+def fn_vlookup(lookup_value, table, column_index, approximate=True):
+    lookup_value, column_index = scalar(lookup_value), to_number(scalar(column_index))
+    if isinstance(lookup_value, ExcelError):
+        return lookup_value
+    if isinstance(column_index, ExcelError):
+        return column_index
+    if not isinstance(table, RangeReference):
+        return ERROR_VALUE
+    column_offset = int(column_index) - 1
+    if column_offset < 0 or column_offset >= table.shape[1]:
+        return ERROR_REF
+    position = _lookup_position(lookup_value, table.column(0), to_bool(scalar(approximate)) is True)
+    return ERROR_NA if position is None else table.cell(position, column_offset)
+
+
+def fn_hlookup(lookup_value, table, row_index, approximate=True):
+    lookup_value, row_index = scalar(lookup_value), to_number(scalar(row_index))
+    if isinstance(lookup_value, ExcelError):
+        return lookup_value
+    if isinstance(row_index, ExcelError):
+        return row_index
+    if not isinstance(table, RangeReference):
+        return ERROR_VALUE
+    row_offset = int(row_index) - 1
+    if row_offset < 0 or row_offset >= table.shape[0]:
+        return ERROR_REF
+    position = _lookup_position(lookup_value, table.row(0), to_bool(scalar(approximate)) is True)
+    return ERROR_NA if position is None else table.cell(row_offset, position)
+
+
+def fn_match(lookup_value, lookup_range, match_type=1.0):
+    lookup_value, match_type = scalar(lookup_value), to_number(scalar(match_type))
+    if isinstance(lookup_value, ExcelError):
+        return lookup_value
+    if isinstance(match_type, ExcelError):
+        return match_type
+    candidates = list(as_array(lookup_range).flat)
+    if match_type == -1:
+        return ERROR_NA # Descending approximate match is not used by the workbook
+    position = _lookup_position(lookup_value, candidates, match_type == 1)
+    return ERROR_NA if position is None else float(position + 1)
+
+
+def fn_index(array, row_number, column_number=None):
+    row_number = to_number(scalar(row_number))
+    column_number = to_number(scalar(column_number)) if column_number is not None else 0.0
+    if isinstance(row_number, ExcelError):
+        return row_number
+    if isinstance(column_number, ExcelError):
+        return column_number
+    values = as_array(array)
+    rows, cols = values.shape
+    # A single row or column can be indexed by one number
+    if column_number == 0 and rows == 1:
+        row_number, column_number = 1.0, row_number
+    row_offset, column_offset = int(row_number) - 1, max(int(column_number), 1) - 1
+    if not (0 <= row_offset < rows and 0 <= column_offset < cols):
+        return ERROR_REF
+    return values[row_offset, column_offset]
+
+
+def fn_if(condition, value_if_true=lambda: True, value_if_false=lambda: False):
+    """IF with lazily evaluated branches; element-wise when the condition is an array."""
+    condition = condition()
+    if isinstance(condition, (RangeReference, np.ndarray)):
+        conditions = as_array(condition)
+        if_true, if_false = as_array(value_if_true()), as_array(value_if_false())
+        choose = np.frompyfunc(lambda c, t, f: c if isinstance(c, ExcelError) else (t if to_bool(c) is True else f), 3, 1)
+        return choose(conditions, if_true, if_false)
+    condition = to_bool(condition)
+    if isinstance(condition, ExcelError):
+        return condition
+    return value_if_true() if condition else value_if_false()
+
+
+def fn_iferror(value, value_if_error):
+    result = value()
+    return value_if_error() if isinstance(scalar(result), ExcelError) else result
+
+
+def fn_ifna(value, value_if_na):
+    result = value()
+    return value_if_na() if scalar(result) == ERROR_NA else result
+
+
+def fn_switch(expression, *cases):
+    """SWITCH(expression, value1, result1, ..., [default]) with lazily evaluated arguments."""
+    expression = scalar(expression())
+    if isinstance(expression, ExcelError):
+        return expression
+    for position in range(0, len(cases) - 1, 2):
+        if compare_values(expression, scalar(cases[position]()), "=") is True:
+            return cases[position + 1]()
+    return cases[-1]() if len(cases) % 2 else ERROR_NA
+
+
+WORKSHEET_FUNCTIONS = {
+    "SUM": fn_sum, "MIN": fn_min, "MAX": fn_max, "AVERAGE": fn_average, "COUNT": fn_count,
+    "ABS": fn_abs, "ROUND": fn_round, "AND": fn_and, "OR": fn_or, "NOT": fn_not,
+    "ISNUMBER": fn_isnumber, "ISBLANK": fn_isblank, "ISERROR": fn_iserror, "TODAY": fn_today,
+    "VLOOKUP": fn_vlookup, "HLOOKUP": fn_hlookup, "MATCH": fn_match, "INDEX": fn_index,
+}
+# Functions that receive their arguments as thunks so only the branch taken is evaluated
+LAZY_WORKSHEET_FUNCTIONS = {"IF": fn_if, "IFERROR": fn_iferror, "IFNA": fn_ifna, "SWITCH": fn_switch}
+VOLATILE_FUNCTIONS = {"TODAY"}
+
+
+# --- Parsing and compilation ---
+
+OPERATOR_PRECEDENCE = {
+    "=": 10, "<>": 10, "<": 10, ">": 10, "<=": 10, ">=": 10,
+    "&": 20, "+": 30, "-": 30, "*": 40, "/": 40, "^": 50,
+}
+PREFIX_PRECEDENCE = 60
+
+
+class FormulaParser:
+    """Recursive-descent (precedence climbing) parser over openpyxl's formula tokens."""
+
+    def __init__(self, formula):
+        tokenizer = Tokenizer(f"={formula}")
+        self.tokens = [token for token in tokenizer.items if token.type != Token.WSPACE]
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def parse(self):
+        node = self.expression(0)
+        if self.peek() is not None:
+            raise UnsupportedFormula(f"Unexpected token {self.peek().value!r}")
+        return node
+
+    def expression(self, min_precedence):
+        node = self.prefix()
+        while True:
+            token = self.peek()
+            if token is None:
+                return node
+            if token.type == Token.OP_POST:
+                self.take()
+                node = ("binop", "/", node, ("const", 100.0))
+            elif token.type == Token.OP_IN and token.value in OPERATOR_PRECEDENCE:
+                precedence = OPERATOR_PRECEDENCE[token.value]
+                if precedence <= min_precedence:
+                    return node
+                self.take()
+                node = ("binop", token.value, node, self.expression(precedence))
+            elif token.type == Token.OP_IN:
+                raise UnsupportedFormula(f"Operator {token.value!r}")
+            else:
+                return node
+
+    def prefix(self):
+        token = self.take()
+        if token is None:
+            raise UnsupportedFormula("Unexpected end of formula")
+        if token.type == Token.OP_PRE:
+            operand = self.expression(PREFIX_PRECEDENCE)
+            return ("binop", "-", ("const", 0.0), operand) if token.value == "-" else operand
+        if token.type == Token.PAREN and token.subtype == Token.OPEN:
+            node = self.expression(0)
+            closing = self.take()
+            if closing is None or closing.type != Token.PAREN:
+                raise UnsupportedFormula("Unbalanced parentheses")
+            return node
+        if token.type == Token.FUNC and token.subtype == Token.OPEN:
+            return self.function_call(token.value[:-1])
+        if token.type == Token.OPERAND:
+            return self.operand(token)
+        raise UnsupportedFormula(f"Unexpected token {token.value!r}")
+
+    def function_call(self, name):
+        name = name.upper()
+        for prefix in ("_XLFN.", "_XLWS."):
+            if name.startswith(prefix):
+                name = name[len(prefix):]
+        args = []
+        while True:
+            token = self.peek()
+            if token is None:
+                raise UnsupportedFormula(f"Unclosed call to {name}")
+            if token.type == Token.FUNC and token.subtype == Token.CLOSE:
+                self.take()
+                if args:
+                    args.append(("blank",)) # Trailing empty argument, e.g. IF(A1,1,)
+                return ("call", name, args)
+            if token.type == Token.SEP and token.subtype == Token.ARG:
+                self.take()
+                args.append(("blank",))
+                continue
+            args.append(self.expression(0))
+            separator = self.take()
+            if separator is None:
+                raise UnsupportedFormula(f"Unclosed call to {name}")
+            if separator.type == Token.FUNC and separator.subtype == Token.CLOSE:
+                return ("call", name, args)
+            if separator.type != Token.SEP or separator.subtype != Token.ARG:
+                raise UnsupportedFormula(f"Unexpected token {separator.value!r} in {name}")
+
+    def operand(self, token):
+        if token.subtype == Token.NUMBER:
+            return ("const", float(token.value))
+        if token.subtype == Token.TEXT:
+            return ("const", token.value[1:-1].replace('""', '"'))
+        if token.subtype == Token.LOGICAL:
+            return ("const", token.value.upper() == "TRUE")
+        if token.subtype == Token.ERROR:
+            return ("const", ExcelError(token.value.upper()))
+        return ("ref", token.value)
+
+
+class WorkbookFormulaEngine:
+    """
+    Holds the workbook's cell values and compiled formulas with their dependency graph.
+    Built once per workbook version; the base values are never mutated, so one engine can be
+    shared by every session and what-if scenarios are evaluated on top of it.
+    """
+
+    def __init__(self, sheet_names, cached_values, formulas, defined_names):
+        self.sheet_names = sheet_names
+        self.cached_values = cached_values
+        self.defined_names = defined_names
+        self.formulas = formulas
+        self.sheet_max_rows = {}
+        for sheet_name, row, _ in list(cached_values) + list(formulas):
+            self.sheet_max_rows[sheet_name] = max(self.sheet_max_rows.get(sheet_name, 0), row)
+
+        # Compile every formula; the ones that fail keep their cached value.
+        # Each distinct formula text (including shared formula masters) is parsed once.
+        self.compiled = {}
+        self.unsupported = {}
+        self.precedent_cells = {}
+        self.precedent_ranges = {}
+        self.volatile = set()
+        parsed = {}
+        for key, (text, _, is_spilled_array, offset) in formulas.items():
+            try:
+                if is_spilled_array:
+                    raise UnsupportedFormula("Spilled array formula")
+                if text not in parsed:
+                    try:
+                        parsed[text] = FormulaParser(text).parse()
+                    except UnsupportedFormula as exc:
+                        parsed[text] = exc
+                tree = parsed[text]
+                if isinstance(tree, UnsupportedFormula):
+                    raise tree
+                cells, ranges, functions = set(), [], set()
+                self.compiled[key] = self._compile(shift_formula_tree(tree, *offset), key[0], cells, ranges, functions)
+                self.precedent_cells[key] = cells
+                self.precedent_ranges[key] = ranges
+                if functions & VOLATILE_FUNCTIONS:
+                    self.volatile.add(key)
+            except UnsupportedFormula as exc:
+                self.unsupported[key] = str(exc)
+
+        self._build_graph()
+        self.values = dict(cached_values)
+        self.recalculation_seconds = self._evaluate(self.order, self.values)
+
+    @classmethod
+    @instrumented("WorkbookFormulaEngine.build")
+    def from_xlsx(cls, file_path):
+        return cls(*read_workbook_cells(file_path))
+
+    # -- Compilation --
+
+    def resolve_reference(self, text, current_sheet, depth=0):
+        """Returns ('cell', key) or ('range', sheet, row1, col1, row2, col2) for a reference or defined name."""
+        if "[" in text:
+            raise UnsupportedFormula(f"External reference {text}")
+        sheet_name, reference = current_sheet, text
+        if "!" in text:
+            sheet_part, reference = text.rsplit("!", 1)
+            sheet_name = sheet_part[1:-1].replace("''", "'") if sheet_part.startswith("'") else sheet_part
+            if sheet_name not in self.sheet_max_rows and sheet_name not in self.sheet_names:
+                raise UnsupportedFormula(f"Unknown sheet {sheet_name}")
+        reference = reference.upper()
+        if reference == "#REF!":
+            return ("const", ERROR_REF)
+
+        match = CELL_REFERENCE_PATTERN.match(reference)
+        if match:
+            column1, row1, column2, row2 = match.groups()
+            if column2 is None:
+                return ("cell", (sheet_name, int(row1), column_index_from_string(column1)))
+            return ("range", sheet_name, int(row1), column_index_from_string(column1), int(row2), column_index_from_string(column2))
+        match = COLUMN_REFERENCE_PATTERN.match(reference)
+        if match:
+            # Whole columns are bounded by the sheet's last used row
+            return ("range", sheet_name, 1, column_index_from_string(match.group(1)),
+                    max(self.sheet_max_rows.get(sheet_name, 1), 1), column_index_from_string(match.group(2)))
+
+        # Defined names: sheet-scoped first, then workbook-scoped
+        target = self.defined_names.get((sheet_name, reference), self.defined_names.get((None, reference)))
+        if target is None or depth > 5:
+            raise UnsupportedFormula(f"Unknown name {text}")
+        return self.resolve_reference(target, sheet_name, depth + 1)
+
+    def _compile(self, node, sheet_name, cells, ranges, functions):
+        kind = node[0]
+        if kind == "const":
+            value = node[1]
+            return lambda get: value
+        if kind == "blank":
+            return lambda get: None
+        if kind == "ref":
+            resolved = self.resolve_reference(node[1], sheet_name)
+            if resolved[0] == "const":
+                error = resolved[1]
+                return lambda get: error
+            if resolved[0] == "cell":
+                key = resolved[1]
+                cells.add(key)
+                return lambda get: get(key)
+            _, range_sheet, row1, col1, row2, col2 = resolved
+            ranges.append((range_sheet, row1, col1, row2, col2))
+            return lambda get: RangeReference(range_sheet, row1, col1, row2, col2, get)
+        if kind == "binop":
+            op = node[1]
+            left = self._compile(node[2], sheet_name, cells, ranges, functions)
+            right = self._compile(node[3], sheet_name, cells, ranges, functions)
+            return lambda get: apply_binary(op, left(get), right(get))
+
+        _, name, arg_nodes = node
+        functions.add(name)
+        args = [self._compile(arg, sheet_name, cells, ranges, functions) for arg in arg_nodes]
+        if name in LAZY_WORKSHEET_FUNCTIONS:
+            function = LAZY_WORKSHEET_FUNCTIONS[name]
+            return lambda get: function(*[(lambda arg=arg: arg(get)) for arg in args])
+        if name not in WORKSHEET_FUNCTIONS:
+            raise UnsupportedFormula(f"Function {name}")
+        function = WORKSHEET_FUNCTIONS[name]
+        return lambda get: function(*[arg(get) for arg in args])
+
+    # -- Dependency graph --
+
+    def _build_graph(self):
+        """Links every compiled formula to the formulas it reads and orders them topologically."""
+        # Formula cells per (sheet, column), sorted by row, to find the formulas inside a range quickly
+        formula_rows = {}
+        for sheet_name, row, column in self.compiled:
+            formula_rows.setdefault((sheet_name, column), []).append(row)
+        for rows in formula_rows.values():
+            rows.sort()
+
+        # Reverse edges: single cells in a dict, ranges bucketed by (sheet, column)
+        self.cell_dependents = {}
+        self.range_dependents = {}
+        graph = {}
+        for key in self.compiled:
+            formula_precedents = {cell for cell in self.precedent_cells[key] if cell in self.compiled}
+            for cell in self.precedent_cells[key]:
+                self.cell_dependents.setdefault(cell, set()).add(key)
+            for range_sheet, row1, col1, row2, col2 in self.precedent_ranges[key]:
+                for column in range(col1, col2 + 1):
+                    self.range_dependents.setdefault((range_sheet, column), []).append((row1, row2, key))
+                    rows = formula_rows.get((range_sheet, column), [])
+                    for row in rows[bisect.bisect_left(rows, row1):bisect.bisect_right(rows, row2)]:
+                        formula_precedents.add((range_sheet, row, column))
+            graph[key] = formula_precedents
+
+        # Circular references keep their cached values, as with manual calculation in Excel
+        self.circular = set()
+        while True:
+            try:
+                order = list(graphlib.TopologicalSorter(graph).static_order())
+                break
+            except graphlib.CycleError as exc:
+                cycle = set(exc.args[1])
+                self.circular |= cycle
+                for key in cycle:
+                    graph.pop(key, None)
+                for precedents in graph.values():
+                    precedents -= cycle
+        self.order = [key for key in order if key in self.compiled and key not in self.circular]
+        self.order_position = {key: position for position, key in enumerate(self.order)}
+
+    def dependents(self, key):
+        """Formula cells that read the given cell directly."""
+        found = set(self.cell_dependents.get(key, ()))
+        for row1, row2, dependent in self.range_dependents.get((key[0], key[2]), ()):
+            if row1 <= key[1] <= row2:
+                found.add(dependent)
+        return found
+
+    def dirty_cells(self, changed_keys):
+        """Every formula cell downstream of the changed cells, in evaluation order."""
+        dirty, pending = set(), list(changed_keys)
+        while pending:
+            for dependent in self.dependents(pending.pop()):
+                if dependent not in dirty and dependent in self.order_position:
+                    dirty.add(dependent)
+                    pending.append(dependent)
+        return sorted(dirty, key=self.order_position.__getitem__)
+
+    # -- Evaluation --
+
+    def _evaluate(self, keys, values):
+        """Evaluates the formulas of keys (already in dependency order) into values; returns the elapsed seconds."""
+        started = time.perf_counter()
+        get = values.get
+        for key in keys:
+            try:
+                result = scalar(self.compiled[key](get))
+            except (ArithmeticError, ValueError, TypeError, IndexError):
+                result = ERROR_VALUE
+            if isinstance(result, np.generic):
+                result = result.item()
+            if result is None:
+                result = 0.0 # A formula pointing at a blank cell shows 0
+            values[key] = float(result) if isinstance(result, int) and not isinstance(result, bool) else result
+        return time.perf_counter() - started
+
+    def formula(self, key):
+        """Returns the formula of a cell as Excel shows it (with '='), or None for value cells."""
+        if key not in self.formulas:
+            return None
+        text, _, _, (row_offset, column_offset) = self.formulas[key]
+        if row_offset == 0 and column_offset == 0:
+            return f"={text}"
+        master_address = f"{get_column_letter(key[2] - column_offset)}{key[1] - row_offset}"
+        return Translator(f"={text}", origin=master_address).translate_formula(key_address(key))
+
+    def value(self, sheet_name, address):
+        return self.values.get(cell_key(sheet_name, address))
+
+    @instrumented("WorkbookFormulaEngine.what_if", rows_in="changes")
+    def what_if(self, changes):
+        """
+        Recomputes the workbook with some cells overridden, without touching the engine's own values.
+        changes maps (sheet, address) to the new input value. Returns (changed, stats) where changed
+        maps (sheet, address) to (base value, what-if value) for every cell whose value changed, and
+        stats reports the number of dirty cells and the recalculation time.
+        """
+        overrides = {cell_key(sheet_name, address): value for (sheet_name, address), value in changes.items()}
+        dirty = self.dirty_cells(overrides)
+        scenario = _OverlayValues(self.values, overrides)
+        elapsed = self._evaluate(dirty, scenario)
+
+        changed = {}
+        for key, value in scenario.overlay.items():
+            base_value = self.values.get(key)
+            if not _same_value(base_value, value):
+                changed[(key[0], key_address(key))] = (base_value, value)
+        return changed, {"dirty_cells": len(dirty), "seconds": elapsed}
+
+    def verify(self, tolerance=1e-6):
+        """
+        Compares the engine's recomputed values with the values Excel last saved.
+        Returns a list of (sheet, address, cached value, recomputed value) for the cells that differ.
+        Volatile formulas (TODAY) and the cells downstream of them are skipped, since their cached
+        values depend on the day the workbook was saved.
+        """
+        date_dependent = self.volatile | set(self.dirty_cells(self.volatile))
+        mismatches = []
+        for key in self.order:
+            if key in date_dependent:
+                continue
+            cached, computed = self.cached_values.get(key), self.values.get(key)
+            if not _same_value(cached, computed, tolerance):
+                mismatches.append((key[0], key_address(key), cached, computed))
+        return mismatches
+
+
+class _OverlayValues(dict):
+    """Scenario values: reads fall through to the base values, writes stay in the overlay."""
+
+    def __init__(self, base, overrides):
+        super().__init__()
+        self.base = base
+        self.overlay = self
+        self.update(overrides)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return self.base.get(key, default)
+
+
+def _same_value(left, right, tolerance=1e-9):
+    if is_number(left) and is_number(right):
+        return math.isclose(left, right, rel_tol=tolerance, abs_tol=tolerance)
+    # Empty cells and empty strings both read as blank
+    return (left if left != "" else None) == (right if right != "" else None)
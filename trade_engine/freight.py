@@ -0,0 +1,209 @@
+"""
+Freight lane lookups and freight cost calculations on the processed 'Freight & Dressing' sheet.
+"""
+
+import bisect
+import difflib
+
+import numpy as np
+import pandas as pd
+
+from .instrumentation import instrumented
+
+
+def normalize_freight_key(name):
+    """Normalizes a port/lane name for lookups: case-insensitive and whitespace-insensitive."""
+    return " ".join(str(name).split()).casefold()
+
+
+def normalize_freight_keys(names):
+    """Vectorized normalize_freight_key over a Series of names (plain or categorical)."""
+    # Normalize each distinct name once; lanes repeat the same few ports
+    codes, uniques = pd.factorize(names, use_na_sentinel=False)
+    unique_keys = pd.Series(uniques).astype(str).str.replace(r"\s+", " ", regex=True).str.strip().str.casefold()
+    return pd.Series(unique_keys.to_numpy()[codes], index=names.index)
+
+
+def freight_key_codes(names, key_positions):
+    """Position of each normalized name given {key: position} (of a FreightRateIndex key list), -1 if absent."""
+    # Distinct names are few (ports), so they are normalized and looked up one by one
+    codes, uniques = pd.factorize(names, use_na_sentinel=False)
+    unique_codes = np.fromiter((key_positions.get(normalize_freight_key(name), -1) for name in uniques), dtype='int64', count=len(uniques))
+    return unique_codes[codes]
+
+
+class FreightRateIndex:
+    """
+    Lookup structure over the processed freight table, built once per version of the
+    'Freight & Dressing' sheet. Exact lookups go through a normalized
+    (origin, destination) -> rate hash map; partial names can optionally be resolved
+    through sorted key lists (prefix search) with a fuzzy fallback. For vectorized lookups
+    (batch quoting) each lane also has an integer id, origin position * len(destination_keys)
+    + destination position, kept sorted in lane_ids with the matching rates in lane_rates.
+    lane_table holds the same lanes as a DataFrame.
+    """
+
+    @instrumented("FreightRateIndex.build", rows_in="freight_df")
+    def __init__(self, freight_df):
+        self.lane_table = pd.DataFrame(columns=['OriginKey', 'DestinationKey', 'FreightRate', 'RateOrigin', 'RateDestination'])
+        if not freight_df.empty and {'Origin', 'Destination', 'FreightCost'}.issubset(freight_df.columns):
+            lanes = pd.DataFrame({
+                'OriginKey': normalize_freight_keys(freight_df['Origin']),
+                'DestinationKey': normalize_freight_keys(freight_df['Destination']),
+                'FreightRate': pd.to_numeric(freight_df['FreightCost'], errors='coerce'),
+                'RateOrigin': freight_df['Origin'],
+                'RateDestination': freight_df['Destination'],
+            }).dropna(subset=['FreightRate'])
+            # Keep the first valid rate in sheet order for each lane
+            self.lane_table = lanes.drop_duplicates(subset=['OriginKey', 'DestinationKey'], keep='first').reset_index(drop=True)
+
+        self.rates = dict(zip(
+            zip(self.lane_table['OriginKey'], self.lane_table['DestinationKey']),
+            zip(self.lane_table['FreightRate'].astype(float), self.lane_table['RateOrigin'], self.lane_table['RateDestination']),
+        )) # {(origin_key, destination_key): (rate, origin, destination)}
+        self.origin_keys = sorted({origin_key for origin_key, _ in self.rates})
+        self.destination_keys = sorted({destination_key for _, destination_key in self.rates})
+        self._origin_positions = {key: position for position, key in enumerate(self.origin_keys)}
+        self._destination_positions = {key: position for position, key in enumerate(self.destination_keys)}
+
+        lane_ids = self.lane_ids_of(self.lane_table['OriginKey'], self.lane_table['DestinationKey'])
+        order = np.argsort(lane_ids, kind='stable')
+        self.lane_ids = lane_ids[order]
+        self.lane_rates = self.lane_table['FreightRate'].to_numpy(dtype='float64')[order]
+        self.lane_rows = order # lane_table row of each sorted lane id
+
+    def lane_ids_of(self, origins, destinations):
+        """Integer lane ids of Series of origin and destination names, -1 for names without lanes."""
+        origin_codes = freight_key_codes(origins, self._origin_positions)
+        destination_codes = freight_key_codes(destinations, self._destination_positions)
+        return np.where((origin_codes >= 0) & (destination_codes >= 0), origin_codes * len(self.destination_keys) + destination_codes, -1)
+
+    def lane_positions_of(self, origins, destinations):
+        """Positions in lane_ids (and lane_rates) of the (origin, destination) rows of two Series, -1 where no lane matches."""
+        lane_ids = self.lane_ids_of(origins, destinations)
+        if not len(self.lane_ids):
+            return np.full(len(lane_ids), -1)
+        positions = np.minimum(np.searchsorted(self.lane_ids, lane_ids), len(self.lane_ids) - 1)
+        return np.where((lane_ids >= 0) & (self.lane_ids[positions] == lane_ids), positions, -1)
+
+    def lane_rates_of(self, origins, destinations):
+        """Rates of the (origin, destination) rows of two Series, NaN where no lane matches."""
+        positions = self.lane_positions_of(origins, destinations)
+        if not len(self.lane_ids):
+            return np.full(len(positions), np.nan)
+        return np.where(positions >= 0, self.lane_rates[positions], np.nan)
+
+    def __len__(self):
+        return len(self.rates)
+
+    @staticmethod
+    @instrumented("FreightRateIndex.resolve_partial", rows_in="sorted_keys")
+    def _resolve_partial(name_key, sorted_keys):
+        """
+        Resolves a partial name against sorted keys: exact key first, then the keys starting
+        with it (binary search), then the closest fuzzy match. Returns None if nothing matches
+        and the full list of candidates if the prefix is ambiguous.
+        """
+        position = bisect.bisect_left(sorted_keys, name_key)
+        if position < len(sorted_keys) and sorted_keys[position] == name_key:
+            return name_key
+        prefix_matches = []
+        while position < len(sorted_keys) and sorted_keys[position].startswith(name_key):
+            prefix_matches.append(sorted_keys[position])
+            position += 1
+        if len(prefix_matches) == 1:
+            return prefix_matches[0]
+        if prefix_matches:
+            return prefix_matches
+        fuzzy_matches = difflib.get_close_matches(name_key, sorted_keys, n=1, cutoff=0.8)
+        return fuzzy_matches[0] if fuzzy_matches else None
+
+    def lookup(self, origin, destination, allow_partial=False):
+        """
+        Returns ((rate, origin, destination), message). The first element is None when no
+        unique lane matches; the message then explains why.
+        """
+        origin_key, destination_key = normalize_freight_key(origin), normalize_freight_key(destination)
+        match = self.rates.get((origin_key, destination_key))
+        if match is not None or not allow_partial:
+            return match, None if match is not None else f"No freight rate found for {origin} to {destination}."
+
+        resolved_origin = self._resolve_partial(origin_key, self.origin_keys)
+        resolved_destination = self._resolve_partial(destination_key, self.destination_keys)
+        for name, resolved in [(origin, resolved_origin), (destination, resolved_destination)]:
+            if isinstance(resolved, list):
+                return None, f"'{name}' is ambiguous, it matches {len(resolved)} names (e.g. {', '.join(resolved[:3])})."
+        match = self.rates.get((resolved_origin, resolved_destination))
+        if match is None:
+            return None, f"No freight rate found for {origin} to {destination}."
+        return match, None
+
+
+@instrumented()
+def calculate_freight_cost(freight_df, origin, destination, quantity_mt, rate_index=None, allow_partial=False):
+    """
+    Calculates the total freight cost for a given origin, destination, and quantity.
+    Assumes freight_df has columns 'Origin', 'Destination', and 'FreightCost'.
+    Looks up the rate of the matching Origin and Destination (case-insensitive) in a
+    FreightRateIndex and multiplies it by the quantity. Pass a prebuilt rate_index to
+    avoid rebuilding it on every call; allow_partial also resolves partial names.
+    """
+    if freight_df.empty:
+        return None, "Freight data not available."
+
+    # Ensure columns exist before looking up rates
+    if 'Origin' not in freight_df.columns or 'Destination' not in freight_df.columns or 'FreightCost' not in freight_df.columns:
+         return None, "Required columns for freight calculation not found."
+
+    if rate_index is None:
+        rate_index = FreightRateIndex(freight_df)
+
+    match, message = rate_index.lookup(origin, destination, allow_partial=allow_partial)
+    if match is None:
+        return None, message
+
+    # The index keeps the first valid rate found for each lane (simplification - could average or handle differently)
+    freight_rate_per_unit, matched_origin, matched_destination = match
+
+    total_freight = freight_rate_per_unit * quantity_mt
+
+    if allow_partial and (normalize_freight_key(matched_origin), normalize_freight_key(matched_destination)) != (normalize_freight_key(origin), normalize_freight_key(destination)):
+        return total_freight, f"Calculated using rate {freight_rate_per_unit:.2f} per MT ({matched_origin} to {matched_destination})."
+    return total_freight, f"Calculated using rate {freight_rate_per_unit:.2f} per MT."
+
+
+# Columns expected in a batch of freight legs (e.g. an uploaded shipment book)
+FREIGHT_LEG_COLUMNS = ['Origin', 'Destination', 'QuantityMT']
+
+@instrumented(rows_in="legs_df")
+def calculate_freight_costs_batch(freight_df, legs_df, rate_index=None):
+    """
+    Prices many freight legs at once. legs_df needs the columns 'Origin', 'Destination'
+    and 'QuantityMT'; lanes are matched case-insensitively (exact names) by integer lane id
+    against the rate index (a binary search), without a Python loop over the legs.
+    Returns the legs with 'FreightRate', 'TotalFreight' and a per-row 'Status' added,
+    plus a summary message. The first element is None if the batch cannot be priced.
+    """
+    if freight_df.empty:
+        return None, "Freight data not available."
+
+    missing_columns = [col for col in FREIGHT_LEG_COLUMNS if col not in legs_df.columns]
+    if missing_columns:
+        return None, f"Missing column(s) in freight legs: {', '.join(missing_columns)}."
+
+    if rate_index is None:
+        rate_index = FreightRateIndex(freight_df)
+
+    quotes = legs_df.copy()
+    quantities = pd.to_numeric(quotes['QuantityMT'], errors='coerce')
+
+    quotes['FreightRate'] = rate_index.lane_rates_of(quotes['Origin'], quotes['Destination'])
+    quotes['TotalFreight'] = quotes['FreightRate'] * quantities.to_numpy()
+    quotes['Status'] = np.select(
+        [quotes['FreightRate'].isna().to_numpy(), quantities.isna().to_numpy()],
+        ["No freight rate found", "Invalid quantity"],
+        default="OK",
+    )
+
+    priced_legs = int((quotes['Status'] == "OK").sum())
+    return quotes, f"Priced {priced_legs} of {len(quotes)} legs, total freight {quotes['TotalFreight'].sum():.2f}."
@@ -0,0 +1,389 @@
+"""
+FX curves, currency conversions (single, bulk and at live rates) and the FX chart pyramid.
+"""
+
+import threading
+
+import numpy as np
+import pandas as pd
+
+from .instrumentation import instrumented
+from .schemas import to_category
+
+
+class FxCurveStore:
+    """
+    Per-pair FX curves built once from a processed FX frame (Market & FX Fix or Costing Beans).
+    Each pair holds its value dates and rates as sorted NumPy arrays, so the latest rate is an
+    O(1) lookup and the rate as of a given date is a binary search (O(log n)). points holds all
+    the fixings ordered by value date, with the pairs as a categorical.
+    """
+
+    @instrumented("FxCurveStore.build", rows_in="fx_df")
+    def __init__(self, fx_df):
+        self.curves = {} # {pair: (value_dates as datetime64 array, rates as float64 array)}
+        self.points = pd.DataFrame({'FX': pd.Series(dtype='category'), 'VALUE DATE': pd.Series(dtype='datetime64[ns]'), 'FX RATE': pd.Series(dtype='float64')})
+        if fx_df.empty or not {'FX', 'VALUE DATE', 'FX RATE'}.issubset(fx_df.columns):
+            return
+
+        fx_points = pd.DataFrame({
+            'FX': to_category(fx_df['FX']),
+            'VALUE DATE': pd.to_datetime(fx_df['VALUE DATE'], errors='coerce'),
+            'FX RATE': pd.to_numeric(fx_df['FX RATE'], errors='coerce'),
+        }).dropna(subset=['VALUE DATE', 'FX RATE'])
+        # Stable sort keeps sheet order for equal dates, so the last row of a date wins on lookups
+        # All points ordered by value date (date range of bulk conversions)
+        self.points = fx_points.sort_values(by='VALUE DATE', kind='mergesort').reset_index(drop=True)
+        fx_points = fx_points.sort_values(by=['FX', 'VALUE DATE'], kind='mergesort')
+        for pair, pair_points in fx_points.groupby('FX', sort=False, observed=True):
+            self.curves[pair] = (
+                # Keep the parsed datetime unit; stray cells (e.g. year 1) don't fit nanoseconds
+                pair_points['VALUE DATE'].to_numpy(),
+                pair_points['FX RATE'].to_numpy(dtype='float64'),
+            )
+
+    def pairs(self):
+        return list(self.curves)
+
+    def latest(self, pair):
+        """Returns (rate, value_date) of the most recent point of the pair, or None."""
+        curve = self.curves.get(pair)
+        if curve is None:
+            return None
+        value_dates, rates = curve
+        return rates[-1], pd.Timestamp(value_dates[-1])
+
+    def as_of(self, pair, value_date):
+        """Returns (rate, value_date) of the last point on or before value_date, or None."""
+        curve = self.curves.get(pair)
+        if curve is None:
+            return None
+        value_dates, rates = curve
+        position = np.searchsorted(value_dates, np.datetime64(pd.Timestamp(value_date)).astype(value_dates.dtype), side='right') - 1
+        if position < 0:
+            return None
+        return rates[position], pd.Timestamp(value_dates[position])
+
+
+FX_CHART_MAX_POINTS = 2000 # Upper bound on the points sent to the browser per chart
+# Calendar bucket levels of the chart pyramid, finest first: (name, numpy datetime unit)
+FX_CHART_LEVELS = [('Hourly', 'h'), ('Daily', 'D'), ('Weekly', 'W'), ('Monthly', 'M'), ('Quarterly', 'Q'), ('Yearly', 'Y')]
+
+def calendar_bucket_keys(value_dates, unit):
+    """Integer bucket of each date for a FX_CHART_LEVELS unit; works for any datetime64 unit and year."""
+    if unit == 'W':
+        # 1970-01-01 was a Thursday; shift so weeks start on Monday
+        return (value_dates.astype('datetime64[D]').astype('int64') + 3) // 7
+    if unit == 'Q':
+        return value_dates.astype('datetime64[M]').astype('int64') // 3
+    return value_dates.astype(f'datetime64[{unit}]').astype('int64')
+
+
+def lttb_indices(x, y, n_out):
+    """
+    Largest-Triangle-Three-Buckets downsampling: indices of n_out points (first and last included)
+    that keep the visual shape of the series y over x. x must be sorted.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = x.astype('float64')
+    edges = np.linspace(1, n - 1, n_out - 1).astype('int64') # n_out - 2 inner buckets
+    selected = np.empty(n_out, dtype='int64')
+    selected[0], selected[-1] = 0, n - 1
+    previous = 0
+    for bucket in range(n_out - 2):
+        start, end = edges[bucket], max(edges[bucket + 1], edges[bucket] + 1)
+        # The third triangle vertex is the average of the next bucket (or the last point)
+        next_end = edges[bucket + 2] if bucket + 2 < len(edges) else n
+        next_x, next_y = x[end:next_end].mean() if next_end > end else x[-1], y[end:next_end].mean() if next_end > end else y[-1]
+        areas = np.abs((x[previous] - next_x) * (y[start:end] - y[previous]) - (x[previous] - x[start:end]) * (next_y - y[previous]))
+        previous = start + int(np.argmax(areas))
+        selected[bucket + 1] = previous
+    return selected
+
+
+class FxChartPyramid:
+    """
+    Multi-resolution chart data for the pairs of an FxCurveStore: the raw fixings plus OHLC
+    aggregates per calendar level (FX_CHART_LEVELS). Levels are built once per pair on first
+    use; chart_data then serves the finest level whose points in the visible range fit the budget.
+    """
+
+    def __init__(self, curve_store):
+        self.curve_store = curve_store
+        self._levels = {} # {pair: [(name, dates, open, high, low, close)], raw level first}
+        self._lock = threading.Lock()
+
+    def levels(self, pair):
+        levels = self._levels.get(pair)
+        if levels is None:
+            with self._lock:
+                levels = self._levels.get(pair)
+                if levels is None:
+                    levels = self._levels[pair] = self._build_levels(pair)
+        return levels
+
+    def _build_levels(self, pair):
+        curve = self.curve_store.curves.get(pair)
+        if curve is None:
+            return []
+        value_dates, rates = curve
+        valid = ~np.isnan(rates)
+        value_dates, rates = value_dates[valid], rates[valid]
+        levels = [('Raw', value_dates, rates, rates, rates, rates)]
+        for name, unit in FX_CHART_LEVELS:
+            if len(value_dates) == 0:
+                break
+            # Dates are sorted, so each bucket is a contiguous run
+            keys = calendar_bucket_keys(value_dates, unit)
+            starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+            if len(starts) == len(levels[-1][1]):
+                continue # Nothing to aggregate at this level (e.g. hourly buckets of daily fixings)
+            ends = np.r_[starts[1:], len(rates)] - 1
+            levels.append((
+                name, value_dates[starts], rates[starts],
+                np.maximum.reduceat(rates, starts), np.minimum.reduceat(rates, starts), rates[ends],
+            ))
+        return levels
+
+    @instrumented("FxChartPyramid.chart_data")
+    def chart_data(self, pair, start=None, end=None, max_points=FX_CHART_MAX_POINTS, method='ohlc'):
+        """
+        Returns (DataFrame with VALUE DATE, OPEN, HIGH, LOW, FX RATE (close), resolution name) for the
+        days from start to end (inclusive, None for open ends), with at most max_points rows.
+        method 'ohlc' serves the finest bucket level that fits; 'lttb' downsamples the raw fixings
+        with LTTB. Levels coarser than the budget fall back to LTTB on the coarsest level.
+        """
+        levels = self.levels(pair)
+        if not levels:
+            return pd.DataFrame(columns=['VALUE DATE', 'OPEN', 'HIGH', 'LOW', 'FX RATE']), None
+
+        def window(level):
+            dates = level[1]
+            lower = 0 if start is None else np.searchsorted(dates, np.datetime64(start, 'D').astype(dates.dtype), side='left')
+            upper = len(dates) if end is None else np.searchsorted(dates, (np.datetime64(end, 'D') + 1).astype(dates.dtype), side='left')
+            return [values[lower:upper] for values in level[1:]]
+
+        candidates = levels if method == 'ohlc' else levels[:1]
+        for level in candidates:
+            dates, open_rates, high_rates, low_rates, close_rates = window(level)
+            if len(dates) <= max_points:
+                resolution = level[0]
+                break
+        else:
+            # Even the coarsest candidate is over budget: keep its most telling points
+            keep = lttb_indices(dates.astype('int64'), close_rates, max_points)
+            dates, open_rates, high_rates, low_rates, close_rates = (values[keep] for values in (dates, open_rates, high_rates, low_rates, close_rates))
+            resolution = f"{level[0]} (LTTB)"
+
+        return pd.DataFrame({
+            'VALUE DATE': dates, 'OPEN': open_rates, 'HIGH': high_rates, 'LOW': low_rates, 'FX RATE': close_rates,
+        }), resolution
+
+
+@instrumented()
+def perform_currency_conversion(df_fx, selected_fx, value_to_convert, curve_store=None, as_of_date=None):
+    """
+    Performs currency conversion using the latest FX rate for the selected pair, or the
+    rate as of as_of_date if given. Assumes df_fx has columns 'FX', 'VALUE DATE', and 'FX RATE'.
+    Pass a prebuilt curve_store (FxCurveStore of df_fx) to avoid rebuilding the curves on every call.
+    """
+    if df_fx.empty:
+        return None, None, None, "FX data not available."
+
+    # Ensure required columns exist
+    if 'FX' not in df_fx.columns or 'VALUE DATE' not in df_fx.columns or 'FX RATE' not in df_fx.columns:
+        return None, None, None, "Required columns for FX conversion not found."
+
+    if curve_store is None:
+        curve_store = FxCurveStore(df_fx)
+
+    if selected_fx not in curve_store.curves:
+        if (df_fx['FX'] == selected_fx).any():
+            return None, None, None, f"No valid date or FX rate data for the selected FX pair '{selected_fx}'."
+        return None, None, None, f"No data available for the selected FX pair '{selected_fx}'."
+
+    fx_point = curve_store.latest(selected_fx) if as_of_date is None else curve_store.as_of(selected_fx, as_of_date)
+    if fx_point is None:
+        return None, None, None, f"No FX rate for '{selected_fx}' on or before {pd.Timestamp(as_of_date).date()}."
+
+    conversion_fx_rate, conversion_timestamp = fx_point
+    conversion_date = conversion_timestamp.date()
+
+    # Ensure value_to_convert is numeric
+    try:
+        value_to_convert_numeric = float(value_to_convert)
+    except (ValueError, TypeError):
+        return None, None, None, "Invalid value to convert."
+
+
+    converted_value = value_to_convert_numeric * conversion_fx_rate
+
+    return converted_value, conversion_fx_rate, conversion_date, "Conversion successful."
+
+
+# Currencies used to build cross rates when a pair has no direct or inverse quote
+FX_TRIANGULATION_CURRENCIES = ['USD', 'EUR']
+# Columns expected in a batch of cash flows to convert
+FX_CASH_FLOW_COLUMNS = ['FX', 'VALUE DATE', 'AMOUNT']
+
+def parse_value_dates(values):
+    """
+    Parses a Series of value dates given as dates or as text in any mix of formats; each distinct
+    value is parsed on its own, so one column can hold '2026-03-01', '2026-03-02 10:00' and
+    '03/04/2026'. Returns (datetime64 Series, NumPy mask of the invalid dates): missing or blank
+    values are NaT and not invalid, values that are given but don't parse are NaT and invalid.
+    """
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values, np.zeros(len(values), dtype=bool)
+    codes, uniques = pd.factorize(values)
+    unique_values = pd.Series(uniques, dtype=object)
+    blank = unique_values.astype(str).str.strip().eq("").to_numpy()
+    parsed = pd.to_datetime(unique_values.mask(blank), format='mixed', errors='coerce')
+    unique_invalid = parsed.isna().to_numpy() & ~blank
+    # Missing values have code -1, which picks the NaT / False appended at the end
+    dates = np.append(parsed.to_numpy(), np.array(['NaT'], dtype=parsed.dtype))[codes]
+    return pd.Series(dates, index=values.index), np.append(unique_invalid, False)[codes]
+
+
+def _asof_pair_rates(curve_store, pairs, value_dates):
+    """
+    Vectorized as-of lookup: for each (pair, value date) row, the last rate of that pair on or
+    before the date. Returns (rates, rate_dates) arrays aligned with the input, NaN/NaT if none.
+    Rows are grouped by pair (hashed once) and each group is one binary search in its curve, so
+    the cost has no fixed per-call overhead beyond the distinct pairs of the input.
+    """
+    rates = np.full(len(pairs), np.nan)
+    rate_dates = np.full(len(pairs), np.datetime64('NaT'), dtype=value_dates.dtype)
+    row_codes, unique_pairs = pd.factorize(pairs, use_na_sentinel=False)
+    rows_by_pair = np.argsort(row_codes, kind='stable')
+    group_ends = np.cumsum(np.bincount(row_codes, minlength=len(unique_pairs)))
+    for code, pair in enumerate(unique_pairs):
+        curve = curve_store.curves.get(pair)
+        if curve is None:
+            continue
+        curve_dates, curve_rates = curve
+        rows = rows_by_pair[group_ends[code - 1] if code else 0:group_ends[code]]
+        positions = np.searchsorted(curve_dates, value_dates[rows].astype(curve_dates.dtype), side='right') - 1
+        found = positions >= 0
+        rates[rows[found]] = curve_rates[positions[found]]
+        rate_dates[rows[found]] = curve_dates[positions[found]]
+    return rates, rate_dates
+
+
+def _asof_currency_rates(curve_store, base_currencies, quote_currencies, value_dates):
+    """
+    Rate from base to quote currency per row: the direct pair if quoted, else the inverse
+    of the reversed pair. Returns (rates, rate_dates).
+    """
+    rates, rate_dates = _asof_pair_rates(curve_store, base_currencies + quote_currencies, value_dates)
+    inverse_rates, inverse_dates = _asof_pair_rates(curve_store, quote_currencies + base_currencies, value_dates)
+    use_inverse = np.isnan(rates) & ~np.isnan(inverse_rates)
+    with np.errstate(divide='ignore'):
+        rates = np.where(use_inverse, 1.0 / inverse_rates, rates)
+    rate_dates = np.where(use_inverse, inverse_dates, rate_dates)
+    return rates, rate_dates
+
+
+@instrumented(rows_in="cash_flows_df")
+def convert_currency_bulk(fx_df, cash_flows_df, curve_store=None):
+    """
+    Converts many cash flows at once. cash_flows_df needs the columns 'FX' (pair such as
+    'EURGBP'; amounts are in its base currency), 'VALUE DATE' and 'AMOUNT'. Rates are resolved
+    with vectorized as-of lookups (last rate on or before each value date, the latest rate when
+    the date is missing): the direct pair first, then the inverse of the reversed pair, then
+    cross rates through USD and EUR. Returns the cash flows with 'CONVERTED AMOUNT',
+    'FX RATE', 'RATE DATE' and 'RATE SOURCE' added, plus a summary message.
+    Pairs with the same base and quote currency convert at 1; rows whose value date is given
+    but can't be parsed get no rate and the source "invalid value date".
+    """
+    missing_columns = [col for col in FX_CASH_FLOW_COLUMNS if col not in cash_flows_df.columns]
+    if missing_columns:
+        return None, f"Missing column(s) in cash flows: {', '.join(missing_columns)}."
+
+    if curve_store is None:
+        curve_store = FxCurveStore(fx_df)
+    fx_points = curve_store.points
+    if fx_points.empty:
+        return None, "FX data not available."
+
+    conversions = cash_flows_df.copy()
+    pairs = conversions['FX'].astype(str).str.strip().str.upper()
+    # A missing value date means "latest available rate"; a date that doesn't parse gets no rate
+    value_dates, invalid_dates = parse_value_dates(conversions['VALUE DATE'])
+    value_dates = value_dates.astype(fx_points['VALUE DATE'].dtype).fillna(fx_points['VALUE DATE'].max()).to_numpy()
+    amounts = pd.to_numeric(conversions['AMOUNT'], errors='coerce').to_numpy(dtype='float64')
+
+    # Direct quotes, for any pair name (including non-currency instruments)
+    rates, rate_dates = _asof_pair_rates(curve_store, pairs.to_numpy(), value_dates)
+    rate_sources = np.where(np.isnan(rates), "", "direct").astype(object)
+
+    # Six-letter currency pairs can also be inverted or triangulated
+    is_currency_pair = pairs.str.fullmatch(r"[A-Z]{6}").fillna(False).to_numpy()
+    base_currencies = pairs.str[:3].to_numpy()
+    quote_currencies = pairs.str[3:].to_numpy()
+
+    # Amounts already in the quote currency (e.g. 'USDUSD') convert at 1
+    same_currency = np.isnan(rates) & is_currency_pair & (base_currencies == quote_currencies)
+    rates = np.where(same_currency, 1.0, rates)
+    rate_dates = np.where(same_currency, value_dates, rate_dates)
+    rate_sources[same_currency] = "same currency"
+
+    inverse_rates, inverse_dates = _asof_pair_rates(curve_store, quote_currencies + base_currencies, value_dates)
+    use_inverse = np.isnan(rates) & is_currency_pair & ~np.isnan(inverse_rates)
+    with np.errstate(divide='ignore'):
+        rates = np.where(use_inverse, 1.0 / inverse_rates, rates)
+    rate_dates = np.where(use_inverse, inverse_dates, rate_dates)
+    rate_sources[use_inverse] = "inverse"
+
+    for via_currency in FX_TRIANGULATION_CURRENCIES:
+        needs_cross = np.isnan(rates) & is_currency_pair & (base_currencies != via_currency) & (quote_currencies != via_currency)
+        if not needs_cross.any():
+            break
+        via_currencies = np.full(len(pairs), via_currency, dtype=object)
+        first_leg_rates, first_leg_dates = _asof_currency_rates(curve_store, base_currencies, via_currencies, value_dates)
+        second_leg_rates, second_leg_dates = _asof_currency_rates(curve_store, via_currencies, quote_currencies, value_dates)
+        use_cross = needs_cross & ~np.isnan(first_leg_rates) & ~np.isnan(second_leg_rates)
+        rates = np.where(use_cross, first_leg_rates * second_leg_rates, rates)
+        # A cross rate is only as recent as its older leg
+        rate_dates = np.where(use_cross, np.minimum(first_leg_dates, second_leg_dates), rate_dates)
+        rate_sources[use_cross] = f"cross via {via_currency}"
+
+    rates = np.where(invalid_dates, np.nan, rates)
+    rate_dates = np.where(invalid_dates, np.datetime64('NaT'), rate_dates)
+    rate_sources[invalid_dates] = "invalid value date"
+
+    conversions['CONVERTED AMOUNT'] = amounts * rates
+    conversions['FX RATE'] = rates
+    conversions['RATE DATE'] = rate_dates
+    conversions['RATE SOURCE'] = np.where(np.isnan(rates) & ~invalid_dates, "no rate found", rate_sources)
+
+    converted_rows = int((~np.isnan(conversions['CONVERTED AMOUNT'].to_numpy(dtype='float64'))).sum())
+    return conversions, f"Converted {converted_rows} of {len(conversions)} cash flows."
+
+
+def live_start_rates(*curve_stores):
+    """Latest rate per pair from the given FxCurveStores; earlier stores take precedence."""
+    start_rates = {}
+    for curve_store in curve_stores:
+        for pair in curve_store.pairs():
+            start_rates.setdefault(pair, float(curve_store.latest(pair)[0]))
+    return start_rates
+
+@instrumented()
+def perform_live_conversion(rate_book, selected_fx, value_to_convert):
+    """
+    Converts a value at the latest live rate of a pair, using the inverse pair if only that one ticks.
+    Returns (converted_value, rate, tick_time, message); the first three are None if no tick is available.
+    """
+    tick = rate_book.latest(selected_fx)
+    if tick is not None:
+        timestamp, rate = tick
+    else:
+        inverse_tick = rate_book.latest(selected_fx[3:] + selected_fx[:3]) if len(selected_fx) == 6 else None
+        if inverse_tick is None or inverse_tick[1] == 0:
+            return None, None, None, f"No live rate for {selected_fx} yet."
+        timestamp, rate = inverse_tick[0], 1.0 / inverse_tick[1]
+    tick_time = pd.Timestamp(timestamp, unit='s')
+    return value_to_convert * rate, rate, tick_time, f"Converted at the live {selected_fx} rate of {tick_time:%H:%M:%S} UTC."
@@ -0,0 +1,245 @@
+"""
+FX hedge optimizer: forward hedges for the open currency exposures of the position book.
+
+Exposures (Currency, VALUE DATE, AMOUNT; positive amounts are receivable, negative payable) are
+netted per currency and value-date bucket. Each bucket of a foreign currency can be hedged with
+a forward against the base currency settling at the bucket date, at the rate of the FX curves as
+of that date (the first curve store that quotes the currency wins, e.g. Costing Beans before
+Market & FX Fix). The hedge notionals solve one linear program:
+
+    variables    y[i], base-currency notional of the forward hedging bucket i (selling a
+                 receivable currency forward, buying a payable one; never beyond the exposure)
+    objective    "residual": minimize sum(risk[i] * (exposure[i] - y[i]) + cost[i] * y[i])
+                 "cost":     minimize sum(cost[i] * y[i]) with sum(upper[i] - y[i]) <= max_residual
+    bounds       min_hedge_ratio * upper[i] <= y[i] <= upper[i] = min(exposure[i], max_trade_notional);
+                 upper[i] = 0 beyond max_tenor_days or without a forward rate
+    constraints  total notional per bucket date, per currency and for the whole book within limits
+
+exposure[i] is the bucket's absolute exposure in base currency, cost[i] the spread (bps plus bps
+per year of tenor) and risk[i] the currency's annual volatility (daily fixings of the curves)
+times the square root of the tenor in years, i.e. the one-sigma value change of an unhedged unit
+(a fixed annual_vol replaces the estimate where the curves are forward curves rather than history).
+The exposure above upper[i] can't be hedged by any forward; it is reported as unhedgeable and is
+not part of the "cost" objective's residual target.
+Every variable has at most three non-zeros in the constraint matrix, which is built as a SciPy
+sparse matrix and solved with HiGHS, so books of thousands of buckets solve in well under a second.
+"""
+
+import time
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from scipy.optimize import linprog
+
+from .fx import convert_currency_bulk, parse_value_dates
+from .instrumentation import instrumented, stage
+from .risk import RISK_MIN_FX_RETURNS, TRADING_DAYS_PER_YEAR, fx_log_returns
+
+HEDGE_EXPOSURE_COLUMNS = ['Currency', 'VALUE DATE', 'AMOUNT']
+HEDGE_OBJECTIVES = ["residual", "cost"]
+HEDGE_BUCKET_FREQUENCIES = {"D": "Daily", "W": "Weekly", "M": "Monthly"} # Value-date buckets: pandas period code -> label
+HEDGE_DEFAULT_ANNUAL_VOL = 0.10 # Volatility assumed for currencies without enough fixing history
+HEDGE_FULL_RATIO = 0.9999 # Hedge ratios from here on count as fully hedged (solver tolerance)
+
+# Settings of optimize_fx_hedges; limits set to None are not constrained
+HEDGE_DEFAULT_SETTINGS = {
+    "base_currency": "USD",
+    "objective": "residual",
+    "bucket_frequency": "W",
+    "as_of_date": None, # Tenors are counted from this date (default: today)
+    "max_tenor_days": 365,
+    "annual_vol": None, # Volatility of every currency (default: estimated per currency from the curves)
+    "min_hedge_ratio": 0.0,
+    "max_trade_notional": None, # Per forward, in base currency
+    "bucket_notional_limit": None, # All forwards settling on one bucket date, in base currency
+    "currency_notional_limit": None, # All forwards of one currency, in base currency
+    "total_notional_limit": None, # The whole hedge book, in base currency
+    "max_residual": 0.0, # "cost" objective: unhedged exposure allowed, in base currency
+    "spread_bps": 2.0,
+    "spread_bps_per_year": 5.0,
+}
+
+
+def bucket_exposures(exposures_df, base_currency, bucket_frequency, as_of_date):
+    """
+    Net exposure per currency and value-date bucket. A bucket is dated at the end of its period
+    (the value date itself for daily buckets); value dates in the past or missing count as spot
+    (tenor 0). Flows whose value date can't be parsed are left out rather than hedged as spot.
+    Returns (DataFrame with 'Currency', 'Bucket Date', 'Tenor Days', 'Exposure' and 'Flows',
+    number of flows left out for their value date).
+    """
+    currencies = exposures_df['Currency'].astype(str).str.strip().str.upper()
+    parsed_dates, invalid_dates = parse_value_dates(exposures_df['VALUE DATE'])
+    value_dates = parsed_dates.fillna(as_of_date).clip(lower=as_of_date)
+    bucket_dates = value_dates.dt.to_period(bucket_frequency).dt.end_time.dt.normalize().astype('datetime64[ns]')
+    flows = pd.DataFrame({
+        'Currency': currencies,
+        'Bucket Date': bucket_dates,
+        'Exposure': pd.to_numeric(exposures_df['AMOUNT'], errors='coerce'),
+    })[~invalid_dates].dropna(subset=['Exposure'])
+    buckets = flows.groupby(['Currency', 'Bucket Date'], sort=True).agg(Exposure=('Exposure', 'sum'), Flows=('Exposure', 'size')).reset_index()
+    buckets = buckets[(buckets['Exposure'] != 0) & (buckets['Currency'] != base_currency)].reset_index(drop=True)
+    buckets.insert(2, 'Tenor Days', (buckets['Bucket Date'] - as_of_date).dt.days.clip(lower=0))
+    return buckets, int(invalid_dates.sum())
+
+
+def forward_rates(curve_stores, currencies, bucket_dates, base_currency):
+    """Rate from each currency to the base currency as of each bucket date; earlier curve stores take precedence."""
+    rates = np.full(len(currencies), np.nan)
+    for curve_store in curve_stores:
+        missing = np.isnan(rates)
+        if not missing.any() or curve_store.points.empty:
+            continue
+        conversions, _ = convert_currency_bulk(None, pd.DataFrame({
+            'FX': currencies[missing] + base_currency,
+            'VALUE DATE': bucket_dates[missing],
+            'AMOUNT': 1.0,
+        }), curve_store=curve_store)
+        rates[missing] = conversions['FX RATE'].to_numpy(dtype='float64')
+    return rates
+
+
+def annual_volatilities(curve_stores, currencies, base_currency):
+    """Annualized volatility of each currency against the base currency, from the first curve with enough fixings."""
+    volatilities = {}
+    for currency in currencies:
+        volatilities[currency] = HEDGE_DEFAULT_ANNUAL_VOL
+        for curve_store in curve_stores:
+            curve = curve_store.curves.get(currency + base_currency) or curve_store.curves.get(base_currency + currency)
+            returns = fx_log_returns(curve[1]) if curve is not None else np.empty(0)
+            if len(returns) >= RISK_MIN_FX_RETURNS:
+                volatilities[currency] = float(returns.std() * np.sqrt(TRADING_DAYS_PER_YEAR))
+                break
+    return volatilities
+
+
+def limit_rows(groups, limit):
+    """(row per variable, right-hand sides) of "sum of the group's notionals <= limit" constraints."""
+    codes, uniques = pd.factorize(groups)
+    return codes, np.full(len(uniques), float(limit))
+
+
+@instrumented(rows_in="exposures_df")
+def optimize_fx_hedges(exposures_df, curve_stores, settings=None):
+    """
+    Solves for the forward hedges of the exposures (see the module docstring). curve_stores are
+    FxCurveStores in order of precedence; settings override HEDGE_DEFAULT_SETTINGS.
+    Returns (hedges DataFrame, one row per currency and bucket; summary DataFrame with one row
+    per metric; message). The DataFrames are None if the exposures can't be hedged.
+    """
+    settings = {**HEDGE_DEFAULT_SETTINGS, **(settings or {})}
+    missing_columns = [col for col in HEDGE_EXPOSURE_COLUMNS if col not in exposures_df.columns]
+    if missing_columns:
+        return None, None, f"Missing column(s) in exposures: {', '.join(missing_columns)}."
+    if settings["objective"] not in HEDGE_OBJECTIVES:
+        return None, None, f"Unknown objective '{settings['objective']}'; choose one of: {', '.join(HEDGE_OBJECTIVES)}."
+
+    base_currency = settings["base_currency"].strip().upper()
+    as_of_date = pd.Timestamp(settings["as_of_date"] or pd.Timestamp.today()).normalize()
+    with stage("optimize_fx_hedges.buckets", rows_in=len(exposures_df)):
+        hedges, invalid_date_flows = bucket_exposures(exposures_df, base_currency, settings["bucket_frequency"], as_of_date)
+    invalid_date_note = f" {invalid_date_flows} flow(s) with an invalid value date are left out." if invalid_date_flows else ""
+    if hedges.empty:
+        return None, None, f"No foreign-currency exposure to hedge against {base_currency}.{invalid_date_note}"
+
+    currencies = hedges['Currency'].to_numpy(dtype=object)
+    rates = forward_rates(curve_stores, currencies, hedges['Bucket Date'].to_numpy(), base_currency)
+    if settings["annual_vol"]:
+        volatilities = dict.fromkeys(hedges['Currency'].unique(), settings["annual_vol"])
+    else:
+        volatilities = annual_volatilities(curve_stores, hedges['Currency'].unique(), base_currency)
+    tenor_years = hedges['Tenor Days'].to_numpy(dtype='float64') / 365.0
+    exposure = np.abs(hedges['Exposure'].to_numpy(dtype='float64')) * np.nan_to_num(rates)
+    risk = hedges['Currency'].map(volatilities).to_numpy(dtype='float64') * np.sqrt(tenor_years)
+    cost = (settings["spread_bps"] + settings["spread_bps_per_year"] * tenor_years) / 10_000
+
+    hedgeable = ~np.isnan(rates) & (hedges['Tenor Days'].to_numpy() <= settings["max_tenor_days"])
+    upper = np.where(hedgeable, exposure, 0.0)
+    if settings["max_trade_notional"] is not None:
+        upper = np.minimum(upper, settings["max_trade_notional"])
+    # The trade limit wins over the minimum hedge ratio
+    lower = np.minimum(settings["min_hedge_ratio"] * upper, upper) if settings["min_hedge_ratio"] else np.zeros(len(upper))
+
+    # Sparse constraint matrix: one row per limited group, a 1 for each of its variables
+    with stage("optimize_fx_hedges.build_lp", rows_in=len(hedges)):
+        row_blocks, rhs_blocks, row_offset = [], [], 0
+        limited_groups = [
+            (hedges['Bucket Date'], settings["bucket_notional_limit"]),
+            (hedges['Currency'], settings["currency_notional_limit"]),
+            (np.zeros(len(hedges), dtype='int64'), settings["total_notional_limit"]),
+        ]
+        for groups, limit in limited_groups:
+            if limit is None:
+                continue
+            rows, rhs = limit_rows(groups, limit)
+            row_blocks.append((rows + row_offset, np.ones(len(rows))))
+            rhs_blocks.append(rhs)
+            row_offset += len(rhs)
+        if settings["objective"] == "cost":
+            # Only the hedgeable exposure counts: sum(upper - y) <= max_residual  <=>  -sum(y) <= max_residual - sum(upper)
+            row_blocks.append((np.full(len(hedges), row_offset), -np.ones(len(hedges))))
+            rhs_blocks.append(np.array([settings["max_residual"] - upper.sum()]))
+            row_offset += 1
+            objective = cost
+        else:
+            objective = cost - risk
+        a_ub = b_ub = None
+        if row_blocks:
+            rows = np.concatenate([block_rows for block_rows, _ in row_blocks])
+            values = np.concatenate([block_values for _, block_values in row_blocks])
+            columns = np.tile(np.arange(len(hedges)), len(row_blocks))
+            a_ub = scipy.sparse.csr_matrix((values, (rows, columns)), shape=(row_offset, len(hedges)))
+            b_ub = np.concatenate(rhs_blocks)
+
+    solve_start = time.perf_counter()
+    with stage("optimize_fx_hedges.solve", rows_in=len(hedges)):
+        solution = linprog(objective, A_ub=a_ub, b_ub=b_ub, bounds=np.column_stack([lower, upper]), method='highs')
+    solve_seconds = time.perf_counter() - solve_start
+    if solution.status == 2:
+        return None, None, "No hedge satisfies the limits; relax the limits, the minimum hedge ratio or the residual target."
+    if solution.status != 0:
+        return None, None, f"Hedge optimization failed: {solution.message}"
+
+    notional = np.clip(solution.x, lower, upper) # Remove solver noise outside the bounds
+    hedge_ratio = np.divide(notional, exposure, out=np.zeros(len(notional)), where=exposure > 0)
+    exposure_sign = np.sign(hedges['Exposure'].to_numpy(dtype='float64'))
+    hedges['Forward Rate'] = rates
+    hedges[f'Exposure ({base_currency})'] = exposure_sign * np.where(np.isnan(rates), np.nan, exposure)
+    hedges['Direction'] = np.where(notional > 0, np.where(exposure_sign > 0, "Sell", "Buy"), "")
+    hedges['Hedge Amount'] = np.divide(notional, rates, out=np.zeros(len(notional)), where=notional > 0)
+    hedges[f'Hedge Notional ({base_currency})'] = notional
+    hedges['Hedge Ratio'] = hedge_ratio
+    hedges[f'Residual ({base_currency})'] = exposure_sign * (exposure - notional) + 0.0 # No negative zeros
+    hedges[f'Cost ({base_currency})'] = cost * notional
+    hedges['Status'] = np.select(
+        [np.isnan(rates), ~hedgeable, hedge_ratio >= HEDGE_FULL_RATIO, notional > 0],
+        ["No forward rate", f"Beyond {settings['max_tenor_days']} days", "Hedged", "Partially hedged"],
+        default="Not hedged",
+    )
+
+    residual = exposure - notional
+    unhedgeable = exposure - upper
+    summary = pd.DataFrame([
+        ("Buckets", len(hedges)),
+        ("Hedgeable Buckets", int(hedgeable.sum())),
+        ("Forwards", int((notional > 0).sum())),
+        (f"Exposure ({base_currency})", exposure.sum()),
+        (f"Hedged ({base_currency})", notional.sum()),
+        (f"Residual ({base_currency})", residual.sum()),
+        (f"Unhedgeable ({base_currency})", unhedgeable.sum()),
+        ("Hedge Ratio", notional.sum() / exposure.sum() if exposure.sum() > 0 else 0.0),
+        (f"Hedge Cost ({base_currency})", (cost * notional).sum()),
+        (f"Residual Risk, 1 sigma ({base_currency})", (risk * residual).sum()),
+        ("LP Variables", len(hedges)),
+        ("LP Constraints", row_offset),
+        ("Solve Seconds", solve_seconds),
+    ], columns=['Metric', 'Value'])
+    message = (f"Hedged {notional.sum():,.0f} of {exposure.sum():,.0f} {base_currency} with {int((notional > 0).sum())} forwards "
+               f"({len(hedges)} buckets, LP solved in {solve_seconds * 1000:.0f} ms).")
+    if unhedgeable.sum() > 0:
+        message += f" {unhedgeable.sum():,.0f} {base_currency} is beyond the tenor or trade limits and can't be hedged."
+    unpriced = hedges.loc[np.isnan(rates), 'Currency'].unique()
+    if len(unpriced):
+        message += f" No {base_currency} rate for: {', '.join(unpriced)}; those buckets are left out."
+    return hedges, summary, message + invalid_date_note
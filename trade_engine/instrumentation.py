@@ -0,0 +1,167 @@
+"""
+Opt-in per-stage instrumentation of the loaders, processors, calculators and charts.
+
+Engine functions are wrapped with @instrumented and ad-hoc blocks use `with stage(...)`. Both
+only record while a StageRecorder is active in the current context (the app activates one per
+rerun of a session that turned diagnostics on). Otherwise the cost is a single ContextVar lookup.
+Each record has the stage name, its nesting depth, wall time, rows in and out and, when the
+recorder traces allocations, the net change of traced Python memory.
+"""
+
+import contextvars
+import functools
+import inspect
+import json
+import time
+import tracemalloc
+
+import pandas as pd
+
+STAGE_RECORD_COLUMNS = ['run', 'stage', 'depth', 'start_seconds', 'seconds', 'rows_in', 'rows_out', 'alloc_delta_bytes', 'error']
+
+_active_recorder = contextvars.ContextVar("trade_engine_stage_recorder", default=None)
+
+
+def count_rows(value):
+    """
+    Rows of a stage input or result: DataFrames, arrays and lists count their length, a tuple result
+    counts its first element, a dict of frames the sum of their rows (other dicts their length) and
+    an int is taken as a row count (e.g. a number of paths). Anything else counts as None.
+    """
+    if isinstance(value, tuple) and value:
+        value = value[0]
+    if isinstance(value, dict):
+        counts = [count_rows(item) for item in value.values()]
+        return sum(counts) if counts and all(isinstance(item, (pd.DataFrame, pd.Series)) for item in value.values()) else len(value)
+    if isinstance(value, (pd.DataFrame, pd.Series, list)):
+        return len(value)
+    if hasattr(value, "shape"):
+        return len(value) if getattr(value, "ndim", 0) > 0 else None
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    return None
+
+
+class _StageHandle:
+    """Yielded by a recorded stage; set rows_out when the stage's output isn't its return value."""
+
+    def __init__(self, recorder, name, rows_in):
+        self.recorder = recorder
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+
+    def __enter__(self):
+        self.depth = len(self.recorder._open_stages)
+        self.recorder._open_stages.append(self)
+        self._alloc_start = tracemalloc.get_traced_memory()[0] if self.recorder.traces_allocations else None
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        seconds = time.perf_counter() - self._start
+        alloc_delta = tracemalloc.get_traced_memory()[0] - self._alloc_start if self._alloc_start is not None and tracemalloc.is_tracing() else None
+        self.recorder._open_stages.pop()
+        self.recorder.records.append({
+            'run': self.recorder.run_id,
+            'stage': self.name,
+            'depth': self.depth,
+            'start_seconds': self._start - self.recorder.started_at,
+            'seconds': seconds,
+            'rows_in': self.rows_in,
+            'rows_out': self.rows_out,
+            'alloc_delta_bytes': alloc_delta,
+            'error': exc_type.__name__ if exc_type is not None else None,
+        })
+        return False
+
+
+class _NullStage:
+    """Shared no-op stage used while no recorder is active."""
+    rows_out = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+
+class StageRecorder:
+    """
+    Collects the stage records of one run (e.g. one Streamlit rerun). With trace_allocations the
+    recorder starts tracemalloc if nobody else did, and close() stops it again; tracing slows down
+    every allocation of the process while it is on.
+    """
+
+    def __init__(self, run_id=None, trace_allocations=False):
+        self.run_id = run_id
+        self.records = []
+        self.started_at = time.perf_counter()
+        self._open_stages = []
+        self._started_tracing = False
+        if trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self.traces_allocations = trace_allocations
+
+    def stage(self, name, rows_in=None):
+        return _StageHandle(self, name, rows_in)
+
+    def close(self):
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def to_frame(self):
+        return pd.DataFrame(self.records, columns=STAGE_RECORD_COLUMNS)
+
+
+def stage_records_to_json_lines(records):
+    """One JSON object per stage record, for structured log pipelines."""
+    return "".join(json.dumps(record) + "\n" for record in records)
+
+
+def activate_recorder(recorder):
+    """Makes recorder (or None to turn recording off) the active one of the current context."""
+    _active_recorder.set(recorder)
+
+
+def active_recorder():
+    return _active_recorder.get()
+
+
+def stage(name, rows_in=None):
+    """Context manager timing a block as a stage of the active recorder; a no-op when none is active."""
+    recorder = _active_recorder.get()
+    if recorder is None:
+        return _NULL_STAGE
+    return recorder.stage(name, rows_in)
+
+
+def instrumented(name=None, rows_in=None):
+    """
+    Decorator recording every call of a function as a stage. rows_in names the parameter whose
+    rows are counted as input (default: the first argument); rows out are counted from the result.
+    """
+    def decorate(fn):
+        stage_name = name or fn.__qualname__
+        signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            recorder = _active_recorder.get()
+            if recorder is None:
+                return fn(*args, **kwargs)
+            if rows_in is None:
+                input_value = args[0] if args else None
+            else:
+                input_value = signature.bind_partial(*args, **kwargs).arguments.get(rows_in)
+            with recorder.stage(stage_name, count_rows(input_value)) as handle:
+                result = fn(*args, **kwargs)
+                handle.rows_out = count_rows(result)
+            return result
+        return wrapper
+    return decorate
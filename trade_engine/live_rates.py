@@ -0,0 +1,203 @@
+"""
+Live FX rates: a background poller that reads ticks from a pluggable feed into bounded
+per-pair ring buffers.
+
+Readers (conversions, charts) only take a short lock to copy the latest ticks, so they never
+wait on the feed. The module does not import Streamlit; the app keeps one LiveRatePoller per
+server process and shares it across sessions.
+"""
+
+import abc
+import csv
+import math
+import os
+import threading
+import time
+
+import numpy as np
+
+LIVE_RING_CAPACITY = 4096 # Ticks kept per pair
+LIVE_POLL_SECONDS = 1.0
+
+
+class TickRingBuffer:
+    """Fixed-size buffer of (timestamp, rate) ticks; the oldest tick is overwritten when full."""
+
+    def __init__(self, capacity=LIVE_RING_CAPACITY):
+        self.capacity = capacity
+        self.timestamps = np.full(capacity, np.nan)
+        self.rates = np.full(capacity, np.nan)
+        self.count = 0 # Ticks written since creation; the next write goes to count % capacity
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, timestamp, rate):
+        with self._lock:
+            position = self.count % self.capacity
+            self.timestamps[position] = timestamp
+            self.rates[position] = rate
+            self.count += 1
+
+    def latest(self):
+        """Returns (timestamp, rate) of the newest tick, or None."""
+        with self._lock:
+            if self.count == 0:
+                return None
+            position = (self.count - 1) % self.capacity
+            return self.timestamps[position], self.rates[position]
+
+    def snapshot(self):
+        """Returns copies of (timestamps, rates) in arrival order."""
+        with self._lock:
+            if self.count <= self.capacity:
+                return self.timestamps[:self.count].copy(), self.rates[:self.count].copy()
+            start = self.count % self.capacity
+            return np.roll(self.timestamps, -start), np.roll(self.rates, -start)
+
+
+class LiveRateBook:
+    """One TickRingBuffer per pair, created on the first tick of the pair."""
+
+    def __init__(self, capacity=LIVE_RING_CAPACITY):
+        self.capacity = capacity
+        self.buffers = {}
+        self._lock = threading.Lock()
+
+    def record(self, pair, timestamp, rate):
+        buffer = self.buffers.get(pair)
+        if buffer is None:
+            with self._lock:
+                buffer = self.buffers.setdefault(pair, TickRingBuffer(self.capacity))
+        buffer.append(timestamp, rate)
+
+    def pairs(self):
+        return sorted(self.buffers)
+
+    def latest(self, pair):
+        buffer = self.buffers.get(pair)
+        return buffer.latest() if buffer is not None else None
+
+    def history(self, pair):
+        buffer = self.buffers.get(pair)
+        return buffer.snapshot() if buffer is not None else (np.empty(0), np.empty(0))
+
+
+class RateFeed(abc.ABC):
+    """Interface of a live rate source: poll() returns the ticks received since the last call."""
+
+    name = "feed"
+
+    @abc.abstractmethod
+    def poll(self):
+        """Returns a list of (pair, timestamp in epoch seconds, rate)."""
+
+
+class FileRateFeed(RateFeed):
+    """
+    Tails a CSV file of ticks with a 'pair,timestamp,rate' header, e.g. written by another
+    process or a test. Only lines appended since the last poll are read; a truncated or
+    replaced file is read again from the start.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.name = f"file {os.path.basename(file_path)}"
+        self._offset = 0
+        self._columns = None
+
+    def poll(self):
+        if not os.path.exists(self.file_path):
+            return []
+        if os.path.getsize(self.file_path) < self._offset:
+            self._offset, self._columns = 0, None
+
+        ticks = []
+        with open(self.file_path, newline="") as tick_file:
+            tick_file.seek(self._offset)
+            while True:
+                line = tick_file.readline()
+                if not line.endswith("\n"):
+                    break # Stop before a line that is still being written
+                self._offset = tick_file.tell()
+                values = next(csv.reader([line]), [])
+                if self._columns is None:
+                    self._columns = [value.strip().lower() for value in values]
+                    continue
+                tick = dict(zip(self._columns, values))
+                try:
+                    ticks.append((tick["pair"].strip().upper(), float(tick["timestamp"]), float(tick["rate"])))
+                except (KeyError, ValueError):
+                    continue # Skip malformed lines rather than stopping the feed
+        return ticks
+
+
+class SimulatedRateFeed(RateFeed):
+    """
+    Stand-in feed for development: every poll moves each pair by a lognormal step scaled to
+    the time since the previous poll, starting from the given rates (e.g. the sheet's latest fixes).
+    """
+
+    name = "simulated"
+
+    def __init__(self, start_rates, annual_vol=0.08, seed=None):
+        self.rates = {pair: float(rate) for pair, rate in start_rates.items() if rate and math.isfinite(rate) and rate > 0}
+        self.annual_vol = annual_vol
+        self._rng = np.random.default_rng(seed)
+        self._last_poll = None
+
+    def poll(self):
+        now = time.time()
+        elapsed = 0.0 if self._last_poll is None else now - self._last_poll
+        self._last_poll = now
+        step_vol = self.annual_vol * math.sqrt(elapsed / (365 * 24 * 3600))
+        shocks = self._rng.standard_normal(len(self.rates)) * step_vol - 0.5 * step_vol ** 2
+        ticks = []
+        for (pair, rate), shock in zip(list(self.rates.items()), shocks):
+            self.rates[pair] = rate * math.exp(shock)
+            ticks.append((pair, now, self.rates[pair]))
+        return ticks
+
+
+class LiveRatePoller:
+    """Daemon thread polling a RateFeed into a LiveRateBook every interval seconds."""
+
+    def __init__(self, feed, book=None, interval=LIVE_POLL_SECONDS):
+        self.feed = feed
+        self.book = book if book is not None else LiveRateBook()
+        self.interval = interval
+        self.ticks_received = 0
+        self.last_poll = None
+        self.last_error = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="live-rate-poller", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._thread.join(timeout)
+
+    @property
+    def running(self):
+        return self._thread.is_alive()
+
+    def poll_once(self):
+        ticks = self.feed.poll()
+        for pair, timestamp, rate in ticks:
+            self.book.record(pair, timestamp, rate)
+        self.ticks_received += len(ticks)
+        self.last_poll = time.time()
+        return len(ticks)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll_once()
+                self.last_error = None
+            except Exception as exc: # A failing feed must not kill the poller; report it and retry
+                self.last_error = str(exc)
+            self._stop.wait(self.interval)
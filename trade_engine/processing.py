@@ -0,0 +1,158 @@
+"""
+Turns the raw sheets of the workbook into the typed frames the calculators work on.
+
+Problems are reported through the "trade_engine" loggers; a process_* function never raises
+and returns an empty DataFrame when its sheet can't be processed.
+"""
+
+import logging
+
+import pandas as pd
+
+from .schemas import (
+    COLUMN_SCHEMA_BEANS,
+    COLUMN_SCHEMA_FX,
+    COLUMN_SCHEMA_VALO,
+    SCHEMA_DTYPE_CONVERTERS,
+    apply_column_schema,
+    get_inferred_schema,
+)
+from .workbook import (
+    SHEET_NAME_BEANS,
+    SHEET_NAME_FREIGHT,
+    SHEET_NAME_FX_FIX,
+    SHEET_NAME_FX_LIVE,
+    SHEET_NAME_PRODUCTS,
+    SHEET_NAME_VALO,
+)
+from .instrumentation import instrumented
+
+logger = logging.getLogger(__name__)
+
+
+@instrumented()
+def process_costing_beans(df_beans):
+    """Processes the 'Costing Beans' DataFrame."""
+    df_processed = pd.DataFrame()
+    if not df_beans.empty:
+        try:
+            # Select, convert and filter the relevant columns as declared in the schema
+            df_processed = apply_column_schema(df_beans, COLUMN_SCHEMA_BEANS)
+
+            if df_processed is None:
+                logger.warning("Required columns for processing 'Costing Beans' not found.")
+                df_processed = pd.DataFrame() # Return empty DataFrame if key columns are missing
+
+        except Exception as e:
+            logger.error(f"Error processing 'Costing Beans' sheet: {e}")
+            df_processed = pd.DataFrame() # Return empty DataFrame on error
+    return df_processed
+
+@instrumented()
+def process_fx_data(df_fx):
+    """Processes FX related DataFrames (Market & FX Fix/Live)."""
+    df_processed = pd.DataFrame()
+    if not df_fx.empty:
+        try:
+            # 'Quote Table', 'Delivery', 'Last' map to FX, VALUE DATE, FX RATE (see COLUMN_SCHEMA_FX)
+            df_processed = apply_column_schema(df_fx, COLUMN_SCHEMA_FX)
+
+            if df_processed is None:
+                logger.warning("Required columns for processing FX data not found (assuming 'Quote Table', 'Delivery', 'Last').")
+                df_processed = pd.DataFrame() # Return empty DataFrame if key columns is missing
+        except Exception as e:
+            logger.error(f"Error processing FX sheet: {e}")
+            df_processed = pd.DataFrame() # Return empty DataFrame on error
+    return df_processed
+
+
+@instrumented()
+def process_freight_data(df_freight):
+    """Processes the 'Freight & Dressing' DataFrame."""
+    df_processed = pd.DataFrame()
+    if not df_freight.empty:
+        try:
+            # Use the actual column names loaded with header=0
+            # Assuming column names are 'Origin', 'Destination', 'FreightCost' or similar after loading
+            # Need to inspect df_freight.columns after loading with header=0 to confirm
+            # For now, let's try more generic Unnamed columns as column names might not be clean
+            relevant_cols = [df_freight.columns[0], df_freight.columns[1], df_freight.columns[5]] if df_freight.shape[1] > 5 else [] # Assuming first 2 and 6th column based on index
+            if len(relevant_cols) == 3:
+                df_processed = df_freight[relevant_cols] # Copy-on-write: renaming/converting below never touches df_freight
+
+                # Rename columns for clarity
+                df_processed.columns = ['Origin', 'Destination', 'FreightCost']
+
+                # Explicitly convert columns to handle mixed types and ensure correct dtypes
+                # (lanes as categorical codes, costs as the configured rate dtype)
+                if 'Origin' in df_processed.columns:
+                    df_processed['Origin'] = SCHEMA_DTYPE_CONVERTERS["category"](df_processed['Origin'])
+                if 'Destination' in df_processed.columns:
+                    df_processed['Destination'] = SCHEMA_DTYPE_CONVERTERS["category"](df_processed['Destination'])
+                if 'FreightCost' in df_processed.columns:
+                    df_processed['FreightCost'] = SCHEMA_DTYPE_CONVERTERS["rate"](df_processed['FreightCost'])
+
+                subset_cols = [col for col in ['Origin', 'Destination', 'FreightCost'] if col in df_processed.columns]
+                # Only dropna if the columns actually exist in the dataframe
+                if subset_cols and not df_processed[subset_cols].empty:
+                     df_processed.dropna(subset=subset_cols, inplace=True)
+                     for col in ['Origin', 'Destination']:
+                         df_processed[col] = df_processed[col].cat.remove_unused_categories()
+                elif subset_cols: # If columns exist but are empty after selection
+                     df_processed = pd.DataFrame(columns=df_processed.columns) # Return empty with correct columns
+                else: # If no relevant columns were found at all
+                     df_processed = pd.DataFrame() # Return empty DataFrame
+
+            else:
+                logger.warning("Required columns for processing 'Freight & Dressing' not found (assuming first, second, and sixth columns).")
+                df_processed = pd.DataFrame()
+
+        except Exception as e:
+            logger.error(f"Error processing 'Freight & Dressing' sheet: {e}")
+            df_processed = pd.DataFrame()
+    return df_processed
+
+@instrumented()
+def process_costing_products_data(df_products):
+    """Processes the 'Costing Products' DataFrame."""
+    df_processed = pd.DataFrame()
+    if not df_products.empty:
+        try:
+            # The sheet has no fixed column layout, so its schema is inferred once from a sample
+            # and persisted; later loads convert each column in a single pass without inference
+            schema = get_inferred_schema(df_products, SHEET_NAME_PRODUCTS)
+            df_processed = apply_column_schema(df_products, schema)
+
+        except Exception as e:
+            logger.error(f"Error processing 'Costing Products' sheet: {e}")
+            df_processed = pd.DataFrame()
+    return df_processed
+
+@instrumented()
+def process_valo_data(df_valo):
+    """Processes the 'Valo Ori & Dest' DataFrame."""
+    df_processed = pd.DataFrame()
+    if not df_valo.empty:
+        try:
+            # Calculation columns are numeric; rows without Break Even or Margin are dropped
+            df_processed = apply_column_schema(df_valo, COLUMN_SCHEMA_VALO)
+
+            if df_processed is None:
+                logger.warning("Required columns for processing 'Valo Ori & Dest' not found.")
+                df_processed = pd.DataFrame()
+
+        except Exception as e:
+            logger.error(f"Error processing 'Valo Ori & Dest' sheet: {e}")
+            df_processed = pd.DataFrame()
+    return df_processed
+
+
+# Each loaded sheet is mapped to the function that processes it
+SHEET_PROCESSORS = {
+    SHEET_NAME_BEANS: process_costing_beans,
+    SHEET_NAME_PRODUCTS: process_costing_products_data,
+    SHEET_NAME_FREIGHT: process_freight_data,
+    SHEET_NAME_VALO: process_valo_data,
+    SHEET_NAME_FX_FIX: process_fx_data,
+    SHEET_NAME_FX_LIVE: process_fx_data, # Process live data similarly for now
+}
@@ -0,0 +1,223 @@
+"""
+Cost stacks of finished products from the 'Costing Products' form, the FX curves and the freight table.
+"""
+
+import re
+
+import numpy as np
+import pandas as pd
+
+from .freight import calculate_freight_costs_batch
+from .fx import FxCurveStore, convert_currency_bulk
+from .instrumentation import instrumented
+
+
+# Cost lines of the 'Costing Products' form: label -> (cost category, basis)
+#   "per_mt": amount per MT in column D (column C when D is empty)
+#   "pct": rate in column C applied to the bean value
+#   "annual_pct": annual rate in column C applied to the bean value over the months in column B
+PRODUCT_COST_LINES = {
+    'CERT PREMIUM': ('Bean', 'per_mt'),
+    'FINANCE': ('Finance & Insurance', 'annual_pct'),
+    'DOCS COSTS': ('Finance & Insurance', 'pct'),
+    'QUALITY CLAIM': ('Finance & Insurance', 'pct'),
+    'WEIGHT LOSS': ('Finance & Insurance', 'pct'),
+    'INSURANCE': ('Finance & Insurance', 'pct'),
+    'QUALITY CONTROLE DEP': ('Processing', 'per_mt'),
+    'QUALITY CONTROLE ARR': ('Processing', 'per_mt'),
+    'MELTING CACAO LIQUOR': ('Processing', 'per_mt'),
+    'MELTING CACAO BUTTER': ('Processing', 'per_mt'),
+    'SAMPLING': ('Processing', 'per_mt'),
+    'FAT ANALYSIS': ('Processing', 'per_mt'),
+    'FFA ANALYSIS': ('Processing', 'per_mt'),
+    'SALMONELLA ANALYSIS': ('Processing', 'per_mt'),
+    'SURCHARGE INBOUND LOOSE CARTONS': ('Packaging', 'per_mt'),
+    'CP-3 PALLET (ISPM-15)': ('Packaging', 'per_mt'),
+    'SHRINKING FOIL': ('Packaging', 'per_mt'),
+    'DTHC': ('Logistics', 'per_mt'),
+    'CIF TO INSTORE': ('Logistics', 'per_mt'),
+    'WAREHOUSE RENTAL': ('Logistics', 'per_mt'),
+    'COURRIER COSTS': ('Logistics', 'per_mt'),
+    'EX-A / EU-A /& T-1 (TRANSIT DOC)': ('Logistics', 'per_mt'),
+    'ADMIN FEE FOR DET&DEM': ('Logistics', 'per_mt'),
+    'FREIGHT': ('Freight', 'per_mt'), # Fallback when a product's lane has no rate in the freight table
+    'DRESSING': ('Freight', 'per_mt'),
+}
+# Labels that open a block of lines priced in the currency given in the header's column C
+PRODUCT_COST_BLOCK_HEADERS = ['WAREHOUSE']
+COST_STACK_CATEGORIES = ['Bean', 'Processing', 'Packaging', 'Logistics', 'Freight', 'Finance & Insurance']
+# Columns of the products table priced by calculate_costing_products
+PRODUCT_COLUMNS = ['Product', 'QuantityMT', 'BeanCost', 'BeanCurrency', 'Origin', 'Destination']
+
+@instrumented()
+def extract_product_cost_lines(products_df):
+    """
+    Extracts the cost lines of the 'Costing Products' form (labels in the first column, see
+    PRODUCT_COST_LINES) with their category, basis, amount or rate, currency and include flag
+    (column F; lines without a flag are included). Currencies missing on a line come from the
+    enclosing block header; lines without any currency are in the base currency (NaN).
+    """
+    if products_df.shape[1] < 6:
+        return pd.DataFrame(columns=['Component', 'Category', 'Basis', 'Amount', 'Currency', 'Included'])
+
+    labels = products_df.iloc[:, 0].astype(str).str.strip().str.upper()
+    months = pd.to_numeric(products_df.iloc[:, 1], errors='coerce')
+    column_c = products_df.iloc[:, 2]
+    column_c_numeric = pd.to_numeric(column_c, errors='coerce')
+    column_d_numeric = pd.to_numeric(products_df.iloc[:, 3], errors='coerce')
+    include_flags = pd.to_numeric(products_df.iloc[:, 5], errors='coerce')
+
+    currency_cells = column_c.astype(str).str.strip().str.upper()
+    currency_cells = currency_cells.where(column_c.notna() & currency_cells.str.fullmatch(r"[A-Z]{3}"))
+    block_currencies = currency_cells.where(labels.isin(PRODUCT_COST_BLOCK_HEADERS)).ffill()
+
+    categories = labels.map(lambda label: PRODUCT_COST_LINES.get(label, (None, None))[0])
+    bases = labels.map(lambda label: PRODUCT_COST_LINES.get(label, (None, None))[1])
+    amounts = column_d_numeric.fillna(column_c_numeric).where(bases == 'per_mt', column_c_numeric)
+    # Annual rates only apply for the financed months
+    amounts = amounts.where(bases != 'annual_pct', amounts * months.fillna(12) / 12)
+
+    cost_lines = pd.DataFrame({
+        'Component': labels,
+        'Category': categories,
+        'Basis': bases,
+        'Amount': amounts,
+        'Currency': currency_cells.fillna(block_currencies),
+        'Included': include_flags.fillna(1) != 0,
+    })
+    return cost_lines[cost_lines['Category'].notna() & cost_lines['Amount'].notna()].reset_index(drop=True)
+
+
+def sheet_fixed_price(products_df):
+    """Returns (price, currency) of the 'FIXED PRICE' row of the form that carries a price, or (None, None)."""
+    fixed_price_rows = products_df[products_df.astype(str).apply(lambda col: col.str.strip().str.upper()).eq('FIXED PRICE').any(axis=1)]
+    for _, row in fixed_price_rows.iterrows():
+        prices = pd.to_numeric(row, errors='coerce').dropna()
+        currencies = [str(value).strip() for value in row.dropna() if re.fullmatch(r"[A-Z]{3}", str(value).strip())]
+        if not prices.empty:
+            return float(prices.iloc[-1]), currencies[0] if currencies else None
+    return None, None
+
+
+def sheet_port_pair(products_df):
+    """Returns (POL, POD) from the 'TC & POL & POD' row of the form, or (None, None)."""
+    labels = products_df.iloc[:, 0].astype(str).str.strip().str.upper()
+    port_rows = products_df[labels == 'TC & POL & POD']
+    if port_rows.empty or products_df.shape[1] < 4:
+        return None, None
+    return str(port_rows.iloc[0, 2]), str(port_rows.iloc[0, 3])
+
+
+@instrumented()
+def calculate_costing_products(products_df, input_params):
+    """
+    Computes the full cost stack per product (bean, processing, packaging, logistics, freight,
+    finance & insurance) in the base currency for every product at once, with column
+    arithmetic and joins instead of per-product loops.
+    products_df is the processed 'Costing Products' sheet, the source of the cost lines.
+    input_params is a dictionary with:
+        "products": DataFrame with PRODUCT_COLUMNS (bean cost per MT in BeanCurrency)
+        "base_currency": currency of the results, e.g. "USD"
+        "fx_df", "fx_curves": processed Market & FX Fix data and its FxCurveStore
+        "freight_df", "freight_index": processed freight data and its FreightRateIndex
+        "freight_currency": currency of the freight table rates
+    Returns (cost_stack_df, message, cost_lines_df); cost_stack_df is None if nothing can be computed.
+    A product's totals are NaN when its bean cost, an included cost line or its freight can't be
+    priced; its 'Status' says which.
+    """
+    if products_df.empty:
+        return None, "Costing Products data not available.", pd.DataFrame()
+
+    products = input_params.get("products", pd.DataFrame())
+    missing_columns = [col for col in PRODUCT_COLUMNS if col not in products.columns]
+    if missing_columns:
+        return None, f"Missing product column(s): {', '.join(missing_columns)}.", pd.DataFrame()
+    if products.empty:
+        return None, "No products to cost.", pd.DataFrame()
+
+    base_currency = input_params.get("base_currency", "USD")
+    fx_df = input_params.get("fx_df", pd.DataFrame())
+    fx_curves = input_params.get("fx_curves")
+    if fx_curves is None:
+        fx_curves = FxCurveStore(fx_df)
+    warnings = []
+
+    # 1. Cost lines from the sheet, converted to the base currency in one bulk conversion
+    cost_lines = extract_product_cost_lines(products_df)
+    line_currencies = cost_lines['Currency'].fillna(base_currency)
+    line_conversions, _ = convert_currency_bulk(fx_df, pd.DataFrame({
+        'FX': line_currencies + base_currency,
+        'VALUE DATE': pd.NaT,
+        'AMOUNT': cost_lines['Amount'],
+    }), curve_store=fx_curves)
+    is_rate_line = cost_lines['Basis'] != 'per_mt'
+    # Rates are unit-less; zero amounts don't need an FX rate
+    cost_lines['AmountBase'] = np.where(
+        is_rate_line | (cost_lines['Amount'] == 0),
+        cost_lines['Amount'],
+        line_conversions['CONVERTED AMOUNT'] if line_conversions is not None else np.nan,
+    )
+    unconverted_lines = cost_lines[cost_lines['Included'] & cost_lines['AmountBase'].isna()]
+    if not unconverted_lines.empty:
+        warnings.append(f"No FX rate to {base_currency} for: " + ", ".join(unconverted_lines['Component'] + " (" + unconverted_lines['Currency'].fillna(base_currency) + ")") + ".")
+
+    included_lines = cost_lines[cost_lines['Included']]
+    is_sheet_freight = included_lines['Component'] == 'FREIGHT'
+    # An unconverted line makes its category (and so the total) NaN instead of silently counting as 0
+    per_mt_costs = included_lines[(included_lines['Basis'] == 'per_mt') & ~is_sheet_freight].groupby('Category')['AmountBase'].sum(skipna=False)
+    value_rate = included_lines.loc[included_lines['Basis'] != 'per_mt', 'AmountBase'].sum(skipna=False)
+    sheet_freight_per_mt = included_lines.loc[is_sheet_freight, 'AmountBase'].sum(skipna=False) if is_sheet_freight.any() else np.nan
+
+    # 2. Bean cost per product, converted in one bulk conversion
+    quantities = pd.to_numeric(products['QuantityMT'], errors='coerce').to_numpy(dtype='float64')
+    bean_currencies = products['BeanCurrency'].fillna(base_currency).astype(str).str.strip().str.upper()
+    bean_conversions, _ = convert_currency_bulk(fx_df, pd.DataFrame({
+        'FX': (bean_currencies + base_currency).to_numpy(),
+        'VALUE DATE': pd.NaT,
+        'AMOUNT': pd.to_numeric(products['BeanCost'], errors='coerce').to_numpy(),
+    }), curve_store=fx_curves)
+    bean_cost = bean_conversions['CONVERTED AMOUNT'].to_numpy(dtype='float64') if bean_conversions is not None else np.full(len(products), np.nan)
+
+    # 3. Freight per MT from the lane table (one merge), else the sheet's FREIGHT line, else none (NaN)
+    freight_df = input_params.get("freight_df", pd.DataFrame())
+    freight_rates = np.full(len(products), np.nan)
+    if not freight_df.empty:
+        lane_quotes, _ = calculate_freight_costs_batch(
+            freight_df, products[['Origin', 'Destination']].assign(QuantityMT=1.0), rate_index=input_params.get("freight_index")
+        )
+        if lane_quotes is not None:
+            freight_currency = input_params.get("freight_currency", base_currency)
+            freight_conversions, _ = convert_currency_bulk(fx_df, pd.DataFrame({
+                'FX': freight_currency + base_currency,
+                'VALUE DATE': pd.NaT,
+                'AMOUNT': lane_quotes['FreightRate'].to_numpy(),
+            }), curve_store=fx_curves)
+            if freight_conversions is not None:
+                freight_rates = freight_conversions['CONVERTED AMOUNT'].to_numpy(dtype='float64')
+    has_lane_rate = ~np.isnan(freight_rates)
+    has_sheet_freight = bool(is_sheet_freight.any())
+    freight_cost = np.where(has_lane_rate, freight_rates, sheet_freight_per_mt)
+    has_freight = has_lane_rate | has_sheet_freight
+
+    # 4. Cost stack: every column is one vectorized expression over all products
+    cost_stack = pd.DataFrame({'Product': products['Product'].to_numpy(), 'QuantityMT': quantities})
+    cost_stack['Bean'] = bean_cost + per_mt_costs.get('Bean', 0.0)
+    cost_stack['Processing'] = per_mt_costs.get('Processing', 0.0)
+    cost_stack['Packaging'] = per_mt_costs.get('Packaging', 0.0)
+    cost_stack['Logistics'] = per_mt_costs.get('Logistics', 0.0)
+    cost_stack['Freight'] = freight_cost + per_mt_costs.get('Freight', 0.0)
+    cost_stack['Finance & Insurance'] = bean_cost * value_rate
+    cost_stack['TotalPerMT'] = cost_stack[COST_STACK_CATEGORIES].sum(axis=1, min_count=len(COST_STACK_CATEGORIES))
+    cost_stack['TotalCost'] = cost_stack['TotalPerMT'] * quantities
+    cost_stack['FreightSource'] = np.select([has_lane_rate, has_freight], ["freight table", "sheet FREIGHT line"], default="none")
+    cost_stack['Status'] = np.select(
+        [np.isnan(bean_cost), np.full(len(products), not unconverted_lines.empty), ~has_freight, np.isnan(quantities)],
+        [f"No FX rate from bean currency to {base_currency}", f"Unconverted cost lines (no FX rate to {base_currency})", "No freight rate", "Invalid quantity"],
+        default="OK",
+    )
+
+    costed_products = int((cost_stack['Status'] == "OK").sum())
+    message = f"Costed {costed_products} of {len(cost_stack)} products in {base_currency} using {len(included_lines)} cost lines from the sheet."
+    if warnings:
+        message += " " + " ".join(warnings)
+    return cost_stack, message, cost_lines
@@ -0,0 +1,159 @@
+"""
+Monte Carlo margin-at-risk for a physical cocoa position.
+
+Paths of the EURUSD rate and of the buying diff, selling diff and costing are generated in
+chunks of NumPy arrays and each path is valued like calculate_valuation in valuation.py
+(Selling Diff of the nearest Valo row minus Buying Diff plus Costing). Freight is not simulated
+as a factor of its own: it is taken as part of the costing, whose daily vol covers both. This
+module does not import Streamlit, so the chunks can run in a process pool.
+"""
+
+import math
+
+import numpy as np
+import pandas as pd
+
+from .instrumentation import instrumented
+from .valuation import ValuationLookup, calculate_valuation, nearest_positions
+
+TRADING_DAYS_PER_YEAR = 252
+RISK_CHUNK_BYTES = 32 * 1024 * 1024 # Memory budget of the path arrays of one chunk
+RISK_MIN_CHUNK_PATHS = 1_000
+RISK_MAX_CHUNK_PATHS = 100_000
+RISK_CONFIDENCE_LEVELS = [0.95, 0.99]
+RISK_FX_PAIR = "EURUSD" # Pair that revalues the EUR share of the costing
+RISK_MIN_FX_RETURNS = 20 # Fewer historical returns than this can't be bootstrapped meaningfully
+RISK_PARALLEL_MIN_PATHS = 50_000 # Smaller runs finish faster in-process than through a pool
+
+
+def fx_log_returns(rates):
+    """Daily log returns of a rate series, skipping non-positive or missing rates."""
+    rates = np.asarray(rates, dtype='float64')
+    rates = rates[np.isfinite(rates) & (rates > 0)]
+    return np.diff(np.log(rates))
+
+
+def chunk_path_count(horizon_days):
+    """Paths per chunk so that one chunk's bootstrap arrays (indices and returns) fit RISK_CHUNK_BYTES."""
+    paths = RISK_CHUNK_BYTES // (16 * max(int(horizon_days), 1))
+    return int(min(max(paths, RISK_MIN_CHUNK_PATHS), RISK_MAX_CHUNK_PATHS))
+
+
+def simulate_margin_chunk(params, n_paths, seed):
+    """
+    Simulates n_paths margins per MT at the horizon for the position described by params:
+        "buying_diff", "costing": position inputs, as for calculate_valuation
+        "eur_cost_share": share of the costing paid in EUR, revalued with the EURUSD paths
+        "horizon_days": number of trading days simulated
+        "fx_model": "bootstrap" (resample "fx_returns", the sheet's daily log returns) or
+                    "parametric" (driftless lognormal with "fx_annual_vol")
+        "buying_diff_daily_vol", "selling_diff_daily_vol", "costing_daily_vol": normal daily moves per MT
+            (the costing includes freight, which has no vol of its own)
+        "valo_buying_diffs", "valo_selling_diffs", "valo_rows": sorted arrays of a ValuationLookup
+    Returns a float64 array of margins per MT.
+    """
+    rng = np.random.default_rng(seed)
+    horizon_days = max(int(params["horizon_days"]), 1)
+    horizon_scale = math.sqrt(horizon_days)
+
+    if params["fx_model"] == "bootstrap":
+        fx_returns = params["fx_returns"]
+        fx_log_moves = fx_returns[rng.integers(0, len(fx_returns), size=(n_paths, horizon_days))].sum(axis=1)
+    else:
+        # The sum of daily normal log returns over the horizon is itself normal, so one draw per path suffices
+        horizon_vol = params["fx_annual_vol"] * math.sqrt(horizon_days / TRADING_DAYS_PER_YEAR)
+        fx_log_moves = rng.standard_normal(n_paths) * horizon_vol - 0.5 * horizon_vol ** 2
+
+    buying_diffs = params["buying_diff"] + rng.standard_normal(n_paths) * params["buying_diff_daily_vol"] * horizon_scale
+    selling_shocks = rng.standard_normal(n_paths) * params["selling_diff_daily_vol"] * horizon_scale
+    costings = params["costing"] + rng.standard_normal(n_paths) * params["costing_daily_vol"] * horizon_scale
+
+    positions = nearest_positions(params["valo_buying_diffs"], params["valo_rows"], buying_diffs)
+    selling_diffs = params["valo_selling_diffs"][positions] + selling_shocks
+    eur_cost_share = params["eur_cost_share"]
+    costings = costings * (1.0 - eur_cost_share + eur_cost_share * np.exp(fx_log_moves))
+    return selling_diffs - (buying_diffs + costings)
+
+
+@instrumented(rows_in="n_paths")
+def simulate_margins(params, n_paths, seed=None, executor=None):
+    """
+    Simulates n_paths margins per MT in independent chunks (see chunk_path_count), each with its
+    own child seed so results do not depend on how the chunks are scheduled. With an executor
+    (e.g. a ProcessPoolExecutor) the chunks run in parallel; otherwise they run in this process.
+    """
+    chunk_paths = chunk_path_count(params["horizon_days"])
+    chunk_sizes = [chunk_paths] * (n_paths // chunk_paths)
+    if n_paths % chunk_paths:
+        chunk_sizes.append(n_paths % chunk_paths)
+    seeds = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+
+    if executor is None:
+        chunks = [simulate_margin_chunk(params, size, chunk_seed) for size, chunk_seed in zip(chunk_sizes, seeds)]
+    else:
+        chunks = list(executor.map(simulate_margin_chunk, [params] * len(chunk_sizes), chunk_sizes, seeds))
+    return np.concatenate(chunks) if chunks else np.empty(0)
+
+
+def margin_risk_summary(margins_per_mt, quantity_mt, confidence_levels=RISK_CONFIDENCE_LEVELS):
+    """
+    Summarizes simulated margins for a position of quantity_mt.
+    Value at Risk and Expected Shortfall are measured from the expected margin: VaR is the
+    expected P&L minus the (1 - confidence) quantile, ES the expected P&L minus the mean of the
+    outcomes at or below that quantile. Returns a DataFrame with one row per metric.
+    """
+    pnl = margins_per_mt * quantity_mt
+    expected_pnl = pnl.mean()
+    rows = [
+        ("Expected Margin per MT", margins_per_mt.mean()),
+        ("Margin Std Dev per MT", margins_per_mt.std()),
+        ("Expected P&L", expected_pnl),
+        ("Probability of Negative Margin", (margins_per_mt < 0).mean()),
+    ]
+    for confidence in confidence_levels:
+        threshold = np.quantile(pnl, 1.0 - confidence)
+        rows.append((f"VaR {confidence:.0%}", expected_pnl - threshold))
+        rows.append((f"Expected Shortfall {confidence:.0%}", expected_pnl - pnl[pnl <= threshold].mean()))
+    return pd.DataFrame(rows, columns=['Metric', 'Value'])
+
+
+@instrumented()
+def calculate_margin_at_risk(valo_df, fx_curves, position, n_paths, seed=None, lookup=None, executor=None, workers=None):
+    """
+    Simulates the margin distribution of a position by Monte Carlo (see simulate_margin_chunk).
+    position is a dictionary with "buying_diff", "costing", "quantity_mt", "eur_cost_share",
+    "horizon_days", "fx_model" ("bootstrap" or "parametric"), "fx_annual_vol" and the daily vols
+    "buying_diff_daily_vol", "selling_diff_daily_vol", "costing_daily_vol".
+    Pass a process pool as executor to spread the chunks over its workers, and its worker count
+    as workers for the message.
+    Returns (summary DataFrame, margins per MT array, message); the DataFrame is None on error.
+    """
+    base_break_even, base_margin, base_message = calculate_valuation(valo_df, position["buying_diff"], position["costing"], lookup=lookup)
+    if base_margin is None:
+        return None, None, base_message
+    if lookup is None:
+        lookup = ValuationLookup(valo_df)
+
+    fx_returns = np.empty(0)
+    if RISK_FX_PAIR in fx_curves.curves:
+        fx_returns = fx_log_returns(fx_curves.curves[RISK_FX_PAIR][1])
+    if position["fx_model"] == "bootstrap" and len(fx_returns) < RISK_MIN_FX_RETURNS:
+        return None, None, f"Not enough {RISK_FX_PAIR} history to bootstrap ({len(fx_returns)} daily returns); use the parametric model."
+
+    params = {
+        **position,
+        "fx_returns": fx_returns,
+        "valo_buying_diffs": lookup.buying_diffs,
+        "valo_selling_diffs": lookup.selling_diffs,
+        "valo_rows": lookup.rows,
+    }
+    margins_per_mt = simulate_margins(params, n_paths, seed=seed, executor=executor)
+
+    summary = margin_risk_summary(margins_per_mt, position["quantity_mt"])
+    summary = pd.concat([pd.DataFrame([("Base Margin per MT", base_margin)], columns=summary.columns), summary], ignore_index=True)
+    if executor is None:
+        scheduling = "in-process"
+    else:
+        scheduling = f"{workers} worker processes" if workers else "in a process pool"
+    message = f"Simulated {n_paths:,} paths ({scheduling}). Base case: {base_message}"
+    return summary, margins_per_mt, message
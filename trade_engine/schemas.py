@@ -0,0 +1,157 @@
+"""
+Declarative column schemas of the workbook sheets and the helpers that apply them.
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+import pandas as pd
+
+from .snapshots import SNAPSHOT_CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+# Storage type of the rate columns (FX rates, freight costs): "float32" halves their memory and
+# keeps about 7 significant digits, plenty for quoted rates; calculations still run in float64
+RATE_DTYPE = os.environ.get("TRADE_ENGINE_RATE_DTYPE", "float64")
+if RATE_DTYPE not in ("float64", "float32"):
+    raise ValueError(f"TRADE_ENGINE_RATE_DTYPE must be 'float64' or 'float32', not '{RATE_DTYPE}'")
+
+# Declarative column schemas used by the process_* functions. Each source column maps to:
+#   "dtype": "str", "category", "numeric", "rate" or "datetime" (converted in a single pass,
+#            invalid values become NaN/NaT). "category" stores each distinct text once plus
+#            integer codes, so filters on pairs and lanes compare integers; "rate" is numeric
+#            stored as RATE_DTYPE
+#   "rename": optional new column name
+#   "required": rows without a value in this column are dropped
+COLUMN_SCHEMA_BEANS = {
+    'FX': {"dtype": "category", "required": True},
+    'VALUE DATE': {"dtype": "datetime", "required": True},
+    'FX RATE': {"dtype": "rate", "required": True},
+    'Unnamed: 4': {"dtype": "numeric", "required": True},
+}
+COLUMN_SCHEMA_FX = { # Market & FX Fix / Live
+    'Quote Table': {"dtype": "category", "rename": "FX", "required": True},
+    'Delivery': {"dtype": "datetime", "rename": "VALUE DATE", "required": True},
+    'Last': {"dtype": "rate", "rename": "FX RATE", "required": True},
+}
+COLUMN_SCHEMA_VALO = {
+    'Buying Diff': {"dtype": "numeric"},
+    'Costings': {"dtype": "numeric"},
+    'Break Even': {"dtype": "numeric", "required": True},
+    'Selling Diff': {"dtype": "numeric"},
+    'Margin': {"dtype": "numeric", "required": True},
+}
+# 'Costing Products' has no fixed layout: its schema is inferred from a sample and persisted
+SCHEMA_INFERENCE_SAMPLE_ROWS = 200
+
+def to_category(column):
+    """Text column as a categorical with sorted text categories; categorical text columns are returned as they are."""
+    if isinstance(column.dtype, pd.CategoricalDtype) and pd.api.types.is_string_dtype(column.cat.categories):
+        return column
+    return column.astype(str).astype('category')
+
+
+SCHEMA_DTYPE_CONVERTERS = {
+    "str": lambda column: column.astype(str),
+    "category": to_category,
+    "numeric": lambda column: pd.to_numeric(column, errors='coerce'),
+    "rate": lambda column: pd.to_numeric(column, errors='coerce').astype(RATE_DTYPE),
+    "datetime": lambda column: pd.to_datetime(column, errors='coerce'),
+}
+
+def apply_column_schema(df, schema):
+    """
+    Selects, converts and renames the schema's columns in one pass and drops rows missing a
+    required value. Schema columns absent from df are skipped; returns None if none are present.
+    """
+    present_columns = [col for col in schema if col in df.columns]
+    if not present_columns:
+        return None
+
+    df_processed = pd.DataFrame({
+        schema[col].get("rename", col): SCHEMA_DTYPE_CONVERTERS[schema[col]["dtype"]](df[col])
+        for col in present_columns
+    })
+    required_columns = [schema[col].get("rename", col) for col in present_columns if schema[col].get("required")]
+    if required_columns:
+        df_processed = df_processed.dropna(subset=required_columns)
+        # Dropped rows may leave categories no row uses any more
+        for col in df_processed.select_dtypes(include='category').columns:
+            df_processed[col] = df_processed[col].cat.remove_unused_categories()
+    return df_processed
+
+
+def sample_values(column, sample_rows=SCHEMA_INFERENCE_SAMPLE_ROWS):
+    """A reproducible sample of a column's non-empty values."""
+    values = column.dropna()
+    if len(values) > sample_rows:
+        values = values.sample(n=sample_rows, random_state=0)
+    return values
+
+
+def infer_column_schema(df, sample_rows=SCHEMA_INFERENCE_SAMPLE_ROWS):
+    """
+    Infers a column schema from a sample of each column's non-empty values: numeric if every
+    sampled value is a number, datetime if every one is a date, text otherwise (mixed label and
+    number columns stay readable). Empty columns are numeric so they display as NaN.
+    """
+    schema = {}
+    for col in df.columns:
+        values = sample_values(df[col], sample_rows)
+
+        if values.empty or pd.to_numeric(values, errors='coerce').notna().all():
+            schema[col] = {"dtype": "numeric"}
+        elif pd.api.types.infer_dtype(values, skipna=True) in ("datetime", "datetime64", "date"):
+            schema[col] = {"dtype": "datetime"}
+        else:
+            schema[col] = {"dtype": "str"}
+    return schema
+
+
+def schema_path(sheet_name):
+    """Location of the persisted inferred schema of a sheet."""
+    return os.path.join(SNAPSHOT_CACHE_DIR, "schemas", f"{hashlib.sha256(sheet_name.encode()).hexdigest()[:16]}.json")
+
+
+def schema_fits_sample(df, schema, sample_rows=SCHEMA_INFERENCE_SAMPLE_ROWS):
+    """
+    Whether converting a sample of each column with its schema dtype keeps every non-empty value,
+    i.e. no numeric or datetime column has started to hold text since the schema was inferred.
+    """
+    for col, column_schema in schema.items():
+        values = sample_values(df[col], sample_rows)
+        if SCHEMA_DTYPE_CONVERTERS[column_schema["dtype"]](values).isna().any():
+            return False
+    return True
+
+
+def get_inferred_schema(df, sheet_name):
+    """
+    Returns the persisted inferred schema of a sheet if it still matches the sheet's columns and
+    still converts a sample of their values without losing any, otherwise infers a new one from a
+    sample and persists it so later loads skip inference.
+    """
+    column_names = [str(col) for col in df.columns]
+    path = schema_path(sheet_name)
+    try:
+        with open(path) as f:
+            persisted = json.load(f)
+        if persisted.get("columns") == column_names:
+            schema = dict(zip(df.columns, persisted["schema"]))
+            if schema_fits_sample(df, schema):
+                return schema
+            logger.info(f"The column types of '{sheet_name}' changed; inferring its schema again.")
+    except (OSError, ValueError, KeyError):
+        pass # No usable persisted schema yet
+
+    schema = infer_column_schema(df)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"sheet": sheet_name, "columns": column_names, "schema": [schema[col] for col in df.columns]}, f, indent=1)
+    except OSError as e:
+        logger.warning(f"Could not persist the inferred schema of '{sheet_name}': {e}")
+    return schema
@@ -0,0 +1,227 @@
+"""
+Bump-and-reprice sensitivities of a book's margin to every FX pair, every freight lane and the
+buying and selling diffs.
+
+Each deal of the book is valued like calculate_valuation (Selling Diff of the nearest Valo row
+minus Buying Diff plus costing) with a costing made of two legs converted to the base currency:
+'Costings' in the deal's CostCurrency and, when the deal has a lane, the lane's freight rate in
+the freight currency:
+
+    margin = QuantityMT * (Selling Diff - Buying Diff - Costings * fx(CostCurrency) - freight rate * fx(freight currency))
+
+The book is priced once, and that pass keeps the partial results every bump needs: the base-currency
+amount of each FX leg grouped by how its rate was built from the curves (direct, inverse or a cross
+of two curve pairs), and the base-currency quantity on each lane. A relative bump b of a curve pair
+multiplies a leg's rate by (1 + b) ** exponent (-1 for an inverse, one factor per cross leg), so the
+repriced margins of all pairs are one matrix expression over those groups; a lane bump moves the
+margin by its quantity times the converted bump. Only the buying diff needs a second lookup of the
+nearest Valo rows (one vectorized pass each way). Every bump is a full revaluation, not a linear
+approximation, yet a ladder over all pairs and lanes costs a few array operations.
+"""
+
+import numpy as np
+import pandas as pd
+
+from .fx import FX_TRIANGULATION_CURRENCIES, convert_currency_bulk, parse_value_dates
+from .instrumentation import instrumented, stage
+from .valuation import ValuationLookup
+
+# Columns of a book priced by calculate_sensitivities; CostCurrency, Origin, Destination and VALUE DATE are optional
+SENSITIVITY_BOOK_COLUMNS = ['Buying Diff', 'Costings', 'QuantityMT']
+SENSITIVITY_LADDER_COLUMNS = ['Factor Type', 'Factor', 'Base Value', 'Bump', 'Bump Unit', 'P&L Up', 'P&L Down', 'Delta', 'Gamma']
+
+# Settings of calculate_sensitivities
+SENSITIVITY_DEFAULT_SETTINGS = {
+    "base_currency": "USD",
+    "freight_currency": "USD", # Currency of the freight table rates
+    "fx_bump_pct": 1.0, # Relative bump of every FX curve pair, in percent of its rate
+    "freight_bump": 1.0, # Bump of every lane rate, per MT in the freight currency
+    "diff_bump": 1.0, # Bump of the buying and selling diffs, per MT
+    "include_unused": False, # Also list the pairs and lanes the book does not depend on
+}
+
+
+def leg_exponents(curve_pairs, pair, rate_source):
+    """
+    {curve pair: exponent} of the curve rates a conversion rate of convert_currency_bulk is built
+    from: the pair itself (1), the reversed pair (-1) or, for a cross via a currency, one of both
+    for each leg. A leg counts as direct when its pair has a curve, as convert_currency_bulk
+    prefers the direct quote.
+    """
+    if rate_source == "direct":
+        return {pair: 1}
+    if rate_source == "inverse":
+        return {pair[3:] + pair[:3]: -1}
+    exponents = {}
+    for via_currency in FX_TRIANGULATION_CURRENCIES:
+        if rate_source != f"cross via {via_currency}":
+            continue
+        for leg in (pair[:3] + via_currency, via_currency + pair[3:]):
+            if leg in curve_pairs:
+                exponents[leg] = 1
+            else:
+                exponents[leg[3:] + leg[:3]] = -1
+    return exponents
+
+
+def bump_ladder(factor_type, factors, base_values, bump, bump_unit, pnl_up, pnl_down):
+    """Ladder rows of one factor type; delta is the P&L of a one-bump move (central difference), gamma its convexity."""
+    return pd.DataFrame({
+        'Factor Type': factor_type,
+        'Factor': factors,
+        'Base Value': base_values,
+        'Bump': bump,
+        'Bump Unit': bump_unit,
+        'P&L Up': pnl_up,
+        'P&L Down': pnl_down,
+        'Delta': (pnl_up - pnl_down) / 2,
+        'Gamma': pnl_up + pnl_down,
+    })
+
+
+@instrumented(rows_in="book_df")
+def calculate_sensitivities(valo_df, book_df, fx_curves, freight_index, settings=None, lookup=None):
+    """
+    Delta ladder of a book's margin (see the module docstring). book_df needs SENSITIVITY_BOOK_COLUMNS
+    and may have 'CostCurrency' (currency of 'Costings', default the base currency), 'Origin' and
+    'Destination' (the freight lane, priced from freight_index) and 'VALUE DATE' (date of the FX
+    rates, default the latest). settings override SENSITIVITY_DEFAULT_SETTINGS.
+    Pass a prebuilt lookup (ValuationLookup of valo_df) to avoid re-sorting the sheet.
+    Returns (ladder DataFrame with SENSITIVITY_LADDER_COLUMNS, the book with its base margin per
+    deal and a 'Status', message). The DataFrames are None on error.
+    """
+    settings = {**SENSITIVITY_DEFAULT_SETTINGS, **(settings or {})}
+    if valo_df.empty:
+        return None, None, "Valuation data not available."
+    if 'Buying Diff' not in valo_df.columns or 'Selling Diff' not in valo_df.columns:
+        return None, None, "Required columns for valuation calculation not found ('Buying Diff', 'Selling Diff')."
+    missing_columns = [col for col in SENSITIVITY_BOOK_COLUMNS if col not in book_df.columns]
+    if missing_columns:
+        return None, None, f"Missing column(s) in book: {', '.join(missing_columns)}."
+    if book_df.empty:
+        return None, None, "No deals in the book."
+
+    if lookup is None:
+        lookup = ValuationLookup(valo_df)
+    if len(lookup) == 0:
+        return None, None, "Valuation data empty after processing 'Buying Diff'."
+
+    base_currency = settings["base_currency"].strip().upper()
+    freight_currency = settings["freight_currency"].strip().upper()
+    book = book_df.copy()
+    deal_count = len(book)
+    buying_diffs = pd.to_numeric(book['Buying Diff'], errors='coerce').to_numpy(dtype='float64')
+    costings = pd.to_numeric(book['Costings'], errors='coerce').to_numpy(dtype='float64')
+    quantities = pd.to_numeric(book['QuantityMT'], errors='coerce').to_numpy(dtype='float64')
+    cost_currencies = book['CostCurrency'].fillna(base_currency) if 'CostCurrency' in book.columns else pd.Series(base_currency, index=book.index)
+    cost_currencies = cost_currencies.astype(str).str.strip().str.upper()
+    # Missing dates price at the latest rate; dates that don't parse are not priced at all
+    value_dates, invalid_value_dates = parse_value_dates(book['VALUE DATE'] if 'VALUE DATE' in book.columns else pd.Series(pd.NaT, index=book.index))
+
+    # 1. Base pricing, keeping the partial results of the bumps
+    with stage("calculate_sensitivities.base", rows_in=deal_count):
+        selling_diffs = np.where(np.isnan(buying_diffs), np.nan, lookup.selling_diffs[lookup.nearest(buying_diffs)])
+        has_lane = np.zeros(deal_count, dtype=bool)
+        lane_positions = np.full(deal_count, -1)
+        freight_rates = np.zeros(deal_count)
+        if {'Origin', 'Destination'}.issubset(book.columns):
+            has_lane = (book['Origin'].notna() & book['Destination'].notna()).to_numpy()
+            if freight_index is not None and len(freight_index.lane_ids):
+                lane_positions = np.where(has_lane, freight_index.lane_positions_of(book['Origin'], book['Destination']), -1)
+                freight_rates = np.where(lane_positions >= 0, freight_index.lane_rates[lane_positions], 0.0)
+
+        # Both FX legs of every deal, costing legs first, then freight legs; each distinct pair
+        # and value date is converted once (books repeat a few currencies over a few dates)
+        fx_legs = pd.DataFrame({
+            'FX': np.concatenate([(cost_currencies + base_currency).to_numpy(dtype=object), np.full(deal_count, freight_currency + base_currency, dtype=object)]),
+            'VALUE DATE': np.concatenate([value_dates.to_numpy(dtype='datetime64[ns]')] * 2),
+        })
+        leg_amounts = np.concatenate([costings, freight_rates]) * np.tile(quantities, 2)
+        leg_codes = fx_legs.groupby(['FX', 'VALUE DATE'], sort=False, dropna=False).ngroup().to_numpy()
+        conversions, conversion_message = convert_currency_bulk(None, fx_legs.drop_duplicates().assign(AMOUNT=1.0), curve_store=fx_curves)
+        if conversions is None:
+            return None, None, conversion_message
+        leg_rates = conversions['FX RATE'].to_numpy(dtype='float64')[leg_codes]
+        # A zero leg (no freight) needs no rate
+        leg_base_amounts = np.where(leg_amounts == 0, 0.0, leg_amounts * leg_rates)
+        cost_base, freight_base = leg_base_amounts[:deal_count], leg_base_amounts[deal_count:]
+        freight_fx_rates = leg_rates[deal_count:]
+
+        margins = quantities * (selling_diffs - buying_diffs) - cost_base - freight_base
+        statuses = np.select(
+            [np.isnan(buying_diffs) | np.isnan(costings), np.isnan(quantities), invalid_value_dates, np.isnan(cost_base),
+             has_lane & (lane_positions < 0), has_lane & np.isnan(freight_base), np.isnan(selling_diffs)],
+            ["Invalid diff or costing", "Invalid quantity", "Invalid value date", f"No FX rate from cost currency to {base_currency}",
+             "No freight rate found", f"No FX rate from {freight_currency} to {base_currency}", "Selling Diff from sheet is not numeric"],
+            default="OK",
+        )
+        priced = (statuses == "OK") & ~np.isnan(margins)
+        book['Selling Diff'] = selling_diffs
+        book['Freight Rate'] = np.where(lane_positions >= 0, freight_rates, np.nan)
+        book[f'Cost ({base_currency})'] = cost_base + freight_base
+        book[f'Margin ({base_currency})'] = margins
+        book['Status'] = statuses
+
+    priced_quantities = np.where(priced, quantities, 0.0)
+    ladders = []
+
+    # 2. Buying and selling diffs: the whole book moves together
+    with stage("calculate_sensitivities.diffs", rows_in=deal_count):
+        diff_bump = settings["diff_bump"]
+        diff_pnl = []
+        for direction in (1.0, -1.0):
+            bumped_selling_diffs = lookup.selling_diffs[lookup.nearest(buying_diffs + direction * diff_bump)]
+            diff_pnl.append(np.sum(priced_quantities * np.nan_to_num(bumped_selling_diffs - selling_diffs - direction * diff_bump)))
+        total_quantity = priced_quantities.sum()
+        average_weights = priced_quantities / total_quantity if total_quantity else priced_quantities
+        ladders.append(bump_ladder(
+            "Diff", ["Buying Diff", "Selling Diff"],
+            [np.nansum(average_weights * buying_diffs), np.nansum(average_weights * selling_diffs)],
+            diff_bump, "per MT",
+            np.array([diff_pnl[0], diff_bump * total_quantity]),
+            np.array([diff_pnl[1], -diff_bump * total_quantity]),
+        ))
+
+    # 3. FX pairs: leg amounts grouped by conversion pair and rate source, times (1 + b) ** exponent - 1
+    with stage("calculate_sensitivities.fx", rows_in=len(fx_legs)):
+        curve_pairs = fx_curves.pairs()
+        curve_positions = {pair: position for position, pair in enumerate(curve_pairs)}
+        leg_groups = conversions[['FX', 'RATE SOURCE']].assign(
+            Amount=np.bincount(leg_codes, weights=np.where(np.tile(priced, 2), leg_base_amounts, 0.0), minlength=len(conversions)),
+        ).groupby(['FX', 'RATE SOURCE'], sort=False)['Amount'].sum()
+        exponents = np.zeros((len(leg_groups), len(curve_pairs)))
+        for group, (pair, rate_source) in enumerate(leg_groups.index):
+            for curve_pair, exponent in leg_exponents(curve_positions, pair, rate_source).items():
+                if curve_pair in curve_positions:
+                    exponents[group, curve_positions[curve_pair]] += exponent
+        fx_bump = settings["fx_bump_pct"] / 100
+        group_amounts = leg_groups.to_numpy(dtype='float64')
+        # A higher rate converts the same cost into more base currency, lowering the margin
+        fx_pnl_up = -group_amounts @ ((1.0 + fx_bump) ** exponents - 1.0)
+        fx_pnl_down = -group_amounts @ ((1.0 - fx_bump) ** exponents - 1.0)
+        fx_used = (exponents != 0).any(axis=0)
+        latest_rates = np.array([float(fx_curves.latest(pair)[0]) for pair in curve_pairs])
+        fx_ladder = bump_ladder("FX", curve_pairs, latest_rates, settings["fx_bump_pct"], "% of rate", fx_pnl_up, fx_pnl_down)
+        ladders.append(fx_ladder if settings["include_unused"] else fx_ladder[fx_used])
+
+    # 4. Freight lanes: base-currency quantity per lane, times the bump
+    if freight_index is not None and len(freight_index.lane_ids):
+        with stage("calculate_sensitivities.freight", rows_in=deal_count):
+            on_lane = priced & (lane_positions >= 0)
+            lane_exposure = np.bincount(lane_positions[on_lane], weights=(quantities * freight_fx_rates)[on_lane], minlength=len(freight_index.lane_ids))
+            lane_deals = np.bincount(lane_positions[on_lane], minlength=len(freight_index.lane_ids))
+            # Only the listed lanes are labelled; a sheet has far more lanes than a book trades
+            listed_lanes = np.arange(len(freight_index.lane_ids)) if settings["include_unused"] else np.flatnonzero(lane_deals)
+            lane_names = freight_index.lane_table.iloc[freight_index.lane_rows[listed_lanes]]
+            freight_bump = settings["freight_bump"]
+            ladders.append(bump_ladder(
+                "Freight", (lane_names['RateOrigin'].astype(str) + " -> " + lane_names['RateDestination'].astype(str)).to_numpy(),
+                freight_index.lane_rates[listed_lanes], freight_bump, f"{freight_currency} per MT",
+                -freight_bump * lane_exposure[listed_lanes], freight_bump * lane_exposure[listed_lanes],
+            ))
+
+    ladder = pd.concat(ladders, ignore_index=True)
+    priced_deals = int(priced.sum())
+    message = (f"Priced {priced_deals} of {deal_count} deals, book margin {np.sum(margins[priced]):,.2f} {base_currency}; "
+               f"{len(ladder)} factors bumped ({int(fx_used.sum())} FX pairs, {int((ladder['Factor Type'] == 'Freight').sum())} lanes).")
+    return ladder, book, message
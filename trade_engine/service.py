@@ -0,0 +1,416 @@
+"""
+Local HTTP/JSON pricing service over the workbook's reference data, for desk tools that can't go
+through the Streamlit page:
+
+    python -m trade_engine serve --port 8765
+
+Endpoints (a JSON object prices one request; a JSON list prices its items and answers with a list):
+    POST /freight     {"origin", "destination", "quantity_mt", "allow_partial" (optional)}
+    POST /fx          {"pair", "amount", "value_date" (optional, latest rate when missing)}
+    POST /valuation   {"buying_diff", "costing"}
+    GET  /metrics     requests, errors, batch sizes and p50/p99 latency per endpoint
+    GET  /health      reference data sizes
+
+The reference sheets are loaded once per process (see batch.build_pricing_context). Concurrent
+requests of an endpoint are coalesced into micro-batches and priced with the vectorized
+calculators, which apply the rules of calculate_freight_cost, perform_currency_conversion and
+calculate_valuation to every row: a batch waits at most SERVICE_BATCH_WINDOW_SECONDS for more
+requests and is priced on a worker thread, so requests arriving meanwhile form the next batch.
+Conversions also use inverse and cross rates, like convert_currency_bulk. Freight requests with
+"allow_partial" resolve partial names through calculate_freight_cost, one request at a time; the
+other items of the same list are still batched.
+
+The server is asyncio streams with a minimal HTTP/1.1 parser (keep-alive, Content-Length bodies),
+so it needs nothing beyond the standard library and the engine.
+"""
+
+import asyncio
+import collections
+import json
+import logging
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+import numpy as np
+import pandas as pd
+
+from .batch import build_pricing_context, price_chunk
+from .freight import calculate_freight_cost
+
+logger = logging.getLogger(__name__)
+
+SERVICE_DEFAULT_HOST = "127.0.0.1" # Local desk tools only; bind another interface explicitly
+SERVICE_DEFAULT_PORT = 8765
+SERVICE_MAX_BATCH_ROWS = 4096 # Rows priced per micro-batch; bounds the latency a large batch adds
+SERVICE_BATCH_WINDOW_SECONDS = 0.001 # How long a batch waits for concurrent requests to join it
+SERVICE_LATENCY_WINDOW = 10_000 # Latest request latencies kept per endpoint for the percentiles
+SERVICE_MAX_BODY_BYTES = 16 * 1024 * 1024 # Larger request bodies are rejected
+
+# Priced endpoints: batch job, JSON request fields -> input columns (required unless listed as
+# optional; numeric fields must be numbers or numeric strings) and result columns -> JSON response fields
+SERVICE_ENDPOINTS = {
+    "/freight": {
+        "job": "freight",
+        "fields": {"origin": "Origin", "destination": "Destination", "quantity_mt": "QuantityMT"},
+        "optional": [],
+        "numeric": ["quantity_mt"],
+        "results": {"FreightRate": "rate", "TotalFreight": "total_freight", "Status": "status"},
+    },
+    "/fx": {
+        "job": "fx",
+        "fields": {"pair": "FX", "amount": "AMOUNT", "value_date": "VALUE DATE"},
+        "optional": ["value_date"],
+        "numeric": ["amount"],
+        "results": {"CONVERTED AMOUNT": "converted_amount", "FX RATE": "rate", "RATE DATE": "rate_date", "RATE SOURCE": "rate_source"},
+    },
+    "/valuation": {
+        "job": "valuation",
+        "fields": {"buying_diff": "Buying Diff", "costing": "Costings"},
+        "optional": [],
+        "numeric": ["buying_diff", "costing"],
+        "results": {"Selling Diff": "selling_diff", "Break Even": "break_even", "Margin": "margin", "Status": "status"},
+    },
+}
+
+
+def is_numeric_field(value):
+    """True for finite JSON numbers and numeric strings (which the calculators coerce), False for booleans, text, NaN and infinity."""
+    if isinstance(value, bool):
+        return False
+    try:
+        return math.isfinite(float(value))
+    except (TypeError, ValueError):
+        return False
+
+
+def invalid_request_fields(request, endpoint):
+    """Message naming the fields of a request that can't be priced (not a scalar, or not numeric), or None."""
+    not_scalar = [field for field in endpoint["fields"] if isinstance(request.get(field), (list, dict))]
+    if not_scalar:
+        return f"field(s) {', '.join(not_scalar)} must be a single value."
+    not_numeric = [field for field in endpoint["numeric"] if request.get(field) is not None and not is_numeric_field(request[field])]
+    if not_numeric:
+        return f"field(s) {', '.join(not_numeric)} must be numeric."
+    return None
+
+
+def results_to_records(priced_df, results):
+    """JSON-ready records of the result columns of a priced frame: NaN/NaT become None, dates ISO strings."""
+    columns = []
+    for column in results:
+        values = priced_df[column]
+        missing = values.isna().to_numpy()
+        if pd.api.types.is_datetime64_any_dtype(values):
+            items = np.datetime_as_string(values.to_numpy().astype('datetime64[s]')).tolist()
+        else:
+            items = values.to_numpy(dtype=object).tolist()
+        columns.append([None if is_missing else item for item, is_missing in zip(items, missing)])
+    fields = list(results.values())
+    return [dict(zip(fields, row)) for row in zip(*columns)]
+
+
+class LatencyMetrics:
+    """Request counts, errors, batch sizes and a sliding window of latencies per endpoint."""
+
+    def __init__(self, window=SERVICE_LATENCY_WINDOW):
+        self.started_at = time.time()
+        self._latencies = collections.defaultdict(lambda: collections.deque(maxlen=window))
+        self._counts = collections.defaultdict(collections.Counter)
+
+    def record_request(self, endpoint, seconds, error=False):
+        self._latencies[endpoint].append(seconds)
+        self._counts[endpoint]["requests"] += 1
+        if error:
+            self._counts[endpoint]["errors"] += 1
+
+    def record_batch(self, endpoint, rows):
+        self._counts[endpoint]["batches"] += 1
+        self._counts[endpoint]["batched_rows"] += rows
+
+    def snapshot(self):
+        """{"uptime_seconds", "endpoints": {endpoint: counts, mean batch rows and p50/p99/max latency in ms}}."""
+        endpoints = {}
+        for endpoint, counts in sorted(self._counts.items()):
+            latencies = np.fromiter(self._latencies[endpoint], dtype='float64') * 1000
+            p50, p99 = np.percentile(latencies, [50, 99]) if len(latencies) else (None, None)
+            endpoints[endpoint] = {
+                "requests": counts["requests"],
+                "errors": counts["errors"],
+                "batches": counts["batches"],
+                "mean_batch_rows": counts["batched_rows"] / counts["batches"] if counts["batches"] else None,
+                "p50_ms": None if p50 is None else float(p50),
+                "p99_ms": None if p99 is None else float(p99),
+                "max_ms": float(latencies.max()) if len(latencies) else None,
+                "latency_samples": len(latencies),
+            }
+        return {"uptime_seconds": time.time() - self.started_at, "endpoints": endpoints}
+
+
+class MicroBatcher:
+    """
+    Coalesces the rows of concurrent requests into one call of price_rows(list of row dicts) ->
+    (list of result records, message), run on the given executor. submit() resolves to (result
+    records of the request, None) or (None, error message) when its rows can't be priced. When a
+    batch of several requests fails, each request is priced again on its own, so a bad request
+    only fails itself and not the requests it was coalesced with.
+    """
+
+    def __init__(self, name, price_rows, executor, metrics, max_rows=SERVICE_MAX_BATCH_ROWS, window_seconds=SERVICE_BATCH_WINDOW_SECONDS):
+        self.name = name
+        self.price_rows = price_rows
+        self.executor = executor
+        self.metrics = metrics
+        self.max_rows = max_rows
+        self.window_seconds = window_seconds
+        self._pending = collections.deque() # (rows as a list of dicts, future)
+        self._pending_rows = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    async def submit(self, rows):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((rows, future))
+        self._pending_rows += len(rows)
+        self._wakeup.set()
+        return await future
+
+    def _take_batch(self):
+        """Pending requests up to max_rows (at least one request, however large)."""
+        batch, rows = [], 0
+        while self._pending and (not batch or rows + len(self._pending[0][0]) <= self.max_rows):
+            request = self._pending.popleft()
+            batch.append(request)
+            rows += len(request[0])
+        self._pending_rows -= rows
+        return batch, rows
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._wakeup.wait()
+            if self._pending_rows < self.max_rows and self.window_seconds > 0:
+                await asyncio.sleep(self.window_seconds)
+            batch, _ = self._take_batch()
+            if not self._pending:
+                self._wakeup.clear()
+            batch_rows = [row for request_rows, _ in batch for row in request_rows]
+            records, message = await self._price(loop, batch_rows)
+            if records is not None:
+                results, start = [], 0
+                for request_rows, _ in batch:
+                    results.append((records[start:start + len(request_rows)], None))
+                    start += len(request_rows)
+            elif len(batch) > 1:
+                logger.warning(f"Pricing a {self.name} batch of {len(batch)} requests failed ({message}); pricing them one by one")
+                results = [await self._price(loop, request_rows) for request_rows, _ in batch]
+            else:
+                results = [(None, message)]
+            for (_, future), (request_records, request_message) in zip(batch, results):
+                if future.done(): # The client went away
+                    continue
+                future.set_result((request_records, None) if request_records is not None else (None, request_message))
+
+    async def _price(self, loop, rows):
+        """(records, message) of price_rows on the executor; (None, error message) if it raised."""
+        try:
+            records, message = await loop.run_in_executor(self.executor, self.price_rows, rows)
+        except Exception as e:
+            logger.exception(f"Pricing a {self.name} batch of {len(rows)} rows failed")
+            records, message = None, f"Pricing failed: {e}"
+        self.metrics.record_batch(self.name, len(rows))
+        return records, message
+
+
+class PricingService:
+    """
+    The HTTP pricing service of one workbook. Reference data and lookup structures are built once
+    in the constructor; pricing runs on a single worker thread so the event loop keeps accepting
+    requests (which join the next micro-batch) while a batch is priced.
+    """
+
+    def __init__(self, workbook_path, max_batch_rows=SERVICE_MAX_BATCH_ROWS, batch_window_seconds=SERVICE_BATCH_WINDOW_SECONDS):
+        self.workbook_path = workbook_path
+        self.contexts = {endpoint["job"]: build_pricing_context(workbook_path, endpoint["job"]) for endpoint in SERVICE_ENDPOINTS.values()}
+        self.metrics = LatencyMetrics()
+        self.max_batch_rows = max_batch_rows
+        self.batch_window_seconds = batch_window_seconds
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pricing")
+        self._batchers = {}
+
+    def reference_sizes(self):
+        return {
+            "freight_lanes": len(self.contexts["freight"]["freight_index"] or []),
+            "fx_points": len(self.contexts["fx"]["fx_curves"].points),
+            "valuation_rows": len(self.contexts["valuation"]["valo_lookup"] or []),
+        }
+
+    def _batcher(self, path):
+        batcher = self._batchers.get(path)
+        if batcher is None:
+            endpoint = SERVICE_ENDPOINTS[path]
+            context = self.contexts[endpoint["job"]]
+            columns = list(endpoint["fields"].values())
+
+            def price_rows(rows):
+                priced, message = price_chunk(context, pd.DataFrame.from_records(rows, columns=columns))
+                return (None, message) if priced is None else (results_to_records(priced, endpoint["results"]), message)
+
+            batcher = self._batchers[path] = MicroBatcher(
+                path, price_rows, self._executor, self.metrics, self.max_batch_rows, self.batch_window_seconds,
+            )
+        return batcher
+
+    def _price_partial_freight(self, rows):
+        """Freight quotes with partial name resolution, through calculate_freight_cost row by row."""
+        context = self.contexts["freight"]
+        records = []
+        for row in rows:
+            quantity = pd.to_numeric(row['QuantityMT'], errors='coerce')
+            total_freight, message = calculate_freight_cost(
+                context["freight_df"], row['Origin'], row['Destination'], quantity,
+                rate_index=context["freight_index"], allow_partial=True,
+            ) if context["freight_index"] is not None else (None, "Freight data not available.")
+            # Same statuses as calculate_freight_costs_batch; the message has the details
+            if total_freight is None:
+                status = "No freight rate found"
+            elif pd.isna(total_freight):
+                status = "Invalid quantity"
+            else:
+                status = "OK"
+            ok = status == "OK"
+            records.append({
+                "rate": float(total_freight / quantity) if ok and quantity else None,
+                "total_freight": float(total_freight) if ok else None,
+                "status": status,
+                "message": message,
+            })
+        return records
+
+    async def price(self, path, payload):
+        """Prices a JSON payload of a priced endpoint. Returns (HTTP status, JSON-ready response)."""
+        endpoint = SERVICE_ENDPOINTS[path]
+        requests = payload if isinstance(payload, list) else [payload]
+        if not requests or not all(isinstance(request, dict) for request in requests):
+            return HTTPStatus.BAD_REQUEST, {"error": "Expected a JSON object or a non-empty list of objects."}
+        required = [field for field in endpoint["fields"] if field not in endpoint["optional"]]
+        for position, request in enumerate(requests):
+            missing = [field for field in required if request.get(field) is None]
+            if missing:
+                return HTTPStatus.BAD_REQUEST, {"error": f"Request {position}: missing field(s) {', '.join(missing)}."}
+            invalid = invalid_request_fields(request, endpoint)
+            if invalid:
+                return HTTPStatus.BAD_REQUEST, {"error": f"Request {position}: {invalid}"}
+        rows = [{column: request.get(field) for field, column in endpoint["fields"].items()} for request in requests]
+
+        # Only the items asking for partial names take the row-by-row path; the rest are batched
+        partial = [path == "/freight" and bool(request.get("allow_partial")) for request in requests]
+        batched_records, partial_records = [], []
+        batched_rows = [row for row, is_partial in zip(rows, partial) if not is_partial]
+        if batched_rows:
+            batched_records, message = await self._batcher(path).submit(batched_rows)
+            if batched_records is None:
+                return HTTPStatus.UNPROCESSABLE_ENTITY, {"error": message}
+        partial_rows = [row for row, is_partial in zip(rows, partial) if is_partial]
+        if partial_rows:
+            partial_records = await asyncio.get_running_loop().run_in_executor(self._executor, self._price_partial_freight, partial_rows)
+        batched_records, partial_records = iter(batched_records), iter(partial_records)
+        records = [next(partial_records) if is_partial else next(batched_records) for is_partial in partial]
+        return HTTPStatus.OK, records if isinstance(payload, list) else records[0]
+
+    async def dispatch(self, method, path, body):
+        """Routes one request. Returns (HTTP status, JSON-ready response)."""
+        if path in SERVICE_ENDPOINTS:
+            if method != "POST":
+                return HTTPStatus.METHOD_NOT_ALLOWED, {"error": f"Use POST for {path}."}
+            try:
+                payload = json.loads(body or b"null")
+            except ValueError as e:
+                return HTTPStatus.BAD_REQUEST, {"error": f"Invalid JSON: {e}"}
+            return await self.price(path, payload)
+        if method != "GET":
+            return HTTPStatus.METHOD_NOT_ALLOWED, {"error": f"Use GET for {path}."}
+        if path == "/metrics":
+            return HTTPStatus.OK, self.metrics.snapshot()
+        if path == "/health":
+            return HTTPStatus.OK, {"status": "ok", "workbook": self.workbook_path, "reference": self.reference_sizes()}
+        return HTTPStatus.NOT_FOUND, {"error": f"Unknown endpoint {path}; use {', '.join([*SERVICE_ENDPOINTS, '/metrics', '/health'])}."}
+
+    async def handle_connection(self, reader, writer):
+        """Serves the requests of one keep-alive connection in order."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                parts = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode('latin-1').partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                if len(parts) != 3:
+                    await self._respond(writer, HTTPStatus.BAD_REQUEST, {"error": "Malformed request line."}, keep_alive=False)
+                    break
+                method, target, version = parts
+                length = int(headers.get("content-length") or 0)
+                if length > SERVICE_MAX_BODY_BYTES:
+                    await self._respond(writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {"error": "Request body too large."}, keep_alive=False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+
+                path = target.split("?", 1)[0]
+                start = time.perf_counter()
+                try:
+                    status, response = await self.dispatch(method, path, body)
+                except Exception as e:
+                    logger.exception(f"{method} {path} failed")
+                    status, response = HTTPStatus.INTERNAL_SERVER_ERROR, {"error": str(e)}
+                if path in SERVICE_ENDPOINTS:
+                    self.metrics.record_request(path, time.perf_counter() - start, error=status != HTTPStatus.OK)
+
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+                await self._respond(writer, status, response, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass # Client went away or sent an unparsable header
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _respond(writer, status, response, keep_alive):
+        body = json.dumps(response, default=str).encode()
+        writer.write(
+            f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + body
+        )
+        await writer.drain()
+
+    async def serve(self, host=SERVICE_DEFAULT_HOST, port=SERVICE_DEFAULT_PORT):
+        """Serves until cancelled."""
+        server = await asyncio.start_server(self.handle_connection, host, port, backlog=1024)
+        logger.info(f"Pricing service on http://{host}:{port} ({', '.join(f'{name} {size:,}' for name, size in self.reference_sizes().items())})")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def run_service(workbook_path, host=SERVICE_DEFAULT_HOST, port=SERVICE_DEFAULT_PORT, max_batch_rows=SERVICE_MAX_BATCH_ROWS, batch_window_seconds=SERVICE_BATCH_WINDOW_SECONDS):
+    """Loads the reference data of workbook_path and serves it until interrupted (blocking)."""
+    load_start = time.perf_counter()
+    service = PricingService(workbook_path, max_batch_rows, batch_window_seconds)
+    logger.info(f"Loaded the reference data in {time.perf_counter() - load_start:.2f}s")
+    try:
+        asyncio.run(service.serve(host, port))
+    except KeyboardInterrupt:
+        pass
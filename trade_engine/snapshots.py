@@ -0,0 +1,73 @@
+"""
+Persistent snapshot cache of processed sheet frames.
+
+Each frame is stored as uncompressed Arrow IPC under the fingerprint of its sheet, so a later
+start (of the app or of a batch run) memory-maps it instead of parsing the workbook again.
+"""
+
+import logging
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from .instrumentation import instrumented
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_CACHE_DIR = ".snapshot_cache"
+SNAPSHOT_VERSION = 3 # Bump whenever a process_* function changes so stale snapshots are not reused
+
+
+def to_columnar_frame(df):
+    """
+    Makes a DataFrame storable as Arrow: column labels become strings and object
+    columns holding mixed types (common in raw Excel sheets) are stored as text.
+    """
+    df_columnar = df.copy(deep=False)
+    df_columnar.columns = [str(col) for col in df_columnar.columns]
+    for col in df_columnar.columns:
+        if df_columnar[col].dtype == "object" and pd.api.types.infer_dtype(df_columnar[col], skipna=True).startswith("mixed"):
+            df_columnar[col] = df_columnar[col].map(lambda value: None if pd.isna(value) else str(value))
+    return df_columnar
+
+
+def snapshot_path(sheet_fingerprint, frame_name):
+    """Location of one cached frame inside the snapshot cache directory."""
+    return os.path.join(SNAPSHOT_CACHE_DIR, "sheets", sheet_fingerprint, f"{frame_name}.arrow")
+
+
+@instrumented()
+def read_snapshot(sheet_fingerprint, frame_names):
+    """
+    Memory-maps the cached frames of one sheet. Returns None if any of them is missing
+    or unreadable, in which case the sheet has to be parsed again.
+    """
+    frames = {}
+    for frame_name in frame_names:
+        path = snapshot_path(sheet_fingerprint, frame_name)
+        if not os.path.exists(path):
+            return None
+        try:
+            frames[frame_name] = feather.read_table(path, memory_map=True).to_pandas()
+        except (OSError, pa.ArrowException):
+            return None
+    return frames
+
+
+@instrumented(rows_in="frames")
+def write_snapshot(sheet_fingerprint, frames):
+    """Writes the frames of one sheet to the snapshot cache (uncompressed Arrow IPC for zero-copy reads)."""
+    for frame_name, df in frames.items():
+        path = snapshot_path(sheet_fingerprint, frame_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so concurrent servers never map a half-written snapshot
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            feather.write_feather(to_columnar_frame(df), tmp_path, compression="uncompressed")
+            os.replace(tmp_path, path)
+        except (OSError, pa.ArrowException) as e:
+            logger.warning(f"Could not write snapshot for '{frame_name}': {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
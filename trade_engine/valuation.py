@@ -0,0 +1,172 @@
+"""
+Valuation of a purchase against the 'Valo Ori & Dest' sheet: break even and margin from the
+Selling Diff of the nearest Buying Diff row.
+"""
+
+import numpy as np
+import pandas as pd
+
+from .instrumentation import instrumented
+
+
+def nearest_positions(sorted_values, rows, values):
+    """
+    Positions in sorted_values of the closest value to each input, with ties going to the
+    lowest sheet row (rows holds the sheet row of each sorted value).
+    """
+    right = np.searchsorted(sorted_values, values).clip(0, len(sorted_values) - 1)
+    left = (right - 1).clip(0, len(sorted_values) - 1)
+    left_distance = np.abs(values - sorted_values[left])
+    right_distance = np.abs(sorted_values[right] - values)
+    pick_left = (left_distance < right_distance) | ((left_distance == right_distance) & (rows[left] <= rows[right]))
+    return np.where(pick_left, left, right)
+
+
+class ValuationLookup:
+    """
+    Valo rows sorted by 'Buying Diff' for nearest-row lookups with a single searchsorted,
+    scalar or vectorized. Duplicate buying diffs keep their first row, and a value exactly
+    halfway between two buying diffs resolves to the row that comes first in the sheet.
+    """
+
+    @instrumented("ValuationLookup.build", rows_in="valo_df")
+    def __init__(self, valo_df):
+        valo_points = pd.DataFrame({
+            'Buying Diff': pd.to_numeric(valo_df['Buying Diff'], errors='coerce').to_numpy(),
+            'Selling Diff': pd.to_numeric(valo_df['Selling Diff'], errors='coerce').to_numpy(),
+            'Row': np.arange(len(valo_df)),
+        }).dropna(subset=['Buying Diff'])
+        valo_points = valo_points.drop_duplicates(subset='Buying Diff', keep='first').sort_values(by='Buying Diff')
+        self.buying_diffs = valo_points['Buying Diff'].to_numpy(dtype='float64')
+        self.selling_diffs = valo_points['Selling Diff'].to_numpy(dtype='float64')
+        self.rows = valo_points['Row'].to_numpy()
+
+    def __len__(self):
+        return len(self.buying_diffs)
+
+    def nearest(self, buying_diffs):
+        """Positions (into the sorted arrays) of the closest 'Buying Diff' for each input value."""
+        return nearest_positions(self.buying_diffs, self.rows, np.asarray(buying_diffs, dtype='float64'))
+
+
+@instrumented()
+def calculate_valuation(valo_df, buying_diff, costing, lookup=None):
+    """
+    Calculates valuation metrics (Break Even, Margin) based on Valo data.
+    Assumes valo_df has columns 'Buying Diff', 'Costings', 'Break Even', 'Selling Diff', 'Margin'.
+    This is a simplified calculation based on the structure, actual logic might be more complex.
+    Pass a prebuilt lookup (ValuationLookup of valo_df) to avoid re-sorting the sheet on every call.
+    """
+    if valo_df.empty:
+        return None, None, "Valuation data not available."
+
+    # Find relevant row based on Buying Diff and Costings (simplified)
+    # In a real scenario, the lookup would likely be more complex based on contract terms, etc.
+    # Let's find a row where 'Buying Diff' is close and use its 'Selling Diff' for a sample calculation
+
+    # Find the row with the closest 'Buying Diff' to the input (simplified lookup)
+    if 'Buying Diff' not in valo_df.columns or 'Selling Diff' not in valo_df.columns:
+         return None, None, "Required columns for valuation calculation not found ('Buying Diff', 'Selling Diff')."
+
+    if lookup is None:
+        lookup = ValuationLookup(valo_df)
+
+    if len(lookup) == 0:
+        return None, None, "Valuation data empty after processing 'Buying Diff'."
+
+    # Assuming Break Even = Buying Diff + Costings (simplified)
+    # Assuming Margin = Selling Diff - Break Even (simplified)
+    # We will use the 'Selling Diff' from the closest row found for a sample Margin calculation
+
+    selling_diff_from_sheet = lookup.selling_diffs[lookup.nearest(buying_diff)]
+
+    if pd.isna(selling_diff_from_sheet):
+         return None, None, "Selling Diff from sheet is not numeric."
+
+
+    calculated_break_even = buying_diff + costing # Use input costing
+    calculated_margin = selling_diff_from_sheet - calculated_break_even
+
+    return calculated_break_even, calculated_margin, f"Calculated using Selling Diff ({selling_diff_from_sheet:.2f}) from sheet."
+
+
+@instrumented(rows_in="buying_diffs")
+def calculate_valuation_grid(valo_df, buying_diffs, costings, lookup=None):
+    """
+    Evaluates calculate_valuation over every combination of the given buying diffs and
+    costings at once: one searchsorted for the nearest rows, then broadcast arithmetic.
+    Returns a long DataFrame ('Buying Diff', 'Costings', 'Selling Diff', 'Break Even',
+    'Margin'; one row per grid point) and a message. The first element is None on error.
+    """
+    if valo_df.empty:
+        return None, "Valuation data not available."
+
+    if 'Buying Diff' not in valo_df.columns or 'Selling Diff' not in valo_df.columns:
+        return None, "Required columns for valuation calculation not found ('Buying Diff', 'Selling Diff')."
+
+    if lookup is None:
+        lookup = ValuationLookup(valo_df)
+
+    if len(lookup) == 0:
+        return None, "Valuation data empty after processing 'Buying Diff'."
+
+    buying_diffs = np.asarray(buying_diffs, dtype='float64')
+    costings = np.asarray(costings, dtype='float64')
+
+    # Selling diff only depends on the buying diff, so it is looked up once per grid row
+    selling_diffs = lookup.selling_diffs[lookup.nearest(buying_diffs)]
+    break_even = buying_diffs[:, None] + costings[None, :]
+    margin = selling_diffs[:, None] - break_even
+
+    grid = pd.DataFrame({
+        'Buying Diff': np.repeat(buying_diffs, len(costings)),
+        'Costings': np.tile(costings, len(buying_diffs)),
+        'Selling Diff': np.repeat(selling_diffs, len(costings)),
+        'Break Even': break_even.ravel(),
+        'Margin': margin.ravel(),
+    })
+    return grid, f"Evaluated {len(grid)} grid points ({len(buying_diffs)} buying diffs x {len(costings)} costings)."
+
+
+# Columns of a deals table valued by calculate_valuation_batch
+VALUATION_DEAL_COLUMNS = ['Buying Diff', 'Costings']
+
+@instrumented(rows_in="deals_df")
+def calculate_valuation_batch(valo_df, deals_df, lookup=None):
+    """
+    Values many deals at once with the rule of calculate_valuation: deals_df needs the columns
+    'Buying Diff' and 'Costings'. Returns the deals with 'Selling Diff', 'Break Even', 'Margin'
+    and a per-row 'Status' added, plus a summary message. The first element is None on error.
+    """
+    if valo_df.empty:
+        return None, "Valuation data not available."
+
+    if 'Buying Diff' not in valo_df.columns or 'Selling Diff' not in valo_df.columns:
+        return None, "Required columns for valuation calculation not found ('Buying Diff', 'Selling Diff')."
+
+    missing_columns = [col for col in VALUATION_DEAL_COLUMNS if col not in deals_df.columns]
+    if missing_columns:
+        return None, f"Missing column(s) in deals: {', '.join(missing_columns)}."
+
+    if lookup is None:
+        lookup = ValuationLookup(valo_df)
+
+    if len(lookup) == 0:
+        return None, "Valuation data empty after processing 'Buying Diff'."
+
+    valuations = deals_df.copy()
+    buying_diffs = pd.to_numeric(valuations['Buying Diff'], errors='coerce').to_numpy(dtype='float64')
+    costings = pd.to_numeric(valuations['Costings'], errors='coerce').to_numpy(dtype='float64')
+
+    selling_diffs = lookup.selling_diffs[lookup.nearest(np.nan_to_num(buying_diffs))]
+    valuations['Selling Diff'] = np.where(np.isnan(buying_diffs), np.nan, selling_diffs)
+    valuations['Break Even'] = buying_diffs + costings
+    valuations['Margin'] = valuations['Selling Diff'] - valuations['Break Even']
+    valuations['Status'] = np.select(
+        [np.isnan(buying_diffs) | np.isnan(costings), np.isnan(selling_diffs)],
+        ["Invalid buying diff or costing", "Selling Diff from sheet is not numeric"],
+        default="OK",
+    )
+
+    valued_deals = int((valuations['Status'] == "OK").sum())
+    return valuations, f"Valued {valued_deals} of {len(valuations)} deals, total margin per MT {valuations['Margin'].sum():.2f}."
@@ -0,0 +1,335 @@
+"""
+Loading of the trading workbook: sheet parsing, per-sheet fingerprints, the WorkbookStore
+that keeps the processed frames and reloads only the sheets that changed, and the sheet
+catalog and row pages used to browse every other sheet on demand.
+"""
+
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+import zipfile
+import xml.etree.ElementTree as ET
+
+import pandas as pd
+from openpyxl import load_workbook
+from openpyxl.utils import get_column_letter, range_boundaries
+
+from .instrumentation import instrumented
+from .schemas import RATE_DTYPE
+from .snapshots import SNAPSHOT_VERSION, read_snapshot, write_snapshot
+
+logger = logging.getLogger(__name__)
+
+# Default location of the workbook and the relevant sheet names
+DEFAULT_WORKBOOK_PATH = "Cocoa Trading Sheet.xlsx"
+SHEET_NAME_BEANS = "Costing Beans"
+SHEET_NAME_PRODUCTS = "Costing Products"
+SHEET_NAME_FREIGHT = "Freight & Dressing"
+SHEET_NAME_VALO = "Valo Ori & Dest"
+SHEET_NAME_FX_FIX = "Market & FX Fix"
+SHEET_NAME_FX_LIVE = "Market & FX Live"
+# Sheets whose raw (unprocessed) data is previewed in the UI
+RAW_PREVIEW_SHEETS = [SHEET_NAME_PRODUCTS, SHEET_NAME_VALO, SHEET_NAME_FX_FIX, SHEET_NAME_FX_LIVE]
+
+# XML namespaces used inside the xlsx archive
+XLSX_NS = {
+    "main": "http://schemas.openxmlformats.org/spreadsheetml/2006/main",
+    "rel": "http://schemas.openxmlformats.org/package/2006/relationships",
+    "r": "http://schemas.openxmlformats.org/officeDocument/2006/relationships",
+}
+
+@instrumented()
+def load_excel_data(file_path, sheet_names):
+    """
+    Loads specified sheets from an Excel file into a dictionary of DataFrames.
+    The workbook is opened once in read-only, values-only mode and every requested
+    sheet is streamed out of that single archive handle, so the zip and the shared
+    strings are only parsed once per cold start. Reports how long each sheet took.
+    """
+    dataframes = {}
+    load_start = time.perf_counter()
+    try:
+        # read_only streams rows without building the full cell/style model,
+        # data_only returns the values Excel last cached instead of formulas
+        workbook = pd.ExcelFile(file_path, engine="openpyxl", engine_kwargs={"read_only": True, "data_only": True})
+    except FileNotFoundError:
+        logger.error(f"Error: File not found at {file_path}")
+        return dataframes # Nothing can be loaded without the file
+    except Exception as e:
+        logger.error(f"Error opening workbook '{file_path}': {e}")
+        return dataframes
+
+    with workbook:
+        logger.debug(f"Opened workbook in {time.perf_counter() - load_start:.2f}s")
+        for sheet_name in sheet_names:
+            sheet_start = time.perf_counter()
+            try:
+                # Use header=0, assuming the first row contains headers
+                df = workbook.parse(sheet_name=sheet_name, header=0)
+
+                dataframes[sheet_name] = df
+                logger.info(f"Successfully loaded sheet: '{sheet_name}' ({time.perf_counter() - sheet_start:.2f}s)")
+            except Exception as e:
+                logger.error(f"Error loading sheet '{sheet_name}': {e}")
+                dataframes[sheet_name] = pd.DataFrame() # Return empty DataFrame on error
+
+    logger.debug(f"Loaded {len(dataframes)} sheet(s) in {time.perf_counter() - load_start:.2f}s")
+    return dataframes
+
+
+def workbook_content_hash(file_path):
+    """Returns the SHA-256 of the workbook file."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def workbook_sheet_parts(archive):
+    """
+    Maps every sheet name to its worksheet part inside an open xlsx zip archive
+    (e.g. 'Costing Beans' -> 'xl/worksheets/sheet1.xml') using workbook.xml and its rels.
+    """
+    workbook_xml = ET.fromstring(archive.read("xl/workbook.xml"))
+    rels_xml = ET.fromstring(archive.read("xl/_rels/workbook.xml.rels"))
+    targets = {rel.get("Id"): rel.get("Target") for rel in rels_xml.findall("rel:Relationship", XLSX_NS)}
+
+    sheet_parts = {}
+    for sheet in workbook_xml.findall("main:sheets/main:sheet", XLSX_NS):
+        target = targets.get(sheet.get(f"{{{XLSX_NS['r']}}}id"))
+        if target is None:
+            continue
+        # Targets are usually relative to xl/, but may also be absolute within the package
+        sheet_parts[sheet.get("name")] = target.lstrip("/") if target.startswith("/") else f"xl/{target}"
+    return sheet_parts
+
+
+def read_shared_strings(archive):
+    """Returns the workbook's shared strings table as a list (empty if the workbook has none)."""
+    if "xl/sharedStrings.xml" not in archive.namelist():
+        return []
+    sst_xml = ET.fromstring(archive.read("xl/sharedStrings.xml"))
+    # Rich text entries split their text across several <r><t> runs, so join all <t> nodes
+    return ["".join(t.text or "" for t in si.iter(f"{{{XLSX_NS['main']}}}t")) for si in sst_xml.findall("main:si", XLSX_NS)]
+
+
+SHEET_CATALOG_COLUMNS = ['Sheet', 'State', 'Dimension', 'Rows', 'Columns', 'XML Bytes', 'Compressed Bytes']
+SHEET_HEAD_READ_BYTES = 64 * 1024 # The <dimension> element precedes the cell data, so only the start of a part is read
+# Matches the used range of a worksheet, e.g. <dimension ref="A1:AK1867"/>
+SHEET_DIMENSION_PATTERN = re.compile(rb'<dimension\b[^>]*\bref="([^"]+)"')
+
+@instrumented()
+def sheet_catalog(file_path):
+    """
+    Lists every worksheet of the workbook in tab order with its visibility, used range (from the
+    <dimension> element Excel writes at the start of each part) and its XML size, without parsing
+    any cell data. Rows and Columns are None when a part has no dimension; the catalog is empty
+    if the workbook cannot be read.
+    """
+    try:
+        archive = zipfile.ZipFile(file_path)
+    except (FileNotFoundError, zipfile.BadZipFile) as e:
+        logger.error(f"Error reading the sheet catalog of '{file_path}': {e}")
+        return pd.DataFrame(columns=SHEET_CATALOG_COLUMNS)
+    with archive:
+        workbook_xml = ET.fromstring(archive.read("xl/workbook.xml"))
+        sheet_parts = workbook_sheet_parts(archive)
+        catalog = []
+        for sheet in workbook_xml.findall("main:sheets/main:sheet", XLSX_NS):
+            sheet_name = sheet.get("name")
+            part = sheet_parts.get(sheet_name)
+            if part is None or part not in archive.namelist():
+                continue
+            part_info = archive.getinfo(part)
+            with archive.open(part) as part_file:
+                dimension_match = SHEET_DIMENSION_PATTERN.search(part_file.read(SHEET_HEAD_READ_BYTES))
+            dimension = dimension_match.group(1).decode() if dimension_match else None
+            rows = columns = None
+            if dimension is not None:
+                try:
+                    min_col, min_row, max_col, max_row = range_boundaries(dimension)
+                    rows, columns = max_row - min_row + 1, max_col - min_col + 1
+                except (TypeError, ValueError): # Malformed or open-ended ranges
+                    pass
+            catalog.append((sheet_name, sheet.get("state", "visible"), dimension, rows, columns, part_info.file_size, part_info.compress_size))
+    return pd.DataFrame(catalog, columns=SHEET_CATALOG_COLUMNS).astype({'Rows': 'Int64', 'Columns': 'Int64'})
+
+
+@instrumented(rows_in="row_count")
+def read_sheet_rows(file_path, sheet_name, first_row, row_count):
+    """
+    Reads the rows first_row .. first_row + row_count - 1 (Excel row numbers) of one sheet, as the
+    values Excel last saved. The sheet is streamed in read-only mode and parsing stops after the
+    last requested row, so early pages of a large sheet are cheap; later pages still scan the rows
+    before them. Returns (DataFrame indexed by row number with the Excel column letters as columns,
+    message); the DataFrame is None on error.
+    """
+    try:
+        workbook = load_workbook(file_path, read_only=True, data_only=True, keep_links=False) # External link caches are not needed for values
+    except FileNotFoundError:
+        return None, f"Error: File not found at {file_path}"
+    except Exception as e:
+        return None, f"Error opening workbook '{file_path}': {e}"
+    try:
+        if sheet_name not in workbook.sheetnames:
+            return None, f"Sheet '{sheet_name}' not found in the workbook."
+        last_row = first_row + row_count - 1
+        rows = list(workbook[sheet_name].iter_rows(min_row=first_row, max_row=last_row, values_only=True))
+    except Exception as e:
+        return None, f"Error reading rows {first_row}-{first_row + row_count - 1} of '{sheet_name}': {e}"
+    finally:
+        workbook.close()
+
+    # Drop the empty cells openpyxl pads short rows with, then label the columns like Excel
+    df_page = pd.DataFrame(rows, index=pd.RangeIndex(first_row, first_row + len(rows), name='Row'))
+    df_page = df_page.dropna(axis=1, how='all')
+    df_page.columns = [get_column_letter(column + 1) for column in df_page.columns]
+    return df_page, f"Read rows {first_row}-{first_row + len(rows) - 1} of '{sheet_name}'."
+
+
+# Matches the shared string index of cells stored as <c ... t="s"><v>12</v></c>
+SHARED_STRING_CELL_PATTERN = re.compile(rb'<c\b[^>]*\bt="s"[^>]*>\s*<v>(\d+)</v>')
+
+def sheet_fingerprints(file_path, sheet_names):
+    """
+    Fingerprints each requested sheet from the raw bytes of its worksheet part plus the
+    shared strings it references, without parsing any cell data. A sheet's fingerprint
+    only changes when that sheet's content changes, even if other sheets were edited.
+    """
+    fingerprints = {}
+    with zipfile.ZipFile(file_path) as archive:
+        sheet_parts = workbook_sheet_parts(archive)
+        shared_strings = None
+        for sheet_name in sheet_names:
+            part = sheet_parts.get(sheet_name)
+            if part is None:
+                continue
+            sheet_bytes = archive.read(part)
+            if shared_strings is None:
+                shared_strings = read_shared_strings(archive)
+
+            # Frames processed with another rate dtype are cached under other fingerprints
+            digest = hashlib.sha256(f"v{SNAPSHOT_VERSION}:{RATE_DTYPE}:{sheet_name}".encode())
+            digest.update(sheet_bytes)
+            # Edits to the shared strings table can change a sheet's values without touching its XML
+            for index in SHARED_STRING_CELL_PATTERN.findall(sheet_bytes):
+                index = int(index)
+                digest.update(shared_strings[index].encode() if index < len(shared_strings) else b"")
+                digest.update(b"\x00")
+            fingerprints[sheet_name] = digest.hexdigest()
+    return fingerprints
+
+
+class WorkbookStore:
+    """
+    Process-wide holder of the loaded sheets, shared by all sessions of the app and by batch workers.
+    refresh() notices when the workbook file changed on disk, fingerprints every worksheet
+    part and reloads only the sheets whose fingerprint changed. Frames of unchanged sheets
+    stay the same objects, so the caches built on top of them stay warm.
+    """
+
+    def __init__(self, file_path, sheet_processors, raw_preview_sheets):
+        self.file_path = file_path
+        self.sheet_processors = sheet_processors
+        self.raw_preview_sheets = raw_preview_sheets
+        self.sheet_frames = {} # {sheet_name: {'processed': df, 'raw': df}}
+        self.fingerprints = {}
+        self.workbook_hash = None
+        self.version = 0 # Incremented every time at least one sheet is reloaded
+        self._file_stat = None
+        self._lock = threading.Lock()
+
+    def memory_bytes(self):
+        """Bytes held by the loaded frames; shared by every session, so independent of their number."""
+        return sum(
+            int(frame.memory_usage(index=True, deep=False).sum())
+            for frames in self.sheet_frames.values() for frame in frames.values()
+        )
+
+    def _stat_key(self):
+        stat = os.stat(self.file_path)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def has_file_changed(self):
+        """Cheap check (a single stat call) whether the workbook was written since the last refresh."""
+        try:
+            return self._stat_key() != self._file_stat
+        except FileNotFoundError:
+            return False # Keep serving the last loaded data while the file is being replaced
+
+    @instrumented()
+    def refresh(self):
+        """
+        Reloads the sheets that changed since the last refresh and returns their names.
+        Raises FileNotFoundError if the workbook does not exist.
+        """
+        stat_key = self._stat_key()
+        if stat_key == self._file_stat:
+            return []
+
+        with self._lock:
+            if stat_key == self._file_stat: # Another session refreshed while we were waiting
+                return []
+
+            workbook_hash = workbook_content_hash(self.file_path)
+            if workbook_hash == self.workbook_hash: # Saved again without any content change
+                self._file_stat = stat_key
+                return []
+
+            try:
+                fingerprints = sheet_fingerprints(self.file_path, list(self.sheet_processors))
+            except (zipfile.BadZipFile, ET.ParseError, KeyError) as e:
+                # Excel may still be writing the file; keep the current frames and retry on the next check
+                logger.warning(f"Workbook could not be read yet, keeping the previous data: {e}")
+                return []
+
+            changed_sheets = [
+                sheet_name for sheet_name in self.sheet_processors
+                if sheet_name not in self.sheet_frames or fingerprints.get(sheet_name) != self.fingerprints.get(sheet_name)
+            ]
+            if changed_sheets:
+                self.sheet_frames = {**self.sheet_frames, **self._load_sheets(changed_sheets, fingerprints, workbook_hash)}
+                self.version += 1
+            self.fingerprints = fingerprints
+            self.workbook_hash = workbook_hash
+            self._file_stat = stat_key
+            return changed_sheets
+
+    def _load_sheets(self, sheet_names, fingerprints, workbook_hash):
+        """
+        Loads the given sheets: memory-mapped from the snapshot cache when their fingerprint
+        is already there, otherwise parsed from Excel in one pass, processed and snapshotted.
+        """
+        sheet_frames = {}
+
+        def frame_names_for(sheet_name):
+            return ["processed", "raw"] if sheet_name in self.raw_preview_sheets else ["processed"]
+
+        sheets_to_parse = []
+        for sheet_name in sheet_names:
+            fingerprint = fingerprints.get(sheet_name)
+            cached_frames = read_snapshot(fingerprint, frame_names_for(sheet_name)) if fingerprint else None
+            if cached_frames is not None:
+                sheet_frames[sheet_name] = cached_frames
+                logger.info(f"Loaded sheet from snapshot cache: '{sheet_name}'")
+            else:
+                sheets_to_parse.append(sheet_name)
+
+        if sheets_to_parse:
+            # Single parse of only the sheets that are not cached yet
+            excel_data = load_excel_data(self.file_path, sheets_to_parse)
+            for sheet_name in sheets_to_parse:
+                df_raw = excel_data.get(sheet_name, pd.DataFrame())
+                frames = {"processed": self.sheet_processors[sheet_name](df_raw)}
+                if sheet_name in self.raw_preview_sheets:
+                    frames["raw"] = df_raw
+                sheet_frames[sheet_name] = frames
+                # Don't snapshot failed loads, so the next start retries the sheet
+                if sheet_name in fingerprints and not df_raw.empty:
+                    write_snapshot(fingerprints[sheet_name], frames)
+
+        return sheet_frames